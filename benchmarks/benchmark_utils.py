@@ -0,0 +1,256 @@
+# Copyright 2020 The OpenAGI Datum Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Input datasets and resource measurements shared by the benchmarks.
+
+Input datasets are generated in the layouts the `datum.generator` generators read, see
+`make_inputs`. Images are smooth random images encoded as JPEG, so that their size is close to the
+size of natural images of the same resolution.
+"""
+
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any, Optional
+
+import numpy as np
+
+from datum.generator.synthetic import encode_random_image
+from datum.problem import types
+
+# Variable length features of the problems, written as sparse features.
+SPARSE_FEATURES = {
+    types.IMAGE_DET:
+    ["xmin", "xmax", "ymin", "ymax", "area", "labels", "pose", "is_truncated", "labels_difficult"],
+}
+# Number of distinct images encoded, images are reused by the examples of larger datasets.
+_NUM_DISTINCT_IMAGES = 64
+_CLASS_NAMES = ("cat", "dog", "car", "person", "bicycle", "bird", "boat", "bottle")
+_WORDS = ("the", "a", "datum", "record", "shard", "image", "text", "label", "fast", "slow",
+          "example", "dataset", "writer", "reader", "benchmark", "memory")
+
+
+def _encode_images(image_size: int, num_images: int, seed: int) -> list[bytes]:
+  """Returns num_images random JPEG images of image_size x image_size pixels."""
+  rng = np.random.default_rng(seed)
+  return [encode_random_image(rng, image_size, image_size) for _ in range(num_images)]
+
+
+def _write_images(image_dir: Path, image_ids: list[str], image_size: int, seed: int) -> None:
+  image_dir.mkdir(parents=True, exist_ok=True)
+  images = _encode_images(image_size, min(len(image_ids), _NUM_DISTINCT_IMAGES), seed)
+  for idx, image_id in enumerate(image_ids):
+    (image_dir / f"{image_id}.jpg").write_bytes(images[idx % len(images)])
+
+
+def make_clf_inputs(path: str,
+                    split: str,
+                    num_examples: int,
+                    image_size: int,
+                    seed: int = 0) -> None:
+  """Writes an image classification split, `<split>.csv` and images in `<split>/`."""
+  rng = np.random.default_rng(seed)
+  image_ids = [f"image_{idx:08d}" for idx in range(num_examples)]
+  _write_images(Path(path) / split, image_ids, image_size, seed)
+  labels = rng.integers(0, len(_CLASS_NAMES), size=num_examples)
+  with open(os.path.join(path, f"{split}.csv"), "w") as f:
+    f.write("filename,label\n")
+    for image_id, label in zip(image_ids, labels):
+      f.write(f"{image_id},{label}\n")
+
+
+def make_det_inputs(path: str,
+                    split: str,
+                    num_examples: int,
+                    image_size: int,
+                    max_objects: int = 8,
+                    seed: int = 0) -> None:
+  """Writes a VOC style detection split, image set, JPEG images and XML annotations."""
+  rng = np.random.default_rng(seed)
+  root = Path(path)
+  image_ids = [f"{split}_{idx:08d}" for idx in range(num_examples)]
+  _write_images(root / "JPEGImages", image_ids, image_size, seed)
+  (root / "classes.names").write_text("\n".join(_CLASS_NAMES) + "\n")
+  (root / "ImageSets").mkdir(exist_ok=True)
+  (root / "ImageSets" / f"{split}.txt").write_text("\n".join(image_ids) + "\n")
+  (root / "Annotations").mkdir(exist_ok=True)
+  for image_id in image_ids:
+    objects = []
+    for _ in range(rng.integers(1, max_objects + 1)):
+      xmin, ymin = rng.integers(0, image_size // 2, size=2)
+      xmax, ymax = rng.integers(image_size // 2, image_size, size=2)
+      objects.append(f"<object><name>{_CLASS_NAMES[rng.integers(len(_CLASS_NAMES))]}</name>"
+                     f"<pose>Unspecified</pose><truncated>{rng.integers(2)}</truncated>"
+                     f"<difficult>{rng.integers(2)}</difficult><bndbox><xmin>{xmin}</xmin>"
+                     f"<ymin>{ymin}</ymin><xmax>{xmax}</xmax><ymax>{ymax}</ymax></bndbox>"
+                     "</object>")
+    (root / "Annotations" / f"{image_id}.xml").write_text(
+        f"<annotation><filename>{image_id}.jpg</filename><size><width>{image_size}</width>"
+        f"<height>{image_size}</height><depth>3</depth></size>{''.join(objects)}</annotation>")
+
+
+def make_text_inputs(path: str,
+                     split: str,
+                     num_examples: int,
+                     num_words: int = 128,
+                     seed: int = 0) -> None:
+  """Writes a text classification split as `<split>.json`, see `TextJsonDatumGenerator`."""
+  rng = np.random.default_rng(seed)
+  data = {}
+  for idx in range(num_examples):
+    words = rng.choice(_WORDS, size=rng.integers(num_words // 2, num_words + 1))
+    data[f"{split}_{idx:08d}"] = {
+        "text": " ".join(words),
+        "label": {
+            "polarity": int(rng.integers(2)),
+        },
+    }
+  Path(path).mkdir(parents=True, exist_ok=True)
+  with open(os.path.join(path, f"{split}.json"), "w") as f:
+    json.dump(data, f)
+
+
+def make_inputs(problem_type: str,
+                path: str,
+                split: str,
+                num_examples: int,
+                image_size: int = 256,
+                seed: int = 0) -> None:
+  """Writes an input split of num_examples examples for problem_type to path.
+
+  Args:
+    problem_type: `image_clf`, `image_det` or `text_clf`, see `datum.problem.types`.
+    path: input dataset directory, to pass to `export_to_tfrecord`.
+    split: name of the split.
+    num_examples: number of examples of the split.
+    image_size: width and height of the images, for image problems.
+    seed: seed of the random images, labels and texts.
+
+  Raises:
+    ValueError: if the problem type is not supported.
+  """
+  if problem_type == types.IMAGE_CLF:
+    make_clf_inputs(path, split, num_examples, image_size, seed=seed)
+  elif problem_type == types.IMAGE_DET:
+    make_det_inputs(path, split, num_examples, image_size, seed=seed)
+  elif problem_type == types.TEXT_CLF:
+    make_text_inputs(path, split, num_examples, seed=seed)
+  else:
+    raise ValueError(f"Unsupported benchmark problem type: {problem_type}.")
+
+
+def peak_rss() -> dict[str, int]:
+  """Returns the peak resident set size in bytes of this process and of its waited children."""
+  # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+  scale = 1 if sys.platform == "darwin" else 1024
+  return {
+      "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+      "peak_children_rss_bytes": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+  }
+
+
+def run_in_process(target: Callable[..., None], *args: Any) -> Any:
+  """Runs target(*args, conn) in a new spawned process and returns the object it sends to conn.
+
+  Running each measurement in its own process isolates its peak RSS and TensorFlow state.
+
+  Raises:
+    RuntimeError: if the process exits without sending a result.
+  """
+  context = multiprocessing.get_context("spawn")
+  parent_conn, child_conn = context.Pipe(duplex=False)
+  process = context.Process(target=target, args=(*args, child_conn))
+  process.start()
+  child_conn.close()
+  try:
+    return parent_conn.recv()
+  except EOFError as err:
+    raise RuntimeError(f"Benchmark process exited with code {process.exitcode}.") from err
+  finally:
+    process.join()
+
+
+def dir_size(path: str, suffix: Optional[str] = None, recursive: bool = True) -> int:
+  """Returns the size in bytes of the files under path, only those ending with suffix if set.
+
+  Files of subdirectories are only counted if recursive is set.
+  """
+  size = 0
+  for dirpath, dirnames, filenames in os.walk(path):
+    if not recursive:
+      dirnames.clear()
+    for filename in filenames:
+      if suffix is None or filename.endswith(suffix):
+        try:
+          size += os.path.getsize(os.path.join(dirpath, filename))
+        except FileNotFoundError:
+          # Temporary files are removed while the directory is walked.
+          pass
+  return size
+
+
+class DiskUsageSampler:
+  """Samples the disk usage of a directory in a background thread, to record its peak.
+
+  Temporary files of the writer (spilled examples and shards being written) end with `.tmp`, their
+  peak size is recorded separately. Shards being written are under path, while spill files are
+  written to the parent directory of the output path, which is passed as temp_path. Only the top
+  level files of temp_path are sampled, it usually holds the inputs too.
+
+  Usage:
+    with DiskUsageSampler(path, temp_path=os.path.dirname(path)) as sampler:
+      ...
+    sampler.peak_bytes, sampler.peak_temp_bytes
+  """
+
+  def __init__(self, path: str, interval: float = 0.1, temp_path: Optional[str] = None):
+    self.path = path
+    self.temp_path = temp_path
+    self.interval = interval
+    self.peak_bytes = 0
+    self.peak_temp_bytes = 0
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._run, daemon=True)
+
+  def _sample(self) -> None:
+    self.peak_bytes = max(self.peak_bytes, dir_size(self.path))
+    temp_bytes = dir_size(self.path, ".tmp")
+    if self.temp_path is not None:
+      temp_bytes += dir_size(self.temp_path, ".tmp", recursive=False)
+    self.peak_temp_bytes = max(self.peak_temp_bytes, temp_bytes)
+
+  def _run(self) -> None:
+    while not self._stop.wait(self.interval):
+      self._sample()
+
+  def __enter__(self) -> "DiskUsageSampler":
+    self._thread.start()
+    return self
+
+  def __exit__(self, *exc_info: Any) -> None:
+    self._stop.set()
+    self._thread.join()
+    self._sample()
+
+
+def write_results(path: str, results: list[dict[str, Any]]) -> None:
+  """Writes benchmark results to path, one JSON object per line."""
+  Path(path).parent.mkdir(parents=True, exist_ok=True)
+  with open(path, "w") as f:
+    for result in results:
+      f.write(json.dumps(result, sort_keys=True) + "\n")
@@ -0,0 +1,218 @@
+# Copyright 2020 The OpenAGI Datum Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark of `datum.load(...).train_fn()` across a matrix of read and dataset configs.
+
+A tfrecord dataset is written once per problem type from generated inputs, then read once per
+setting of the matrix, each read in a fresh process so that its memory is measured independently.
+For each setting, the time to the first batch, the steady state examples/s (after warmup batches)
+and the peak RSS are written as one JSON object per line. Settings which fail to build or iterate,
+e.g. batching variable length features without padding, are reported with their error.
+
+Run from the repository root:
+  python -m benchmarks.reader_benchmark --problem_types image_det --num_examples 5000 \
+      --cycle_lengths -1,4,16 --num_parallel_calls 1,-1 --output /tmp/reader_benchmark.jsonl
+"""
+
+import itertools
+import os
+import shutil
+import tempfile
+import time
+from typing import Any
+
+import tensorflow as tf
+from absl import app, flags, logging
+
+from benchmarks import benchmark_utils
+from datum.configs import DatasetConfigs, TFRReadConfigs, TFRWriteConfigs
+from datum.export.export import export_to_tfrecord
+from datum.problem import types
+from datum.reader import load
+
+_SPLIT = 'train'
+_PADDING_NONE = 'none'
+_PADDING_TF = 'tf'
+_PADDING_DATUM = 'datum'
+# Feature whose length examples are bucketed by, and bucket boundaries, for each problem type.
+_BUCKET_FEATURES = {
+    types.IMAGE_DET: ('xmin', [2, 4, 6]),
+    types.TEXT_CLF: ('text', [600, 700, 800]),
+}
+
+flags.DEFINE_list('problem_types', ['image_det', 'text_clf'],
+                  'Problem types of the generated datasets.')
+flags.DEFINE_integer('num_examples', 2000, 'Number of examples of each generated dataset.')
+flags.DEFINE_integer('image_size', 256, 'Width and height of the generated images.')
+flags.DEFINE_integer('num_shards', 16, 'Number of tfrecord shards of each generated dataset.')
+flags.DEFINE_integer('batch_size', 32, 'Batch size of the train dataset.')
+flags.DEFINE_list('cycle_lengths', ['-1', '4'], 'Interleave cycle lengths to sweep, -1 autotunes.')
+flags.DEFINE_list('block_lengths', ['1', '16'], 'Interleave block lengths to sweep.')
+flags.DEFINE_list('num_parallel_calls', ['1', '-1'],
+                  'Batch num_parallel_calls to sweep, -1 autotunes.')
+flags.DEFINE_list('paddings', [_PADDING_DATUM],
+                  f'Padding modes to sweep, {_PADDING_NONE}, {_PADDING_TF} or {_PADDING_DATUM}.')
+flags.DEFINE_list('bucketing', ['false'], 'Whether to batch by bucketing, true or false.')
+flags.DEFINE_list('cache', ['false', 'true'], 'Whether to cache the dataset in memory.')
+flags.DEFINE_list('echoing', ['0'], 'Batch echoing factors to sweep, 0 disables echoing.')
+flags.DEFINE_list('buffer_sizes', ['100', '1000'], 'Shuffle buffer sizes to sweep.')
+flags.DEFINE_integer('warmup_batches', 10, 'Number of batches read before measuring.')
+flags.DEFINE_integer('num_batches', 100, 'Number of batches measured.')
+flags.DEFINE_string(
+    'work_dir', None, 'Directory of the generated datasets, defaults to a temporary directory '
+    'removed at the end of the benchmark.')
+flags.DEFINE_string('output', 'reader_benchmark.jsonl', 'Path of the JSON lines results file.')
+FLAGS = flags.FLAGS
+
+
+def _to_bool(value: str) -> bool:
+  return value.lower() in ('true', '1', 'yes')
+
+
+def write_dataset(problem_type: str, path: str, num_examples: int, image_size: int,
+                  num_shards: int) -> None:
+  """Writes a tfrecord dataset of num_examples generated examples in num_shards shards."""
+  input_path = f'{path}_inputs'
+  benchmark_utils.make_inputs(problem_type, input_path, _SPLIT, num_examples, image_size)
+  write_configs = TFRWriteConfigs()
+  write_configs.splits = {_SPLIT: {'num_examples': num_examples}}
+  write_configs.min_shards = num_shards
+  if problem_type in benchmark_utils.SPARSE_FEATURES:
+    write_configs.sparse_features = benchmark_utils.SPARSE_FEATURES[problem_type]
+  export_to_tfrecord(input_path, path, problem_type, write_configs)
+  shutil.rmtree(input_path)
+
+
+def _bucket_fn(feature: str) -> Any:
+  """Returns a function computing the length of feature, in characters for scalar strings."""
+
+  def bucket_fn(example: dict[str, tf.Tensor]) -> tf.Tensor:
+    value = example[feature]
+    if value.dtype == tf.string and value.shape.rank == 0:
+      return tf.strings.length(value)
+    return tf.shape(value)[0]
+
+  return bucket_fn
+
+
+def get_dataset_configs(config: dict[str, Any]) -> DatasetConfigs:
+  """Returns the dataset configs of a setting of the matrix."""
+  read_config = TFRReadConfigs()
+  read_config.interleave_cycle_length = config['cycle_length']
+  read_config.interleave_block_length = config['block_length']
+  dataset_configs = DatasetConfigs()
+  dataset_configs.read_config = read_config
+  dataset_configs.batch_size_train = config['batch_size']
+  dataset_configs.num_parallel_calls = config['num_parallel_calls']
+  dataset_configs.buffer_size = config['buffer_size']
+  dataset_configs.cache = config['cache']
+  dataset_configs.use_tf_padding = config['padding'] == _PADDING_TF
+  dataset_configs.use_datum_padding = config['padding'] == _PADDING_DATUM
+  if config['echoing']:
+    dataset_configs.echoing = config['echoing']
+  if config['bucketing']:
+    feature, boundaries = _BUCKET_FEATURES[config['problem_type']]
+    dataset_configs.bucket_fn = _bucket_fn(feature)
+    dataset_configs.bucket_op.bucket_boundaries = boundaries
+    dataset_configs.bucket_op.bucket_batch_sizes = [config['batch_size']] * (len(boundaries) + 1)
+  return dataset_configs
+
+
+def _run_read(path: str, config: dict[str, Any], warmup_batches: int, num_batches: int,
+              conn: Any) -> None:
+  """Reads the train dataset with config and sends the measurements to conn."""
+  baseline_rss = benchmark_utils.peak_rss()['peak_rss_bytes']
+  try:
+    start = time.perf_counter()
+    iterator = iter(load(path, get_dataset_configs(config)).train_fn(_SPLIT, repeat=-1))
+    next(iterator)
+    time_to_first_batch = time.perf_counter() - start
+    for _ in range(warmup_batches):
+      next(iterator)
+    examples = 0
+    start = time.perf_counter()
+    for _ in range(num_batches):
+      batch = next(iterator)
+      examples += int(tf.shape(next(iter(batch.values())))[0])
+    seconds = time.perf_counter() - start
+  except (tf.errors.OpError, ValueError, TypeError) as err:
+    conn.send({'error': f'{type(err).__name__}: {err}'})
+    return
+  peak_rss = benchmark_utils.peak_rss()['peak_rss_bytes']
+  conn.send({
+      'time_to_first_batch_seconds': time_to_first_batch,
+      'seconds': seconds,
+      'examples': examples,
+      'examples_per_second': examples / seconds,
+      'batches_per_second': num_batches / seconds,
+      'peak_rss_bytes': peak_rss,
+      'rss_increase_bytes': peak_rss - baseline_rss,
+  })
+
+
+def main(_: Any) -> None:
+  work_dir = FLAGS.work_dir or tempfile.mkdtemp(prefix='datum_reader_benchmark_')
+  matrix = list(
+      itertools.product([int(value) for value in FLAGS.cycle_lengths],
+                        [int(value) for value in FLAGS.block_lengths],
+                        [int(value) for value in FLAGS.num_parallel_calls], FLAGS.paddings,
+                        [_to_bool(value)
+                         for value in FLAGS.bucketing], [_to_bool(value) for value in FLAGS.cache],
+                        [int(value)
+                         for value in FLAGS.echoing], [int(value) for value in FLAGS.buffer_sizes]))
+  results = []
+  try:
+    for problem_type in FLAGS.problem_types:
+      path = os.path.join(work_dir, f'{problem_type}_tfrecord')
+      if not os.path.exists(path):
+        logging.info(f'Writing {FLAGS.num_examples} {problem_type} examples to {path}.')
+        write_dataset(problem_type, path, FLAGS.num_examples, FLAGS.image_size, FLAGS.num_shards)
+      for (cycle_length, block_length, num_parallel_calls, padding, bucketing, cache, echoing,
+           buffer_size) in matrix:
+        if bucketing and problem_type not in _BUCKET_FEATURES:
+          continue
+        config: dict[str, Any] = {
+            'problem_type': problem_type,
+            'num_examples': FLAGS.num_examples,
+            'image_size': FLAGS.image_size,
+            'num_shards': FLAGS.num_shards,
+            'batch_size': FLAGS.batch_size,
+            'cycle_length': cycle_length,
+            'block_length': block_length,
+            'num_parallel_calls': num_parallel_calls,
+            'padding': padding,
+            'bucketing': bucketing,
+            'cache': cache,
+            'echoing': echoing,
+            'buffer_size': buffer_size,
+        }
+        measurements = benchmark_utils.run_in_process(_run_read, path, config, FLAGS.warmup_batches,
+                                                      FLAGS.num_batches)
+        result = {**config, **measurements}
+        if 'error' in result:
+          logging.warning(f'{config} failed: {result["error"].splitlines()[0]}')
+        else:
+          logging.info(f'{config}: first batch in {result["time_to_first_batch_seconds"]:.2f}s, '
+                       f'{result["examples_per_second"]:.1f} examples/s, peak rss '
+                       f'{result["peak_rss_bytes"] >> 20}MB.')
+        results.append(result)
+  finally:
+    if not FLAGS.work_dir:
+      shutil.rmtree(work_dir, ignore_errors=True)
+  benchmark_utils.write_results(FLAGS.output, results)
+  logging.info(f'Wrote {len(results)} results to {FLAGS.output}.')
+
+
+if __name__ == '__main__':
+  logging.set_verbosity(logging.INFO)
+  app.run(main)
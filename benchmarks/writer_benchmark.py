@@ -0,0 +1,168 @@
+# Copyright 2020 The OpenAGI Datum Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""End-to-end benchmark of `export_to_tfrecord`, across worker counts and spill settings.
+
+Input datasets are generated once per problem type, then exported once per configuration of the
+sweep, each export in a fresh process so that its peak RSS is measured independently. Results are
+written one JSON object per configuration, with examples/s, MB/s, peak RSS, peak temporary disk
+usage, the writer stage stats and the speedup over the smallest number of workers.
+
+Run from the repository root:
+  python -m benchmarks.writer_benchmark --problem_types image_clf,text_clf --num_examples 5000 \
+      --num_workers 1,2,4 --memory_budgets 0,16777216 --output /tmp/writer_benchmark.jsonl
+"""
+
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Any
+
+from absl import app, flags, logging
+
+from benchmarks import benchmark_utils
+from datum.configs import TFRWriteConfigs
+from datum.export.export import export_to_tfrecord
+from datum.utils import info_utils
+
+_SPLIT = 'train'
+
+flags.DEFINE_list('problem_types', ['image_clf', 'image_det', 'text_clf'],
+                  'Problem types of the generated input datasets.')
+flags.DEFINE_integer('num_examples', 1000, 'Number of examples of each generated dataset.')
+flags.DEFINE_integer('image_size', 256, 'Width and height of the generated images.')
+flags.DEFINE_list('num_workers', ['1', '2', '4'], 'Numbers of serialization processes to sweep.')
+flags.DEFINE_list('flush_workers', ['1'], 'Numbers of shard writing processes to sweep.')
+flags.DEFINE_list('spill_strategies', ['buckets'], 'Spill strategies to sweep, buckets or runs.')
+flags.DEFINE_list(
+    'memory_budgets', ['0'],
+    'Memory budgets in bytes to sweep, 0 for the writer default, small budgets '
+    'force examples to be spilled to disk.')
+flags.DEFINE_list('spill_compressions', ['none'], 'Spill compressions to sweep, none, zlib or lzma.')
+flags.DEFINE_integer('repeats', 1, 'Number of runs of each configuration.')
+flags.DEFINE_string(
+    'work_dir', None,
+    'Directory of the input and output datasets, defaults to a temporary directory '
+    'removed at the end of the benchmark.')
+flags.DEFINE_float('sample_interval', 0.1, 'Interval in seconds between disk usage samples.')
+flags.DEFINE_string('output', 'writer_benchmark.jsonl', 'Path of the JSON lines results file.')
+FLAGS = flags.FLAGS
+
+
+def _run_export(problem_type: str, input_path: str, output_path: str, config: dict[str, Any],
+                sample_interval: float, conn: Any) -> None:
+  """Exports the input dataset with config and sends the measurements to conn."""
+  write_configs = TFRWriteConfigs()
+  write_configs.splits = {_SPLIT: {'num_examples': config['num_examples']}}
+  write_configs.num_workers = config['num_workers']
+  write_configs.flush_workers = config['flush_workers']
+  write_configs.spill_strategy = config['spill_strategy']
+  if problem_type in benchmark_utils.SPARSE_FEATURES:
+    write_configs.sparse_features = benchmark_utils.SPARSE_FEATURES[problem_type]
+  if config['memory_budget']:
+    write_configs.memory_budget = config['memory_budget']
+  if config['spill_compression']:
+    write_configs.spill_compression = config['spill_compression']
+  os.makedirs(output_path)
+  # The writer spills examples to the parent directory of the output path.
+  with benchmark_utils.DiskUsageSampler(output_path,
+                                        sample_interval,
+                                        temp_path=os.path.dirname(output_path)) as sampler:
+    start = time.perf_counter()
+    export_to_tfrecord(input_path, output_path, problem_type, write_configs)
+    seconds = time.perf_counter() - start
+  with open(os.path.join(output_path, info_utils.WRITE_STATS_FILENAME)) as f:
+    write_stats = json.load(f)[_SPLIT]
+  output_bytes = benchmark_utils.dir_size(output_path)
+  conn.send({
+      'seconds': seconds,
+      'examples': write_stats['examples'],
+      'examples_per_second': write_stats['examples'] / seconds,
+      'output_bytes': output_bytes,
+      'mb_per_second': output_bytes / seconds / (1 << 20),
+      'peak_disk_bytes': sampler.peak_bytes,
+      'peak_temp_disk_bytes': sampler.peak_temp_bytes,
+      'spill_bytes': write_stats['spill_bytes'],
+      'peak_buffer_size': write_stats['peak_buffer_size'],
+      'stages': write_stats['stages'],
+      **benchmark_utils.peak_rss(),
+  })
+
+
+def add_speedups(results: list[dict[str, Any]]) -> None:
+  """Sets the speedup of each result over the result with the fewest workers of its group."""
+  groups: dict[tuple, list[dict[str, Any]]] = {}
+  for result in results:
+    key = tuple(result[name] for name in ('problem_type', 'flush_workers', 'spill_strategy',
+                                          'memory_budget', 'spill_compression', 'repeat'))
+    groups.setdefault(key, []).append(result)
+  for group in groups.values():
+    baseline = min(group, key=lambda result: result['num_workers'])
+    for result in group:
+      result['speedup'] = result['examples_per_second'] / baseline['examples_per_second']
+
+
+def main(_: Any) -> None:
+  work_dir = FLAGS.work_dir or tempfile.mkdtemp(prefix='datum_writer_benchmark_')
+  num_workers = [int(value) for value in FLAGS.num_workers]
+  flush_workers = [int(value) for value in FLAGS.flush_workers]
+  memory_budgets = [int(value) for value in FLAGS.memory_budgets]
+  sweep = list(
+      itertools.product(num_workers, flush_workers, FLAGS.spill_strategies, memory_budgets,
+                        FLAGS.spill_compressions, range(FLAGS.repeats)))
+  results = []
+  try:
+    for problem_type in FLAGS.problem_types:
+      input_path = os.path.join(work_dir, f'{problem_type}_inputs')
+      if not os.path.exists(input_path):
+        logging.info(f'Generating {FLAGS.num_examples} {problem_type} examples in {input_path}.')
+        benchmark_utils.make_inputs(problem_type, input_path, _SPLIT, FLAGS.num_examples,
+                                    FLAGS.image_size)
+      for workers, flushers, spill_strategy, memory_budget, spill_compression, repeat in sweep:
+        config: dict[str, Any] = {
+            'problem_type': problem_type,
+            'num_examples': FLAGS.num_examples,
+            'image_size': FLAGS.image_size,
+            'num_workers': workers,
+            'flush_workers': flushers,
+            'spill_strategy': spill_strategy,
+            'memory_budget': memory_budget,
+            'spill_compression': None if spill_compression == 'none' else spill_compression,
+            'repeat': repeat,
+        }
+        output_path = os.path.join(work_dir, f'{problem_type}_output')
+        shutil.rmtree(output_path, ignore_errors=True)
+        measurements = benchmark_utils.run_in_process(_run_export, problem_type, input_path,
+                                                      output_path, config, FLAGS.sample_interval)
+        result = {**config, **measurements}
+        logging.info(f'{problem_type} num_workers={workers} flush_workers={flushers} '
+                     f'{spill_strategy} memory_budget={memory_budget} {spill_compression}: '
+                     f'{result["examples_per_second"]:.1f} examples/s, '
+                     f'{result["mb_per_second"]:.1f} MB/s, peak rss '
+                     f'{result["peak_rss_bytes"] >> 20}MB, peak temp disk '
+                     f'{result["peak_temp_disk_bytes"] >> 20}MB.')
+        results.append(result)
+  finally:
+    if not FLAGS.work_dir:
+      shutil.rmtree(work_dir, ignore_errors=True)
+  add_speedups(results)
+  benchmark_utils.write_results(FLAGS.output, results)
+  logging.info(f'Wrote {len(results)} results to {FLAGS.output}.')
+
+
+if __name__ == '__main__':
+  logging.set_verbosity(logging.INFO)
+  app.run(main)
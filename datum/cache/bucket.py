@@ -16,20 +16,31 @@
 # Lint as: python3
 """To shuffle records (stable)."""
 
+import array
+import collections
+import heapq
+import lzma
 import math
+import mmap
+import operator
 import os
 import struct
+import sys
+import time
 import uuid
-from collections.abc import Generator
-from typing import Optional
+import zlib
+from collections.abc import Generator, Iterable, Sequence
+from typing import Any, Optional
 
+import numpy as np
 import tensorflow.compat.v2 as tf
+from absl import logging
 
-from datum.utils.hashing import Hasher
+from datum.utils.hashing import HASH_MD5, Hasher
 
-# Approximately how much data to store in memory before writing to disk.
-# If the amount of data to shuffle is < MAX_MEM_BUFFER_SIZE, no intermediary
-# data is written to disk.
+# Default memory budget: how much memory the in-memory buffer can use before
+# data is written to disk. If the buffer holding the data to shuffle is
+# < MAX_MEM_BUFFER_SIZE, no intermediary data is written to disk.
 MAX_MEM_BUFFER_SIZE = 1000 << 20 # 1GB
 
 # If data to shuffle is too large for memory. Records are split among 1K
@@ -38,14 +49,72 @@ MAX_MEM_BUFFER_SIZE = 1000 << 20 # 1GB
 # be about 1GB. Larger datasets will likely be handled by Beam.
 #
 # Increasing the number of buckets would decrease the size of each bucket.
-# Current implementation relies on having one open file per bucket.
-# Windows has a limit of ~2K open files per process (Linux ~32K); so increasing
-# the number of buckets might warrant some changes in implementation.
+# Bucket files are created on first write only, and written through a pool of
+# at most MAX_OPEN_FILES open files, so the number of buckets is not limited by
+# the number of open files per process.
 BUCKETS_NUMBER = 1000 # Number of buckets to pre-sort and hold generated data.
 
+# When the expected number of examples of the split is known, the number of
+# buckets is instead derived from the estimated size of the split, so that each
+# bucket is about half the memory budget, within these bounds.
+MIN_BUCKETS_NUMBER = 16
+MAX_BUCKETS_NUMBER = 100000
+
+MAX_OPEN_FILES = 64 # Maximum number of bucket files open for writing at once.
+WRITE_BUFFER_SIZE = 1 << 20 # 1MB, write buffer of each open bucket file.
+READ_BUFFER_SIZE = 1 << 20 # 1MB, read buffer of spill files read sequentially.
+
+# Strategies to write data to disk once it does not fit in memory anymore:
+#  - SPILL_BUCKETS: records are hash-partitioned among buckets, each bucket is
+#    then sorted in memory when read.
+#  - SPILL_RUNS: the in-memory buffer is sorted and written as a sorted run each
+#    time it is full, sorted runs are then merged when read. Memory used to read
+#    the data back does not depend on the size of the split: at most
+#    MAX_MERGE_FAN_IN runs are merged at once, when there are more runs, groups of
+#    the smallest runs are first merged into intermediate runs.
+SPILL_BUCKETS = 'buckets'
+SPILL_RUNS = 'runs'
+MAX_MERGE_FAN_IN = 64 # Maximum number of files read at once by a merge of sorted runs.
+
+# Optional compression of spill files (buckets and sorted runs). The write
+# buffer of each file is compressed as a block, prefixed with the compressed and
+# raw sizes of the block (8 bytes each), so records are compressed in groups of
+# about WRITE_BUFFER_SIZE bytes.
+SPILL_COMPRESSION_ZLIB = 'zlib'
+SPILL_COMPRESSION_LZMA = 'lzma'
+_BLOCK_HEADER = struct.Struct('=QQ')
+
+# Buckets larger than the memory budget on disk are not sorted in memory as a
+# whole, they are re-partitioned among SUB_BUCKETS_NUMBER sub-buckets, sorted
+# recursively. This bounds the memory used to sort a bucket when the data is
+# skewed.
+SUB_BUCKETS_NUMBER = 16
+
+# Early detection of duplicated keys, at `Shuffler.add` time: hkeys are checked
+# against a scalable Bloom filter, a sequence of Bloom filters whose capacities
+# double, starting with the expected number of records. The first filter has
+# BLOOM_FILTER_BITS_PER_RECORD bits per record (less than 0.1% of false
+# positives), each following one has 2 more bits and one more hash function per
+# record, so the false positive rate stays bounded when the number of records
+# exceeds the expected one. Suspected duplicates are then confirmed by looking
+# hkeys up in HKEYS_PARTITIONS_NUMBER partitions, by leading byte, of sorted
+# segment files on disk. Segments of similar sizes are merged, so a partition
+# has a logarithmic number of segments, and only the first hkey of each block of
+# HKEYS_BLOCK_SIZE hkeys of a segment is held in memory: a lookup reads a single
+# block per segment.
+BLOOM_FILTER_BITS_PER_RECORD = 16
+BLOOM_FILTER_HASHES_NUMBER = 7
+# Expected number of records when the number of records of the split is unknown.
+BLOOM_FILTER_DEFAULT_CAPACITY = 1 << 22
+HKEYS_PARTITIONS_NUMBER = 256
+HKEYS_WRITE_BUFFER_SIZE = 16 << 10 # 16KB, write buffer of each partition.
+HKEYS_BLOCK_SIZE = 256 # Number of hkeys of a segment block, 4KB.
+
 HKEY_SIZE = 128 # Hash of keys is 128 bits (md5).
 HKEY_SIZE_BYTES = HKEY_SIZE // 8
 
+_MAX_INT64 = 0xFFFFFFFFFFFFFFFF
+
 
 class DuplicatedKeysError(Exception):
 
@@ -57,8 +126,7 @@ class DuplicatedKeysError(Exception):
 
 def _hkey_to_bytes(hkey: int) -> bytes:
   """Converts 128 bits integer hkey to binary representation."""
-  max_int64 = 0xFFFFFFFFFFFFFFFF
-  return struct.pack('=QQ', (hkey >> 64) & max_int64, hkey & max_int64)
+  return struct.pack('=QQ', (hkey >> 64) & _MAX_INT64, hkey & _MAX_INT64)
 
 
 def _read_hkey(buff: bytes) -> int:
@@ -74,6 +142,352 @@ def get_bucket_number(hkey: int, shards_number: int) -> int:
   return math.trunc((hkey * shards_number) >> HKEY_SIZE)
 
 
+def get_bucket_range(bucket_number: int, shards_number: int) -> tuple[int, int]:
+  """Returns the range [start, end) of hashed keys (int) of given bucket (shard) number."""
+  # Bucket b holds keys such that b * HKEYS_NUMBER <= key * shards_number < (b + 1) * HKEYS_NUMBER.
+  return (-(-(bucket_number << HKEY_SIZE) // shards_number),
+          -(-((bucket_number + 1) << HKEY_SIZE) // shards_number))
+
+
+def _is_local_path(path: str) -> bool:
+  """Returns whether path is on the local file system, which can be memory-mapped."""
+  return '://' not in path
+
+
+class SpillCodec:
+  """Block compression of spill files, with `zlib` or `lzma`.
+
+  Sizes and time spent compressing and decompressing blocks are recorded, to report the compression
+  ratio and the throughput of the codec.
+  """
+
+  def __init__(self, name: str, level: Optional[int] = None):
+    """Initialize a SpillCodec instance.
+
+    Args:
+      name (string): one of `SPILL_COMPRESSION_ZLIB` or `SPILL_COMPRESSION_LZMA`.
+      level (int): compression level, 0-9, defaults to the default level of the codec.
+    """
+    if name == SPILL_COMPRESSION_ZLIB:
+      self._compress = lambda data: zlib.compress(data, -1 if level is None else level)
+      self._decompress = zlib.decompress
+    elif name == SPILL_COMPRESSION_LZMA:
+      self._compress = lambda data: lzma.compress(data, preset=level)
+      self._decompress = lzma.decompress
+    else:
+      raise ValueError(f'Unsupported spill compression: {name}.')
+    self.name = name
+    self.level = level
+    self.raw_bytes_written = 0
+    self.compressed_bytes_written = 0
+    self.compress_seconds = 0.0
+    self.raw_bytes_read = 0
+    self.decompress_seconds = 0.0
+
+  def encode_block(self, data: bytes) -> bytes:
+    """Returns the compressed block of data, with its header."""
+    start = time.perf_counter()
+    compressed = self._compress(data)
+    self.compress_seconds += time.perf_counter() - start
+    self.raw_bytes_written += len(data)
+    self.compressed_bytes_written += len(compressed)
+    return _BLOCK_HEADER.pack(len(compressed), len(data)) + compressed
+
+  def iter_blocks(self, fobj: tf.io.gfile.GFile) -> Generator[bytes, None, None]:
+    """Yields the decompressed blocks of a spill file."""
+    while True:
+      header = fobj.read(_BLOCK_HEADER.size)
+      if not header:
+        return
+      compressed_size, _ = _BLOCK_HEADER.unpack(header)
+      compressed = fobj.read(compressed_size)
+      start = time.perf_counter()
+      data = self._decompress(compressed)
+      self.decompress_seconds += time.perf_counter() - start
+      self.raw_bytes_read += len(data)
+      yield data
+
+  def raw_size(self, path: str) -> int:
+    """Returns the decompressed size of a spill file, only reading its blocks headers."""
+    size = 0
+    with tf.io.gfile.GFile(path, 'rb') as fobj:
+      while True:
+        header = fobj.read(_BLOCK_HEADER.size)
+        if not header:
+          return size
+        compressed_size, raw_size = _BLOCK_HEADER.unpack(header)
+        fobj.seek(compressed_size, whence=1)
+        size += raw_size
+
+  def log_write_stats(self) -> None:
+    """Logs the compression ratio and throughput of the blocks written so far."""
+    if self.raw_bytes_written:
+      logging.info(f'Spill files {self.name} compression: {self.raw_bytes_written} bytes written '
+                   f'as {self.compressed_bytes_written} bytes (ratio '
+                   f'{self.raw_bytes_written / max(self.compressed_bytes_written, 1):.2f}), '
+                   f'{_throughput(self.raw_bytes_written, self.compress_seconds)}.')
+
+  def log_read_stats(self) -> None:
+    """Logs the throughput of the blocks read so far."""
+    if self.raw_bytes_read:
+      logging.info(f'Spill files {self.name} decompression: {self.raw_bytes_read} bytes read, '
+                   f'{_throughput(self.raw_bytes_read, self.decompress_seconds)}.')
+
+
+def _throughput(num_bytes: int, seconds: float) -> str:
+  return f'{num_bytes / (1 << 20) / max(seconds, 1e-9):.1f} MB/s'
+
+
+def _truncate_file(path: str, size: int) -> None:
+  """Truncates the file at path to size bytes, removes it if size is 0."""
+  if not tf.io.gfile.exists(path):
+    return
+  if not size:
+    tf.io.gfile.remove(path)
+  elif _is_local_path(path):
+    os.truncate(path, size)
+  else:
+    with tf.io.gfile.GFile(path, 'rb') as fobj:
+      data = fobj.read(size)
+    with tf.io.gfile.GFile(path, 'wb') as fobj:
+      fobj.write(data)
+
+
+def _map_file(path: str) -> memoryview:
+  """Returns a memoryview of the local, non empty, file at path, memory-mapped."""
+  with open(path, 'rb') as fobj:
+    # The mapping stays valid once the file is closed (and even deleted), until the memoryview and
+    # all its slices have been released.
+    return memoryview(mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def _read_spill_file(path: str, codec: Optional[SpillCodec]) -> memoryview:
+  """Returns the (decompressed) content of a non empty spill file."""
+  if codec:
+    with tf.io.gfile.GFile(path, 'rb') as fobj:
+      return memoryview(b''.join(codec.iter_blocks(fobj)))
+  if _is_local_path(path):
+    return _map_file(path)
+  with tf.io.gfile.GFile(path, 'rb') as fobj:
+    return memoryview(fobj.read())
+
+
+def _parse_records_table(
+    view: memoryview) -> tuple[memoryview, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+  """Parses the records table of the content of a bucket file.
+
+  When all the records have the same length, e.g. examples of fixed shape features, the headers are
+  at a fixed stride and are decoded at once by numpy. Otherwise the offset of each record header
+  depends on the previous records, headers are walked and decoded with `struct.unpack_from`. In both
+  cases the table is held in compact arrays of 8 bytes per value.
+
+  Args:
+    view: content of the bucket file, for example memory-mapped.
+
+  Returns:
+    view, and arrays with the high and low 64 bits halves of the hkeys, the offsets and the lengths
+    of the data of the records.
+  """
+  header_size = HKEY_SIZE_BYTES + 8
+  unpack_from = struct.Struct('=QQQ').unpack_from
+  size = len(view)
+  if size >= header_size:
+    length = unpack_from(view)[2]
+    stride = header_size + length
+    if size % stride == 0:
+      count = size // stride
+      headers = np.ndarray((count, 3), dtype=np.uint64, buffer=view, strides=(stride, 8))
+      # Each record starts where the previous one ends, so the stride is right if all the
+      # lengths read at that stride are the same.
+      if (headers[:, 2] == length).all():
+        return (view, headers[:, 0].copy(), headers[:, 1].copy(),
+                np.arange(count, dtype=np.int64) * stride + header_size,
+                np.full(count, length, dtype=np.int64))
+  hkeys_hi, hkeys_lo = array.array('Q'), array.array('Q')
+  offsets, lengths = array.array('q'), array.array('q')
+  offset = 0
+  while offset < size:
+    hi, lo, length = unpack_from(view, offset)
+    offset += header_size
+    hkeys_hi.append(hi)
+    hkeys_lo.append(lo)
+    offsets.append(offset)
+    lengths.append(length)
+    offset += length
+  return (view, np.frombuffer(hkeys_hi, dtype=np.uint64), np.frombuffer(hkeys_lo, dtype=np.uint64),
+          np.frombuffer(offsets, dtype=np.int64), np.frombuffer(lengths, dtype=np.int64))
+
+
+def _iter_records_table(view: memoryview, hkeys_hi: np.ndarray, hkeys_lo: np.ndarray,
+                        offsets: np.ndarray,
+                        lengths: np.ndarray) -> Generator[tuple[int, memoryview], None, None]:
+  """Yields (hkey, data) tuples of a records table, data being slices of view (no copy)."""
+  for hi, lo, offset, length in zip(hkeys_hi.tolist(), hkeys_lo.tolist(), offsets.tolist(),
+                                    lengths.tolist()):
+    yield (hi << 64) | lo, view[offset:offset + length]
+
+
+def _iter_blocks_records(blocks: Iterable[bytes]) -> Generator[tuple[int, memoryview], None, None]:
+  """Yields the (hkey, data) tuples of decompressed blocks, records can span several blocks.
+
+  Records held in a block are yielded as slices of the block. A record spanning several blocks is
+  appended to its own buffer as blocks are read, so large records are copied once, not once per
+  block.
+  """
+  header_size = HKEY_SIZE_BYTES + 8
+  unpack_from = struct.Struct('=QQQ').unpack_from
+  # Header, then data, of the record spanning the previous blocks, and its full size once known.
+  pending = bytearray()
+  pending_size = 0
+  for block in blocks:
+    view = memoryview(block)
+    offset = 0
+    if pending:
+      if len(pending) < header_size:
+        offset = header_size - len(pending)
+        pending += view[:offset]
+        if len(pending) < header_size:
+          continue
+        pending_size = header_size + unpack_from(pending)[2]
+      start, offset = offset, min(offset + pending_size - len(pending), len(view))
+      pending += view[start:offset]
+      if len(pending) < pending_size:
+        continue
+      hi, lo, _ = unpack_from(pending)
+      yield (hi << 64) | lo, memoryview(pending)[header_size:]
+      # The yielded slice keeps the buffer alive, a new one is used for the next record.
+      pending = bytearray()
+    while offset + header_size <= len(view):
+      hi, lo, size = unpack_from(view, offset)
+      end = offset + header_size + size
+      if end > len(view):
+        break
+      yield (hi << 64) | lo, view[offset + header_size:end]
+      offset = end
+    if offset < len(view):
+      pending = bytearray(view[offset:])
+      if len(pending) >= header_size:
+        pending_size = header_size + unpack_from(pending)[2]
+
+
+def _iter_chunks(fobj: tf.io.gfile.GFile) -> Generator[bytes, None, None]:
+  """Yields the content of fobj, in chunks of READ_BUFFER_SIZE bytes."""
+  while True:
+    chunk = fobj.read(READ_BUFFER_SIZE)
+    if not chunk:
+      return
+    yield chunk
+
+
+def read_bucket_file(path: str,
+                     codec: Optional[SpillCodec] = None) -> Generator[tuple[int, bytes], None, None]:
+  """Yields (hkey, data) tuples stored in the bucket file at path.
+
+  The file is read sequentially, through a read buffer of READ_BUFFER_SIZE bytes or one decompressed
+  block at a time, data is yielded as `memoryview` slices of the buffer. Memory usage does not
+  depend on the size of the file, so many files can be read at once, e.g. sorted runs being merged.
+
+  Args:
+    path: path of the bucket file.
+    codec: codec the bucket file is compressed with, if any.
+  """
+  if not tf.io.gfile.exists(path):
+    # In case bucket was created but nothing was ever added.
+    # This is likely to happen if the number of buckets is large compared to
+    # the number of generated examples.
+    return
+  with tf.io.gfile.GFile(path, 'rb') as fobj:
+    yield from _iter_blocks_records(codec.iter_blocks(fobj) if codec else _iter_chunks(fobj))
+
+
+class _FilePool:
+  """Pool of files open for writing, with a write buffer per file.
+
+  At most `max_open_files` files are open at any time, the least recently
+  written file is flushed and closed when another one has to be opened. A file
+  is created (truncated) the first time it is opened by the pool, it is then
+  reopened in append mode.
+
+  If a codec is given, each write buffer is compressed as a block when flushed.
+  """
+
+  def __init__(self,
+               max_open_files: int = MAX_OPEN_FILES,
+               buffer_size: int = WRITE_BUFFER_SIZE,
+               codec: Optional[SpillCodec] = None):
+    """Initialize a _FilePool instance.
+
+    Args:
+      max_open_files (int): maximum number of files open at once.
+      buffer_size (int): size in bytes of the write buffer of each open file.
+      codec (SpillCodec): codec to compress the files with, if any.
+    """
+    self._max_open_files = max_open_files
+    self._buffer_size = buffer_size
+    self._codec = codec
+    self._files: collections.OrderedDict[str, tuple[tf.io.gfile.GFile,
+                                                    bytearray]] = (collections.OrderedDict())
+    self._created: set[str] = set()
+    self._dirs: set[str] = set()
+
+  def write(self, path: str, data: bytes) -> None:
+    """Writes data to the file at path."""
+    if path in self._files:
+      self._files.move_to_end(path)
+      fobj, buffer = self._files[path]
+    else:
+      fobj, buffer = self._open(path)
+    if len(buffer) + len(data) > self._buffer_size:
+      self._write(fobj, buffer)
+      buffer.clear()
+    if len(data) >= self._buffer_size:
+      self._write(fobj, data)
+    else:
+      buffer += data
+
+  @property
+  def codec(self) -> Optional[SpillCodec]:
+    return self._codec
+
+  def _write(self, fobj: tf.io.gfile.GFile, data: bytes) -> None:
+    fobj.write(self._codec.encode_block(bytes(data)) if self._codec else bytes(data))
+
+  def _open(self, path: str) -> tuple[tf.io.gfile.GFile, bytearray]:
+    if len(self._files) >= self._max_open_files:
+      self._close(*self._files.popitem(last=False)[1])
+    if path in self._created:
+      mode = 'ab'
+    else:
+      dirname = os.path.dirname(path)
+      if dirname not in self._dirs:
+        tf.io.gfile.makedirs(dirname)
+        self._dirs.add(dirname)
+      self._created.add(path)
+      mode = 'wb'
+    entry = (tf.io.gfile.GFile(path, mode=mode), bytearray())
+    self._files[path] = entry
+    return entry
+
+  def _close(self, fobj: tf.io.gfile.GFile, buffer: bytearray) -> None:
+    if buffer:
+      self._write(fobj, buffer)
+    fobj.close()
+
+  def close(self, path: str) -> None:
+    """Flushes and closes the file at path, if open."""
+    if path in self._files:
+      self._close(*self._files.pop(path))
+
+  def close_all(self) -> None:
+    """Flushes and closes all open files."""
+    while self._files:
+      self._close(*self._files.popitem(last=False)[1])
+
+  def add_existing(self, path: str) -> None:
+    """Registers a file written before this pool was created, it is opened in append mode."""
+    self._created.add(path)
+
+
 class _Bucket:
   """Holds (key, binary value) tuples to disk, fast.
 
@@ -84,8 +498,11 @@ class _Bucket:
     2. Buckets are being written one at a time (or on different machines/jobs).
     Before writing the data, it is sorted in memory. Many bucket are read in
     parallel.
-    This is not currently used, but could be if we decide do parallelize the
-    writing of final sharded tfrecord files.
+    This is how buckets are read when the final sharded tfrecord files are
+    written in parallel, see `Shuffler.bucket_files`.
+
+  The bucket file is only created when the first (key, data) is added, and is
+  written through a `_FilePool`, which can be shared by many buckets.
 
   File format (assuming a key of 16 bytes):
     key1 (16 bytes) | size1 (8 bytes) | data1 (size1 bytes) |
@@ -93,20 +510,18 @@ class _Bucket:
     ...
   """
 
-  def __init__(self, path: str):
+  def __init__(self, path: str, file_pool: Optional[_FilePool] = None):
     """Initialize a _Bucket instance.
 
     Args:
       path (str): path to bucket file, where to write to or read from.
+      file_pool (_FilePool): pool of files to write through, defaults to a pool
+        holding this bucket file only.
     """
     self._path = path
+    self._file_pool = file_pool or _FilePool(max_open_files=1)
     self._length = 0
     self._size = 0
-    self._create_file()
-
-  def _create_file(self) -> None:
-    tf.io.gfile.makedirs(os.path.dirname(self._path))
-    self._fobj = tf.io.gfile.GFile(self._path, mode='wb')
 
   @property
   def size(self) -> int:
@@ -123,7 +538,6 @@ class _Bucket:
       data (binary): the data.
     """
     data_size = len(data)
-    self._fobj.write(_hkey_to_bytes(key))
     # http://docs.python.org/3/library/struct.html#byte-order-size-and-alignment
     # The equal sign ("=") is important here, has it guarantees the standard
     # size (Q: 8 bytes) is used, as opposed to native size, which can differ
@@ -131,116 +545,956 @@ class _Bucket:
     # written, and we can read that same amount of bytes later.
     # We do not specify endianess (platform dependent), but this is OK since the
     # temporary files are going to be written and read by the same platform.
-    self._fobj.write(struct.pack('=Q', data_size))
-    self._fobj.write(data)
+    self._file_pool.write(self._path, _hkey_to_bytes(key) + struct.pack('=Q', data_size))
+    self._file_pool.write(self._path, data)
     self._length += 1
     self._size += data_size
 
   def flush(self) -> None:
-    if self._fobj:
-      self._fobj.flush()
-      self._fobj.close()
+    self._file_pool.close(self._path)
 
   def read_values(self) -> Generator[tuple[int, bytes], None, None]:
     """Yields (hkey, data) tuples stored in bucket."""
-    self.flush()
-    path = self._path
-    if not tf.io.gfile.exists(path):
-      # In case bucket was created but nothing was ever added.
-      # This is likely to happen if the number of buckets is large compared to
-      # the number of generated examples.
+    if not self._length:
       return
-    with tf.io.gfile.GFile(path, 'rb') as fobj:
-      while True:
-        buff = fobj.read(HKEY_SIZE_BYTES)
-        if not buff:
-          break
-        hkey = _read_hkey(buff)
-        size_bytes = fobj.read(8)
-        size = struct.unpack('=Q', size_bytes)[0]
-        data = fobj.read(size)
-        yield hkey, data
+    self.flush()
+    yield from read_bucket_file(self._path, self._file_pool.codec)
+
+  @property
+  def path(self) -> str:
+    return self._path
 
   def del_file(self) -> None:
-    if tf.io.gfile.exists(self._path):
+    if self._length and tf.io.gfile.exists(self._path):
       tf.io.gfile.remove(self._path)
 
+  def state(self) -> list[int]:
+    """Returns the number of records, their size and the size of the (flushed) bucket file."""
+    file_size = tf.io.gfile.stat(self._path).length if self._length else 0
+    return [self._length, self._size, file_size]
+
+  def restore(self, length: int, size: int, file_size: int) -> None:
+    """Restores a bucket to a previous `state`, records written afterwards are discarded."""
+    _truncate_file(self._path, file_size)
+    if length:
+      self._file_pool.add_existing(self._path)
+    self._length = length
+    self._size = size
+
+
+class _RecordsTable(Sequence):
+  """Read-only sequence of the (hkey, data) records of a memory-mapped bucket file.
+
+  Records are only materialized when accessed, data as `memoryview` slices of the mapped file.
+  Slicing returns another table, without materializing any record. This avoids holding one tuple
+  and one (garbage collector tracked) memoryview per record in memory.
+  """
+
+  def __init__(self, view: memoryview, hkeys_hi: np.ndarray, hkeys_lo: np.ndarray,
+               offsets: np.ndarray, lengths: np.ndarray):
+    self._view = view
+    self._hkeys_hi = hkeys_hi
+    self._hkeys_lo = hkeys_lo
+    self._offsets = offsets
+    self._lengths = lengths
+
+  def __len__(self) -> int:
+    return len(self._offsets)
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return _RecordsTable(self._view, self._hkeys_hi[index], self._hkeys_lo[index],
+                           self._offsets[index], self._lengths[index])
+    offset = int(self._offsets[index])
+    return ((int(self._hkeys_hi[index]) << 64) | int(self._hkeys_lo[index]),
+            self._view[offset:offset + int(self._lengths[index])])
+
+  def __iter__(self) -> Generator[tuple[int, memoryview], None, None]:
+    return _iter_records_table(self._view, self._hkeys_hi, self._hkeys_lo, self._offsets,
+                               self._lengths)
+
+  def sorted(self) -> '_RecordsTable':
+    """Returns the table sorted by hkey, with a vectorized `np.lexsort`."""
+    order = np.lexsort((self._hkeys_lo, self._hkeys_hi))
+    return _RecordsTable(self._view, self._hkeys_hi[order], self._hkeys_lo[order],
+                         self._offsets[order], self._lengths[order])
+
+
+def _read_sorted_bucket_file(path: str,
+                             codec: Optional[SpillCodec] = None) -> Sequence[tuple[int, bytes]]:
+  """Returns the (hkey, data) tuples of a non empty bucket file, sorted by hkey."""
+  return _RecordsTable(*_parse_records_table(_read_spill_file(path, codec))).sorted()
+
+
+def iter_sorted_bucket_file(
+    path: str,
+    hkey_range: tuple[int, int],
+    max_bucket_size: int,
+    codec: Optional[SpillCodec] = None) -> Generator[Sequence[tuple[int, bytes]], None, None]:
+  """Yields the (hkey, data) tuples of a bucket file sorted by hkey, as non-empty sorted sequences.
+
+  Sorted sequences are `_RecordsTable` instances, whose data are `memoryview` slices of the
+  memory-mapped (local, uncompressed) or decompressed bucket file.
+
+  If the file is larger than max_bucket_size, its records are re-partitioned among
+  SUB_BUCKETS_NUMBER sub-buckets, each holding a consecutive sub-range of hkey_range, which are then
+  sorted recursively. Concatenated, the yielded sequences are thus in the same order as if the whole
+  bucket had been sorted in memory.
+
+  Args:
+    path: path of the bucket file, sub-bucket files are written next to it.
+    hkey_range: range [start, end) of the hkeys of the records in the bucket.
+    max_bucket_size: maximum size in bytes of a (decompressed) bucket file sorted in memory.
+    codec: codec the bucket file is compressed with, if any. Sub-bucket files are compressed with
+      the same codec.
+  """
+  if not tf.io.gfile.exists(path):
+    return
+  start, end = hkey_range
+  width = end - start
+  size = tf.io.gfile.stat(path).length
+  if not size:
+    return
+  if codec:
+    size = codec.raw_size(path)
+  if size <= max_bucket_size or width < SUB_BUCKETS_NUMBER:
+    yield _read_sorted_bucket_file(path, codec)
+    return
+  # Sub-bucket names are unique, as a bucket can be read by several shard writers concurrently.
+  grp_name = uuid.uuid4().hex
+  file_pool = _FilePool(max_open_files=SUB_BUCKETS_NUMBER, codec=codec)
+  sub_buckets = [
+      _Bucket('%s.%s_%02d' % (path, grp_name, i), file_pool) for i in range(SUB_BUCKETS_NUMBER)
+  ]
+  try:
+    for hkey, data in read_bucket_file(path, codec):
+      sub_buckets[((hkey - start) * SUB_BUCKETS_NUMBER) // width].add(hkey, data)
+    file_pool.close_all()
+    for i, sub_bucket in enumerate(sub_buckets):
+      if len(sub_bucket) == 1:
+        yield list(sub_bucket.read_values())
+      elif len(sub_bucket) > 1:
+        sub_range = (start + -(-(i * width) // SUB_BUCKETS_NUMBER),
+                     start + -(-((i + 1) * width) // SUB_BUCKETS_NUMBER))
+        yield from iter_sorted_bucket_file(sub_bucket.path, sub_range, max_bucket_size, codec)
+      sub_bucket.del_file()
+  finally:
+    # Sub-buckets are also removed when the generator is closed before being exhausted.
+    file_pool.close_all()
+    for sub_bucket in sub_buckets:
+      sub_bucket.del_file()
+
+
+class _MemBuffer:
+  """Holds (key, binary value) tuples in memory, compactly.
+
+  Values are appended to a single contiguous bytearray (the arena), while the two 64 bits halves of
+  each key, and the offset and length of each value in the arena are stored in NumPy arrays, whose
+  capacity is doubled when full. This avoids the overhead of one Python int, bytes and tuple object
+  per record, makes the size of the buffer exact, and lets records be sorted with a vectorized
+  `np.lexsort`.
+  """
+
+  def __init__(self, capacity: int = 1024):
+    """Initialize a _MemBuffer instance.
+
+    Args:
+      capacity (int): initial number of records the arrays can hold.
+    """
+    self._arena = bytearray()
+    self._hkeys_hi = np.empty(capacity, dtype=np.uint64)
+    self._hkeys_lo = np.empty(capacity, dtype=np.uint64)
+    self._offsets = np.empty(capacity, dtype=np.int64)
+    self._lengths = np.empty(capacity, dtype=np.int64)
+    self._length = 0
+
+  def __len__(self) -> int:
+    return self._length
+
+  @property
+  def nbytes(self) -> int:
+    """Returns the number of bytes allocated by the buffer."""
+    return (sys.getsizeof(self._arena) + self._hkeys_hi.nbytes + self._hkeys_lo.nbytes +
+            self._offsets.nbytes + self._lengths.nbytes)
+
+  def _grow(self) -> None:
+    capacity = 2 * len(self._offsets)
+    for name in ['_hkeys_hi', '_hkeys_lo', '_offsets', '_lengths']:
+      array = getattr(self, name)
+      grown = np.empty(capacity, dtype=array.dtype)
+      grown[:self._length] = array[:self._length]
+      setattr(self, name, grown)
+
+  def add(self, hkey: int, data: bytes) -> None:
+    """Adds (hkey, data) to buffer."""
+    if self._length == len(self._offsets):
+      self._grow()
+    index = self._length
+    self._hkeys_hi[index] = hkey >> 64
+    self._hkeys_lo[index] = hkey & _MAX_INT64
+    self._offsets[index] = len(self._arena)
+    self._lengths[index] = len(data)
+    self._arena += data
+    self._length += 1
+
+  def _iter_records(self, order: np.ndarray) -> Generator[tuple[int, bytes], None, None]:
+    hkeys_hi = self._hkeys_hi[order].tolist()
+    hkeys_lo = self._hkeys_lo[order].tolist()
+    offsets = self._offsets[order].tolist()
+    lengths = self._lengths[order].tolist()
+    with memoryview(self._arena) as arena:
+      for hkey_hi, hkey_lo, offset, length in zip(hkeys_hi, hkeys_lo, offsets, lengths):
+        yield (hkey_hi << 64) | hkey_lo, arena[offset:offset + length].tobytes()
+
+  def items(self) -> Generator[tuple[int, bytes], None, None]:
+    """Yields (hkey, data) tuples in insertion order."""
+    yield from self._iter_records(np.arange(self._length))
+
+  def sorted_items(self) -> Generator[tuple[int, bytes], None, None]:
+    """Yields (hkey, data) tuples sorted by hkey."""
+    order = np.lexsort((self._hkeys_lo[:self._length], self._hkeys_hi[:self._length]))
+    yield from self._iter_records(order)
+
+
+class _BloomFilter:
+  """Bloom filter of hkeys, with a power of two number of bits.
+
+  Bit positions are computed by double hashing, the two halves of the (uniform) hkey being the base
+  hashes.
+  """
+
+  def __init__(self, capacity: int, bits_per_record: int, hashes_number: int):
+    """Initialize a _BloomFilter instance.
+
+    Args:
+      capacity (int): number of hkeys the filter is sized for.
+      bits_per_record (int): minimum number of bits per hkey.
+      hashes_number (int): number of bits set per hkey.
+    """
+    bits_number = 1 << (capacity * bits_per_record - 1).bit_length()
+    self._bits = bytearray(bits_number >> 3)
+    self._mask = bits_number - 1
+    self._hashes_number = hashes_number
+    self.capacity = capacity
+    self.count = 0
+
+  def __contains__(self, hkey: int) -> bool:
+    base = hkey & _MAX_INT64
+    step = (hkey >> 64) | 1
+    bits = self._bits
+    mask = self._mask
+    for i in range(self._hashes_number):
+      position = (base + i * step) & mask
+      if not bits[position >> 3] & (1 << (position & 7)):
+        return False
+    return True
+
+  def add(self, hkey: int) -> bool:
+    """Adds hkey, returns whether it may have been added before."""
+    base = hkey & _MAX_INT64
+    step = (hkey >> 64) | 1
+    bits = self._bits
+    mask = self._mask
+    suspected = True
+    for i in range(self._hashes_number):
+      position = (base + i * step) & mask
+      bit = 1 << (position & 7)
+      if not bits[position >> 3] & bit:
+        suspected = False
+        bits[position >> 3] |= bit
+    self.count += 1
+    return suspected
+
+  def add_array(self, hkeys: np.ndarray) -> None:
+    """Adds the hkeys of a (n, 2) array of their high and low 64 bits halves."""
+    bits = np.frombuffer(self._bits, dtype=np.uint8)
+    mask = np.uint64(self._mask)
+    # Same positions as `add`, uint64 arithmetic wraps modulo 2**64, which does not change the masked
+    # bits.
+    base = hkeys[:, 1]
+    step = hkeys[:, 0] | np.uint64(1)
+    for i in range(self._hashes_number):
+      positions = (base + np.uint64(i) * step) & mask
+      np.bitwise_or.at(bits, positions >> np.uint64(3),
+                       (np.uint64(1) << (positions & np.uint64(7))).astype(np.uint8))
+    self.count += len(hkeys)
+
+
+class _HkeysSegment:
+  """Sorted file of hkeys, with an in-memory index of the first hkey of each block.
+
+  File format: the high and low 64 bits halves of each hkey (8 bytes each), sorted.
+  """
+
+  def __init__(self, path: str, hkeys: np.ndarray):
+    """Initialize a _HkeysSegment instance, of an existing segment file.
+
+    Args:
+      path (str): path of the segment file.
+      hkeys (np.ndarray): sorted (n, 2) array of the hkeys of the file, only the first hkey of each
+        block is kept.
+    """
+    self.path = path
+    self.count = len(hkeys)
+    fences = hkeys[::HKEYS_BLOCK_SIZE]
+    self._fences_hi = np.ascontiguousarray(fences[:, 0])
+    self._fences_lo = np.ascontiguousarray(fences[:, 1])
+
+  @classmethod
+  def write(cls, path: str, hkeys: np.ndarray) -> '_HkeysSegment':
+    """Writes the sorted (n, 2) array of hkeys to a segment file at path."""
+    with tf.io.gfile.GFile(path, 'wb') as f:
+      f.write(hkeys.tobytes())
+    return cls(path, hkeys)
+
+  def read(self) -> np.ndarray:
+    """Returns the sorted (n, 2) array of the hkeys of the segment."""
+    with tf.io.gfile.GFile(self.path, 'rb') as f:
+      return np.frombuffer(f.read(), dtype=np.uint64).reshape(-1, 2)
+
+  def __contains__(self, hkey: tuple[np.uint64, np.uint64]) -> bool:
+    """Returns whether the (high, low) hkey is in the segment, reading a single block."""
+    hi, lo = hkey
+    # The block of hkey is the last one whose first hkey is lower or equal.
+    start = np.searchsorted(self._fences_hi, hi, side='left')
+    end = np.searchsorted(self._fences_hi, hi, side='right')
+    block = start + np.searchsorted(self._fences_lo[start:end], lo, side='right') - 1
+    if block < 0:
+      return False
+    with tf.io.gfile.GFile(self.path, 'rb') as f:
+      f.seek(int(block) * HKEYS_BLOCK_SIZE * HKEY_SIZE_BYTES)
+      hkeys = np.frombuffer(f.read(HKEYS_BLOCK_SIZE * HKEY_SIZE_BYTES),
+                            dtype=np.uint64).reshape(-1, 2)
+    return bool(np.any((hkeys[:, 0] == hi) & (hkeys[:, 1] == lo)))
+
+
+def _sort_hkeys(hkeys: np.ndarray) -> np.ndarray:
+  """Returns the (n, 2) array of the high and low halves of hkeys, sorted by hkey."""
+  return hkeys[np.lexsort((hkeys[:, 1], hkeys[:, 0]))]
+
+
+class _DuplicatesDetector:
+  """Detects hkeys added more than once, with a scalable Bloom filter and sorted hkeys segments.
+
+  Memory usage is bounded: about BLOOM_FILTER_BITS_PER_RECORD bits per record for the filters, a
+  write buffer per partition, and 16 bytes per block of HKEYS_BLOCK_SIZE hkeys for the segments
+  index. Merging two segments loads them in memory, at most the hkeys of a partition.
+  """
+
+  def __init__(self, dirpath: str, grp_name: str, capacity: Optional[int] = None):
+    """Initialize a _DuplicatesDetector instance.
+
+    Args:
+      dirpath (string): directory in which to store the hkeys files.
+      grp_name (string): name prefix of the hkeys files.
+      capacity (int): expected number of hkeys, defaults to `BLOOM_FILTER_DEFAULT_CAPACITY`.
+    """
+    self._dirpath = dirpath
+    self._grp_name = grp_name
+    self._capacity = max(capacity or BLOOM_FILTER_DEFAULT_CAPACITY, 1 << 10)
+    self._segments_number = 0
+    self._reset()
+
+  def _reset(self) -> None:
+    self._filters = [self._new_filter(0)]
+    self._buffers = [bytearray() for _ in range(HKEYS_PARTITIONS_NUMBER)]
+    self._segments: list[list[_HkeysSegment]] = [[] for _ in range(HKEYS_PARTITIONS_NUMBER)]
+    # Segments of the last checkpoint are kept until `del_files`, even once merged.
+    self._checkpointed: set[str] = set()
+    self._merged: list[str] = []
+
+  def _new_filter(self, index: int) -> _BloomFilter:
+    return _BloomFilter(self._capacity << index, BLOOM_FILTER_BITS_PER_RECORD + 2 * index,
+                        BLOOM_FILTER_HASHES_NUMBER + index)
+
+  def _add_to_filters(self, hkey: int) -> bool:
+    """Adds hkey to the last filter, returns whether it may have been added before."""
+    bloom_filter = self._filters[-1]
+    suspected = bloom_filter.add(hkey)
+    for previous_filter in self._filters[:-1]:
+      if suspected:
+        break
+      suspected = hkey in previous_filter
+    if bloom_filter.count >= bloom_filter.capacity:
+      self._filters.append(self._new_filter(len(self._filters)))
+    return suspected
+
+  def add(self, hkey: int) -> bool:
+    """Adds hkey, returns whether it had already been added."""
+    partition = hkey >> (HKEY_SIZE - 8)
+    if self._add_to_filters(hkey) and self._contains(partition, hkey):
+      return True
+    buffer = self._buffers[partition]
+    buffer += _hkey_to_bytes(hkey)
+    if len(buffer) >= HKEYS_WRITE_BUFFER_SIZE:
+      self._flush(partition)
+    return False
+
+  def _segment_path(self, partition: int) -> str:
+    self._segments_number += 1
+    return os.path.join(
+        self._dirpath, 'hkeys_%s_%03d_%06d.tmp' % (self._grp_name, partition, self._segments_number))
+
+  def _flush(self, partition: int) -> None:
+    """Writes the buffered hkeys of a partition as a sorted segment, and merges segments.
+
+    The last two segments are merged as long as the older one is not larger than the newer one,
+    so a partition has a logarithmic number of segments, and each hkey is rewritten a logarithmic
+    number of times.
+    """
+    hkeys = _sort_hkeys(
+        np.frombuffer(bytes(self._buffers[partition]), dtype=np.uint64).reshape(-1, 2))
+    self._buffers[partition].clear()
+    segments = self._segments[partition]
+    segments.append(_HkeysSegment.write(self._segment_path(partition), hkeys))
+    while len(segments) > 1 and segments[-2].count <= segments[-1].count:
+      newer, older = segments.pop(), segments.pop()
+      hkeys = _sort_hkeys(np.concatenate([older.read(), newer.read()]))
+      segments.append(_HkeysSegment.write(self._segment_path(partition), hkeys))
+      for segment in (older, newer):
+        if segment.path in self._checkpointed:
+          self._merged.append(segment.path)
+        else:
+          tf.io.gfile.remove(segment.path)
+
+  def _contains(self, partition: int, hkey: int) -> bool:
+    """Returns whether hkey was added to the given partition."""
+    hi, lo = np.uint64(hkey >> 64), np.uint64(hkey & _MAX_INT64)
+    hkeys = np.frombuffer(bytes(self._buffers[partition]), dtype=np.uint64).reshape(-1, 2)
+    if np.any((hkeys[:, 0] == hi) & (hkeys[:, 1] == lo)):
+      return True
+    return any((hi, lo) in segment for segment in self._segments[partition])
+
+  def checkpoint(self) -> list[list[str]]:
+    """Flushes the buffered hkeys, returns the names of the segment files of each partition."""
+    for partition, buffer in enumerate(self._buffers):
+      if buffer:
+        self._flush(partition)
+    self._checkpointed = {segment.path for segments in self._segments for segment in segments}
+    return [[os.path.basename(segment.path) for segment in segments] for segments in self._segments]
+
+  def restore(self, segment_names: list[list[str]]) -> None:
+    """Restores the segments of a checkpoint, and adds their hkeys to the Bloom filters.
+
+    Segment files of the group written after the checkpoint are removed.
+    """
+    self._reset()
+    paths = {os.path.join(self._dirpath, name) for names in segment_names for name in names}
+    pattern = os.path.join(self._dirpath, 'hkeys_%s_*.tmp' % self._grp_name)
+    for path in tf.io.gfile.glob(pattern):
+      if path not in paths:
+        tf.io.gfile.remove(path)
+    self._checkpointed = paths
+    for partition, names in enumerate(segment_names):
+      for name in names:
+        path = os.path.join(self._dirpath, name)
+        with tf.io.gfile.GFile(path, 'rb') as f:
+          hkeys = np.frombuffer(f.read(), dtype=np.uint64).reshape(-1, 2)
+        self._segments[partition].append(_HkeysSegment(path, hkeys))
+        self._segments_number = max(self._segments_number, int(name[-10:-4]))
+        while len(hkeys):
+          bloom_filter = self._filters[-1]
+          size = bloom_filter.capacity - bloom_filter.count
+          bloom_filter.add_array(hkeys[:size])
+          hkeys = hkeys[size:]
+          if bloom_filter.count >= bloom_filter.capacity:
+            self._filters.append(self._new_filter(len(self._filters)))
+
+  def del_files(self) -> None:
+    """Removes the hkeys files."""
+    paths = self._merged + [segment.path for segments in self._segments for segment in segments]
+    for path in paths:
+      if tf.io.gfile.exists(path):
+        tf.io.gfile.remove(path)
+    self._reset()
+
 
 class Shuffler:
   """Stores data in temp buckets, restitute it shuffled."""
 
-  def __init__(self, dirpath: str, hash_salt: str):
+  def __init__(self,
+               dirpath: str,
+               hash_salt: str,
+               spill_strategy: str = SPILL_BUCKETS,
+               memory_budget: Optional[int] = None,
+               buckets_number: Optional[int] = None,
+               total_examples: Optional[int] = None,
+               max_bucket_size: Optional[int] = None,
+               hash_fn: str = HASH_MD5,
+               detect_duplicates: bool = False,
+               spill_compression: Optional[str] = None,
+               spill_compression_level: Optional[int] = None,
+               name: Optional[str] = None):
     """Initialize Shuffler.
 
     Args:
       dirpath (string): directory in which to store temporary files.
       hash_salt (string or bytes): salt to hash keys.
+      spill_strategy (string): how to write data to disk when it does not fit in memory, one of
+        `SPILL_BUCKETS` or `SPILL_RUNS`.
+      memory_budget (int): size in bytes the in-memory buffer can use before data is written to
+        disk, defaults to `MAX_MEM_BUFFER_SIZE`.
+      buckets_number (int): number of buckets used by `SPILL_BUCKETS`, defaults to a number derived
+        from total_examples and the average size of the records when data is first written to
+        disk, or to `BUCKETS_NUMBER` if total_examples is unknown.
+      total_examples (int): expected number of records.
+      max_bucket_size (int): maximum size in bytes of a bucket sorted in memory, larger buckets
+        are re-partitioned in sub-buckets before being sorted, defaults to memory_budget.
+      hash_fn (string): name of the hash function used to hash keys, see `Hasher`.
+      detect_duplicates (bool): whether to check keys are unique as records are added, instead of
+        only when records are read back. This uses about BLOOM_FILTER_BITS_PER_RECORD bits of
+        memory per expected record, and 16 bytes of disk per record.
+      spill_compression (string): codec to compress the files data is spilled to with, one of
+        `SPILL_COMPRESSION_ZLIB` or `SPILL_COMPRESSION_LZMA`, defaults to no compression.
+      spill_compression_level (int): compression level of spill_compression.
+      name (string): name of the temporary files group, defaults to a random name. A shuffler can
+        only be restored from a checkpoint by a shuffler with the same name.
     """
-    grp_name = uuid.uuid4()
-    self._hasher = Hasher(hash_salt)
+    if spill_strategy not in (SPILL_BUCKETS, SPILL_RUNS):
+      raise ValueError(f'Unsupported spill strategy: {spill_strategy}.')
+    grp_name = name or uuid.uuid4().hex
+    self._dirpath = dirpath
+    self._grp_name = grp_name
+    self._spill_strategy = spill_strategy
+    self._memory_budget = MAX_MEM_BUFFER_SIZE if memory_budget is None else memory_budget
+    self._buckets_number = buckets_number
+    self._total_examples = total_examples
+    self._max_bucket_size = self._memory_budget if max_bucket_size is None else max_bucket_size
+    self._hasher = Hasher(hash_salt, hash_fn)
+    # Buckets are only created when data is first written to disk.
+    self._codec = None
+    if spill_compression:
+      self._codec = SpillCodec(spill_compression, spill_compression_level)
+    self._file_pool = _FilePool(codec=self._codec)
     self._buckets: list[_Bucket] = []
-    for i in range(BUCKETS_NUMBER):
-      path = os.path.join(dirpath, 'bucket_%s_%03d.tmp' % (grp_name, i))
-      self._buckets.append(_Bucket(path))
+    self._runs: list[_Bucket] = []
     self._read_only = False
     self._total_bytes = 0
     # To keep data in memory until enough data has been gathered.
     self._in_memory = True
-    self._mem_buffer: list[tuple[int, bytes]] = []
+    self._mem_buffer = _MemBuffer()
+    self._duplicates_detector = None
+    if detect_duplicates:
+      self._duplicates_detector = _DuplicatesDetector(dirpath, grp_name, total_examples)
+    # Once checkpointed, spill files are only removed by `del_files`, as the checkpoint refers to
+    # them.
+    self._checkpointed = False
+    self._spilled_bytes = 0
+    self._peak_buffer_size = 0
 
   @property
   def size(self) -> int:
     """Return total size in bytes of records (not keys)."""
     return self._total_bytes
 
+  @property
+  def spilled_bytes(self) -> int:
+    """Size in bytes of the records (not keys) written to spill files, before compression."""
+    return self._spilled_bytes
+
+  @property
+  def peak_buffer_size(self) -> int:
+    """Largest number of bytes allocated by the in-memory buffer."""
+    return self._peak_buffer_size
+
   @property
   def bucket_lengths(self) -> list[int]:
     if self._in_memory:
       return [len(self._mem_buffer)]
+    if self._spill_strategy == SPILL_RUNS:
+      # Runs are merged, there is a single (virtual) bucket.
+      return [sum(len(run) for run in self._runs) + len(self._mem_buffer)]
     return [len(b) for b in self._buckets]
 
+  @property
+  def spill_strategy(self) -> str:
+    return self._spill_strategy
+
+  @property
+  def max_bucket_size(self) -> int:
+    return self._max_bucket_size
+
+  @property
+  def memory_budget(self) -> int:
+    return self._memory_budget
+
+  @property
+  def hash_fn(self) -> str:
+    return self._hasher.hash_fn
+
+  @property
+  def spill_compression(self) -> Optional[str]:
+    return self._codec.name if self._codec else None
+
+  @property
+  def buffered_records(self) -> int:
+    """Number of records held in the in-memory buffer only, not written to spill files yet."""
+    return len(self._mem_buffer or ())
+
+  @property
+  def in_memory(self) -> bool:
+    """Whether all the records are held in memory, i.e. nothing was written to buckets."""
+    return self._in_memory
+
+  def bucket_files(self) -> list[str]:
+    """Closes the buckets and returns their file paths, ordered as `bucket_lengths`.
+
+    Once called, no more records can be added to the shuffler. Bucket files can then be read in
+    parallel with `read_bucket_file` (with a `SpillCodec` for `spill_compression`, if any) and have
+    to be removed with `del_files`.
+    """
+    if self._in_memory or self._spill_strategy != SPILL_BUCKETS:
+      raise AssertionError('bucket_files() can only be called when records are spilled to '
+                           'buckets.')
+    self._set_read_only()
+    return [bucket.path for bucket in self._buckets]
+
+  def del_files(self) -> None:
+    """Removes the bucket files."""
+    for bucket in self._buckets + self._runs:
+      bucket.del_file()
+    if self._duplicates_detector:
+      self._duplicates_detector.del_files()
+
+  def _set_read_only(self) -> None:
+    if not self._read_only:
+      self._file_pool.close_all()
+      if self._codec:
+        self._codec.log_write_stats()
+    self._read_only = True
+    if self._duplicates_detector:
+      # No more records can be added, the sidecar hkeys are not needed anymore.
+      self._duplicates_detector.del_files()
+      self._duplicates_detector = None
+
+  def _get_buckets_number(self) -> int:
+    """Returns the number of buckets to use, given the records added so far."""
+    if self._buckets_number:
+      return self._buckets_number
+    if not self._total_examples:
+      return BUCKETS_NUMBER
+    num_records = len(self._mem_buffer)
+    record_size = (self._total_bytes + num_records * (HKEY_SIZE_BYTES + 8)) / num_records
+    split_size = record_size * max(self._total_examples, num_records)
+    bucket_size = max(self._memory_budget // 2, 1)
+    return min(max(math.ceil(split_size / bucket_size), MIN_BUCKETS_NUMBER), MAX_BUCKETS_NUMBER)
+
+  def _create_buckets(self) -> None:
+    buckets_number = self._get_buckets_number()
+    logging.info(f'Spilling {len(self._mem_buffer)} records ({self._mem_buffer.nbytes} bytes) to '
+                 f'{buckets_number} buckets in {self._dirpath}, memory budget: '
+                 f'{self._memory_budget} bytes, expected number of records: '
+                 f'{self._total_examples}.')
+    for i in range(buckets_number):
+      path = os.path.join(self._dirpath, 'bucket_%s_%03d.tmp' % (self._grp_name, i))
+      self._buckets.append(_Bucket(path, self._file_pool))
+
   def _add_to_bucket(self, hkey: int, data: bytes) -> None:
-    bucket_number = get_bucket_number(hkey, BUCKETS_NUMBER)
+    bucket_number = get_bucket_number(hkey, len(self._buckets))
     self._buckets[bucket_number].add(hkey, data)
+    self._spilled_bytes += len(data)
 
   def _add_to_mem_buffer(self, hkey: int, data: bytes) -> None:
-    self._mem_buffer.append((hkey, data))
-    if self._total_bytes > MAX_MEM_BUFFER_SIZE:
-      for hkey, data in self._mem_buffer:
+    self._mem_buffer.add(hkey, data)
+    nbytes = self._mem_buffer.nbytes
+    if nbytes > self._peak_buffer_size:
+      self._peak_buffer_size = nbytes
+    if nbytes > self._memory_budget:
+      self._spill()
+
+  def _spill(self) -> None:
+    """Writes the records of the in-memory buffer to disk."""
+    if self._spill_strategy == SPILL_RUNS:
+      self._spill_run()
+    else:
+      if self._in_memory:
+        self._create_buckets()
+      for hkey, data in self._mem_buffer.items():
         self._add_to_bucket(hkey, data)
       self._mem_buffer = None # type: ignore
-      self._in_memory = False
+    self._in_memory = False
+
+  def _spill_run(self) -> None:
+    """Sorts the in-memory buffer and writes it to disk as a sorted run."""
+    path = os.path.join(self._dirpath, 'run_%s_%05d.tmp' % (self._grp_name, len(self._runs)))
+    logging.info(f'Spilling {len(self._mem_buffer)} records ({self._mem_buffer.nbytes} bytes) to '
+                 f'sorted run {path}, memory budget: {self._memory_budget} bytes.')
+    run = _Bucket(path, self._file_pool)
+    for hkey, data in self._mem_buffer.sorted_items():
+      run.add(hkey, data)
+      self._spilled_bytes += len(data)
+    run.flush()
+    self._runs.append(run)
+    self._mem_buffer = _MemBuffer()
+
+  def checkpoint(self) -> dict[str, Any]:
+    """Writes all the records added so far to disk, and returns the manifest of the spill files.
+
+    Records held in memory are spilled first, checkpointing when `buffered_records` is 0 avoids
+    spilling the in-memory buffer early. The manifest can be saved as JSON, and given to `restore`
+    to get back to this state. Spill files are then only removed by `del_files`.
+    """
+    if self._read_only:
+      raise AssertionError('checkpoint() cannot be called after __iter__.')
+    if len(self._mem_buffer or ()):
+      self._spill()
+    self._file_pool.close_all()
+    self._checkpointed = True
+    manifest = {
+        'name': self._grp_name,
+        'spill_strategy': self._spill_strategy,
+        'in_memory': self._in_memory,
+        'total_bytes': self._total_bytes,
+        'buckets': [bucket.state() for bucket in self._buckets],
+        'runs': [run.state() for run in self._runs],
+    }
+    if self._duplicates_detector:
+      manifest['hkeys'] = self._duplicates_detector.checkpoint()
+    return manifest
+
+  def restore(self, manifest: dict[str, Any]) -> None:
+    """Restores the shuffler to a checkpoint, see `checkpoint`.
+
+    Records written to the spill files after the checkpoint are discarded.
+
+    Args:
+      manifest: manifest of the spill files, returned by `checkpoint`.
+
+    Raises:
+      ValueError: if the manifest was not written by a shuffler with the same name and spill
+        strategy.
+    """
+    if (manifest['name'] != self._grp_name or manifest['spill_strategy'] != self._spill_strategy):
+      raise ValueError(f'Checkpoint of shuffler {manifest["name"]} ({manifest["spill_strategy"]}) '
+                       f'cannot be restored by shuffler {self._grp_name} '
+                       f'({self._spill_strategy}).')
+    self._checkpointed = True
+    self._total_bytes = manifest['total_bytes']
+    self._in_memory = manifest['in_memory']
+    self._buckets = []
+    for i, state in enumerate(manifest['buckets']):
+      path = os.path.join(self._dirpath, 'bucket_%s_%03d.tmp' % (self._grp_name, i))
+      self._buckets.append(_Bucket(path, self._file_pool))
+      self._buckets[-1].restore(*state)
+    self._runs = []
+    for i, state in enumerate(manifest['runs']):
+      path = os.path.join(self._dirpath, 'run_%s_%05d.tmp' % (self._grp_name, i))
+      self._runs.append(_Bucket(path, self._file_pool))
+      self._runs[-1].restore(*state)
+    if self._buckets:
+      self._mem_buffer = None # type: ignore
+    if self._duplicates_detector and 'hkeys' in manifest:
+      self._duplicates_detector.restore(manifest['hkeys'])
 
   def add(self, key: int, data: bytes) -> None:
     """Add (key, data) to shuffler."""
+    self.add_hashed(self._hasher.hash_key(key), data, key)
+
+  def add_hashed(self, hkey: int, data: bytes, key: Optional[Any] = None) -> None:
+    """Add (hkey, data) to shuffler.
+
+    Args:
+      hkey: hash of the example key, it must have been computed by a `Hasher` using the same salt
+        as this shuffler.
+      data: the serialized example.
+      key: the example key, only used to report duplicated keys.
+
+    Raises:
+      DuplicatedKeysError: if duplicates are detected at add time and hkey was already added.
+    """
     if self._read_only:
       raise AssertionError('add() cannot be called after __iter__.')
     if not isinstance(data, bytes):
       raise AssertionError('Only bytes (not %s) can be stored in Shuffler!' % (type(data)))
-    hkey = self._hasher.hash_key(key)
+    if self._duplicates_detector and self._duplicates_detector.add(hkey):
+      raise DuplicatedKeysError(key, data)
     self._total_bytes += len(data)
-    if self._in_memory:
+    if self._in_memory or self._spill_strategy == SPILL_RUNS:
       self._add_to_mem_buffer(hkey, data)
     else:
       self._add_to_bucket(hkey, data)
 
   def __iter__(self) -> Generator[bytes, None, None]:
-    self._read_only = True
+    for _, data in self.items():
+      yield data
+
+  def items(self) -> Generator[tuple[int, bytes], None, None]:
+    """Yields the (hkey, data) records, ordered by hkey."""
+    self._set_read_only()
     previous_hkey = None
     previous_data = None
-    iterator = self._iter_mem() if self._in_memory else self._iter_buckets()
-    for hkey, data in iterator:
-      if hkey == previous_hkey:
-        raise DuplicatedKeysError(data, previous_data)
-      previous_hkey = hkey
-      yield data
-      previous_data = data
+    if self._in_memory:
+      iterator = self._iter_mem()
+    elif self._spill_strategy == SPILL_RUNS:
+      iterator = self._iter_runs()
+    else:
+      iterator = self._iter_buckets()
+    try:
+      for hkey, data in iterator:
+        if hkey == previous_hkey:
+          raise DuplicatedKeysError(data, previous_data)
+        previous_hkey = hkey
+        yield hkey, data
+        previous_data = data
+    finally:
+      # Closing the iterator removes its spill files, even if the records were not all read.
+      iterator.close()
+    if self._codec:
+      self._codec.log_read_stats()
 
   def _iter_mem(self) -> Generator[tuple[int, bytes], None, None]:
-    yield from sorted(self._mem_buffer)
+    yield from self._mem_buffer.sorted_items()
 
   def _iter_buckets(self) -> Generator[tuple[int, bytes], None, None]:
-    for bucket in self._buckets:
-      bucket_data = sorted(bucket.read_values())
-      bucket.del_file()
-      yield from bucket_data
+    """Yields records of the buckets, each bucket sorted in memory.
+
+    Bucket files are removed once read, and all of them once the generator is exhausted or closed.
+    """
+    try:
+      for i, bucket in enumerate(self._buckets):
+        if not bucket:
+          continue
+        hkey_range = get_bucket_range(i, len(self._buckets))
+        for bucket_data in iter_sorted_bucket_file(bucket.path, hkey_range, self._max_bucket_size,
+                                                   self._codec):
+          yield from bucket_data
+        if not self._checkpointed:
+          bucket.del_file()
+    finally:
+      if not self._checkpointed:
+        for bucket in self._buckets:
+          bucket.del_file()
+
+  def _iter_runs(self) -> Generator[tuple[int, bytes], None, None]:
+    """Yields records of the sorted runs and in-memory buffer, with a k-way merge.
+
+    Only the read buffer (or decompressed block) of each run file is held in memory, the runs are
+    first merged into intermediate runs until at most MAX_MERGE_FAN_IN files are left to merge.
+    Run files are removed once the merge is exhausted or closed.
+    """
+    runs = list(self._runs)
+    merged: list[_Bucket] = []
+    try:
+      # One of the MAX_MERGE_FAN_IN merged iterators is the in-memory buffer.
+      while len(runs) >= MAX_MERGE_FAN_IN:
+        runs.sort(key=lambda run: run.size)
+        group = runs[:MAX_MERGE_FAN_IN]
+        del runs[:MAX_MERGE_FAN_IN]
+        path = os.path.join(self._dirpath, 'merge_%s_%05d.tmp' % (self._grp_name, len(merged)))
+        logging.info(f'Merging {len(group)} sorted runs to {path}.')
+        run = _Bucket(path, self._file_pool)
+        merged.append(run)
+        for hkey, data in heapq.merge(*[group_run.read_values() for group_run in group],
+                                      key=operator.itemgetter(0)):
+          run.add(hkey, data)
+        run.flush()
+        for group_run in group:
+          if group_run in merged or not self._checkpointed:
+            group_run.del_file()
+        runs.append(run)
+      iterators = [run.read_values() for run in runs]
+      iterators.append(self._mem_buffer.sorted_items())
+      yield from heapq.merge(*iterators, key=operator.itemgetter(0))
+    finally:
+      for run in merged:
+        run.del_file()
+      if not self._checkpointed:
+        for run in self._runs:
+          run.del_file()
+
+
+class WindowShuffler:
+  """Shuffles records within a bounded window, without writing anything to disk.
+
+  Records are held in memory until the window is full, then each added record makes the window
+  release the records with the smallest hkeys greater than the last released one (replacement
+  selection). Released records are thus runs of records ordered by hkey, each run mixing about
+  twice the window of consecutively added records. Unlike `Shuffler`, duplicated keys are only
+  detected when both records are in the window at the same time.
+  """
+
+  def __init__(self, hash_salt: str, memory_budget: Optional[int] = None, hash_fn: str = HASH_MD5):
+    """Initialize WindowShuffler.
+
+    Args:
+      hash_salt (string or bytes): salt to hash keys.
+      memory_budget (int): size in bytes of the records held in the window, defaults to
+        `MAX_MEM_BUFFER_SIZE`.
+      hash_fn (string): name of the hash function used to hash keys, see `Hasher`.
+    """
+    self._hasher = Hasher(hash_salt, hash_fn)
+    self._memory_budget = MAX_MEM_BUFFER_SIZE if memory_budget is None else memory_budget
+    # Heaps of (hkey, data) of the current run, and of the records added with a hkey smaller than
+    # the last released one, released in the next run.
+    self._run: list[tuple[int, bytes]] = []
+    self._next_run: list[tuple[int, bytes]] = []
+    self._window_bytes = 0
+    self._total_bytes = 0
+    self._previous: Optional[tuple[int, bytes]] = None
+    self._peak_buffer_size = 0
+
+  @property
+  def size(self) -> int:
+    """Return total size in bytes of records (not keys)."""
+    return self._total_bytes
+
+  @property
+  def peak_buffer_size(self) -> int:
+    """Largest size in bytes of the records held in the window."""
+    return self._peak_buffer_size
+
+  @property
+  def hash_fn(self) -> str:
+    return self._hasher.hash_fn
+
+  def add(self, key: Any, data: bytes) -> list[bytes]:
+    """Add (key, data) to the window, returns the released records."""
+    return self.add_hashed(self._hasher.hash_key(key), data)
+
+  def add_hashed(self, hkey: int, data: bytes, key: Optional[Any] = None) -> list[bytes]:
+    """Add (hkey, data) to the window, returns the released records.
+
+    Args:
+      hkey: hash of the example key, it must have been computed by a `Hasher` using the same salt
+        as this shuffler.
+      data: the serialized example.
+      key: the example key, unused, for compatibility with `Shuffler.add_hashed`.
+
+    Raises:
+      DuplicatedKeysError: if a released record has the same hkey as the previous one.
+    """
+    return [data for _, data in self.add_hashed_items(hkey, data)]
+
+  def add_hashed_items(self, hkey: int, data: bytes) -> list[tuple[int, bytes]]:
+    """Add (hkey, data) to the window, returns the released (hkey, data) records."""
+    if self._previous is not None and hkey < self._previous[0]:
+      heapq.heappush(self._next_run, (hkey, data))
+    else:
+      heapq.heappush(self._run, (hkey, data))
+    self._window_bytes += len(data)
+    self._total_bytes += len(data)
+    self._peak_buffer_size = max(self._peak_buffer_size, self._window_bytes)
+    released = []
+    while self._window_bytes > self._memory_budget:
+      released.append(self._release())
+    return released
+
+  def _release(self) -> tuple[int, bytes]:
+    if not self._run:
+      self._run, self._next_run = self._next_run, self._run
+    hkey, data = heapq.heappop(self._run)
+    if self._previous is not None and hkey == self._previous[0]:
+      raise DuplicatedKeysError(data, self._previous[1])
+    self._previous = (hkey, data)
+    self._window_bytes -= len(data)
+    return hkey, data
+
+  def __iter__(self) -> Generator[bytes, None, None]:
+    """Releases the records left in the window."""
+    for _, data in self.items():
+      yield data
+
+  def items(self) -> Generator[tuple[int, bytes], None, None]:
+    """Releases the (hkey, data) records left in the window."""
+    while self._run or self._next_run:
+      yield self._release()
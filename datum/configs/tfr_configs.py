@@ -49,6 +49,145 @@ class TFRWriteConfigs(ConfigBase):
   num_test_examples = create_config(name='num_test_examples',
                                     ty=int,
                                     docstring='Num of test examples in the dataset.')
+  num_workers = create_config(
+      name='num_workers',
+      ty=int,
+      docstring='Number of processes used to serialize examples, 1 serializes in the main process.',
+      default_factory=lambda: 1,
+  )
+  flush_workers = create_config(
+      name='flush_workers',
+      ty=int,
+      docstring='Number of processes used to write tfrecord shards once examples are spilled to \
+      disk, 1 writes shards sequentially.',
+      default_factory=lambda: 1,
+  )
+  spill_strategy = create_config(
+      name='spill_strategy',
+      ty=str,
+      docstring='How examples are written to disk when they do not fit in memory, `buckets` \
+      partitions them by hashed key, `runs` writes sorted runs merged at flush time.',
+      default_factory=lambda: 'buckets',
+  )
+  memory_budget = create_config(
+      name='memory_budget',
+      ty=int,
+      docstring='Size in bytes of the examples held in memory before they are written to disk, \
+      defaults to 1GB.',
+  )
+  buckets_number = create_config(
+      name='buckets_number',
+      ty=int,
+      docstring='Number of buckets examples are written to when they do not fit in memory, \
+      defaults to a number derived from the split size.',
+  )
+  hash_fn = create_config(
+      name='hash_fn',
+      ty=str,
+      docstring='Hash function used to shuffle examples, `md5` or `blake2b`, it is recorded in \
+      the dataset info.',
+      default_factory=lambda: 'md5',
+  )
+  detect_duplicates = create_config(
+      name='detect_duplicates',
+      ty=bool,
+      docstring='Whether to check example keys are unique while examples are generated, instead \
+      of only when shards are written.',
+      default_factory=lambda: False,
+  )
+  spill_compression = create_config(
+      name='spill_compression',
+      ty=str,
+      docstring='Codec to compress examples written to disk when they do not fit in memory with, \
+      `zlib` or `lzma`, defaults to no compression.',
+  )
+  spill_compression_level = create_config(
+      name='spill_compression_level',
+      ty=int,
+      docstring='Compression level of spill_compression, defaults to the codec default level.',
+  )
+  resume = create_config(
+      name='resume',
+      ty=bool,
+      docstring='Whether to checkpoint the progress of the conversion and resume from the last \
+      checkpoint of a previous run, the generator must then yield examples in a deterministic \
+      order.',
+      default_factory=lambda: False,
+  )
+  checkpoint_interval = create_config(
+      name='checkpoint_interval',
+      ty=int,
+      docstring='Minimum time in seconds between two checkpoints when resume is set.',
+      default_factory=lambda: 600,
+  )
+  append = create_config(
+      name='append',
+      ty=bool,
+      docstring='Whether to append the examples to existing splits as additional shards, instead \
+      of writing the splits.',
+      default_factory=lambda: False,
+  )
+  shuffle = create_config(
+      name='shuffle',
+      ty=str,
+      docstring='How examples are shuffled, `full` to shuffle whole splits, `window` to shuffle \
+      examples within a window of memory_budget bytes or `none` to keep the generator order. \
+      `window` and `none` stream examples to shards without writing temporary files.',
+      default_factory=lambda: 'full',
+  )
+  compression_type = create_config(
+      name='compression_type',
+      ty=str,
+      docstring='Compression type of the tfrecord shards, `GZIP` or `ZLIB`, defaults to no \
+      compression. It is recorded in the dataset info and used by the reader.',
+  )
+  shard_size = create_config(
+      name='shard_size',
+      ty=int,
+      docstring='Target size in bytes of a tfrecord shard, defaults to a power of two number of \
+      shards of 64MiB to 1GiB.',
+  )
+  min_shards = create_config(
+      name='min_shards',
+      ty=int,
+      docstring='Minimum number of shards of a split, so that small splits are read in parallel.',
+      default_factory=lambda: 1,
+  )
+  shards_multiple = create_config(
+      name='shards_multiple',
+      ty=int,
+      docstring='The number of shards of a split is rounded up to a multiple of shards_multiple, \
+      e.g. the number of hosts reading the dataset.',
+      default_factory=lambda: 1,
+  )
+  write_index = create_config(
+      name='write_index',
+      ty=bool,
+      docstring='Whether to write the record index (offset and length of each record) of each \
+      uncompressed tfrecord shard next to it, as `<shard>.idx`.',
+      default_factory=lambda: False,
+  )
+  write_key_index = create_config(
+      name='write_key_index',
+      ty=bool,
+      docstring='Whether to write the key index (sorted hashed example keys) of each shard next to \
+      it, as `<shard>.keys`, to find examples by key. Requires write_index.',
+      default_factory=lambda: False,
+  )
+  write_checksums = create_config(
+      name='write_checksums',
+      ty=bool,
+      docstring='Whether to record the sha256 digest of each shard in the dataset info, to verify \
+      the shards contents. Shards are then read back once written.',
+      default_factory=lambda: False,
+  )
+  split_workers = create_config(
+      name='split_workers',
+      ty=int,
+      docstring='Number of splits written concurrently, each in its own process, the generator \
+      and serializer must then be picklable.',
+      default_factory=lambda: 1,
+  )
 
 
 class TFRReadConfigs(ConfigBase):
@@ -18,13 +18,50 @@ from typing import Any
 from absl import app, flags, logging
 
 from datum.utils.common_utils import load_module
-from datum.writer.tfrecord_writer import TFRecordWriter
+from datum.writer.tfrecord_writer import TFRecordWriter, create_records_concurrently
 
 flags.DEFINE_string('output_path', None, 'Path to store the tfrecord files.')
 flags.DEFINE_string('input_path', None, 'Path to the input files.')
 flags.DEFINE_string('splits', None,
                     'Single split name or comma seperated multiple split names for conversion.')
 flags.DEFINE_string('config_path', None, 'Path to the configuration file for tfrecord conversion.')
+flags.DEFINE_integer('num_workers', 1, 'Number of processes used to serialize examples.')
+flags.DEFINE_integer('flush_workers', 1, 'Number of processes used to write tfrecord shards.')
+flags.DEFINE_enum('spill_strategy', 'buckets', ['buckets', 'runs'],
+                  'How examples are written to disk when they do not fit in memory.')
+flags.DEFINE_integer(
+    'memory_budget', None,
+    'Size in bytes of the examples held in memory before they are written to disk.')
+flags.DEFINE_integer('buckets_number', None,
+                     'Number of buckets examples are written to when they do not fit in memory.')
+flags.DEFINE_enum('hash_fn', 'md5', ['md5', 'blake2b'],
+                  'Hash function used to shuffle examples, recorded in the dataset info.')
+flags.DEFINE_boolean('detect_duplicates', False,
+                     'Check example keys are unique while examples are generated.')
+flags.DEFINE_enum('spill_compression', None, ['zlib', 'lzma'],
+                  'Codec to compress examples written to disk when they do not fit in memory.')
+flags.DEFINE_integer('spill_compression_level', None, 'Compression level of spill_compression.')
+flags.DEFINE_boolean('resume', False,
+                     'Checkpoint the conversion progress and resume from the last checkpoint.')
+flags.DEFINE_integer('checkpoint_interval', 600,
+                     'Minimum time in seconds between two checkpoints when resume is set.')
+flags.DEFINE_boolean('append', False, 'Append the examples to existing splits as additional shards.')
+flags.DEFINE_enum('shuffle', 'full', ['full', 'window', 'none'],
+                  'How examples are shuffled, `window` and `none` stream examples to shards.')
+flags.DEFINE_enum('compression_type', None, ['GZIP', 'ZLIB'],
+                  'Compression type of the tfrecord shards.')
+flags.DEFINE_integer('shard_size', None, 'Target size in bytes of a tfrecord shard.')
+flags.DEFINE_integer('min_shards', 1, 'Minimum number of shards of a split.')
+flags.DEFINE_integer('shards_multiple', 1,
+                     'Number of shards of a split is a multiple of shards_multiple.')
+flags.DEFINE_boolean('write_index', False,
+                     'Write the record index of each shard next to it, as `<shard>.idx`.')
+flags.DEFINE_boolean('write_key_index', False,
+                     'Write the key index of each shard next to it, as `<shard>.keys`.')
+flags.DEFINE_boolean('write_checksums', False,
+                     'Record the sha256 digest of each shard in the dataset info.')
+flags.DEFINE_integer('split_workers', 1,
+                     'Number of splits written concurrently, each in its own process.')
 FLAGS = flags.FLAGS
 
 
@@ -36,18 +73,45 @@ def main(_: Any) -> None:
     splits = FLAGS.splits.split(',')
   generator = config.generator(FLAGS.input_path)
   Path(FLAGS.output_path).mkdir(parents=True, exist_ok=True)
+  writers_kwargs = []
   for split in splits:
-    logging.info(f'Creating tfrecord writer for split: {split}.')
-    tfr_writer = TFRecordWriter(generator,
-                                config.serializer,
-                                FLAGS.output_path,
-                                split,
-                                config.num_examples.get(split),
-                                sparse_features=config.sparse_features,
-                                **config.gen_kwargs)
+    writers_kwargs.append(
+        dict(generator=generator,
+             serializer=config.serializer,
+             path=FLAGS.output_path,
+             split=split,
+             total_examples=config.num_examples.get(split),
+             sparse_features=config.sparse_features,
+             num_workers=FLAGS.num_workers,
+             flush_workers=FLAGS.flush_workers,
+             spill_strategy=FLAGS.spill_strategy,
+             memory_budget=FLAGS.memory_budget,
+             buckets_number=FLAGS.buckets_number,
+             hash_fn=FLAGS.hash_fn,
+             detect_duplicates=FLAGS.detect_duplicates,
+             spill_compression=FLAGS.spill_compression,
+             spill_compression_level=FLAGS.spill_compression_level,
+             resume=FLAGS.resume,
+             checkpoint_interval=FLAGS.checkpoint_interval,
+             append=FLAGS.append,
+             shuffle=FLAGS.shuffle,
+             compression_type=FLAGS.compression_type,
+             shard_size=FLAGS.shard_size,
+             min_shards=FLAGS.min_shards,
+             shards_multiple=FLAGS.shards_multiple,
+             write_index=FLAGS.write_index,
+             write_key_index=FLAGS.write_key_index,
+             write_checksums=FLAGS.write_checksums,
+             **config.gen_kwargs))
+  if FLAGS.split_workers > 1 and len(writers_kwargs) > 1:
+    create_records_concurrently(FLAGS.output_path, writers_kwargs, FLAGS.split_workers)
+    return
+  for writer_kwargs in writers_kwargs:
+    logging.info(f'Creating tfrecord writer for split: {writer_kwargs["split"]}.')
+    tfr_writer = TFRecordWriter(**writer_kwargs)
     logging.info('Starting conversion process.')
     tfr_writer.create_records()
-    logging.info(f'Completed tfrecord conversion for input split: {split}')
+    logging.info(f'Completed tfrecord conversion for input split: {writer_kwargs["split"]}')
 
 
 if __name__ == '__main__':
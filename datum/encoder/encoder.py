@@ -15,9 +15,10 @@
 import abc
 from typing import Any
 
+import numpy as np
 import tensorflow as tf
 
-from datum.utils.common_utils import add_metaclass
+from datum.utils.common_utils import IMAGE_MAGIC_NUMBERS, add_metaclass
 from datum.utils.types_utils import ValueType
 
 
@@ -63,11 +64,18 @@ class ImageEncoder(Encoder):
     """Image encoder.
 
     Args:
-      inputs: input image absolute path.
+      inputs: input image absolute path, or encoded image bytes.
 
     Returns:
       a bytes string representation of the input image.
+
+    Raises:
+      ValueError: if inputs are bytes, but not a JPEG or PNG encoded image.
     """
+    if isinstance(inputs, bytes):
+      if not inputs.startswith(IMAGE_MAGIC_NUMBERS):
+        raise ValueError('Image bytes are not a JPEG or PNG encoded image.')
+      return inputs
     with tf.io.gfile.GFile(inputs, 'rb') as image_f:
       return image_f.read()
 
@@ -152,6 +160,10 @@ def _get_encoder_type(value: ValueType, problem_type: str) -> Encoder: # type: i
   Raises:
     ValueError, if value type is not supported.
   """
+  if isinstance(value, np.ndarray):
+    if value.dtype.kind in 'biuf':
+      return NumberEncoder()
+    return _get_encoder_type(value.tolist(), problem_type)
   if isinstance(value, (list, tuple)):
     return _get_encoder_type(value[0], problem_type)
   else:
@@ -166,5 +178,9 @@ def _get_encoder_type(value: ValueType, problem_type: str) -> Encoder: # type: i
         return StringEncoder(problem_type=problem_type)
       elif problem_type == 'graph':
         return GraphEncoder()
+    elif isinstance(value, bytes):
+      if problem_type == 'image':
+        return ImageEncoder()
+      return StringEncoder(problem_type=problem_type)
     else:
       raise ValueError('Input object is not supported.')
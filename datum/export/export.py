@@ -20,7 +20,7 @@ from absl import logging
 from datum.configs import ConfigBase
 from datum.configs.default_configs import get_default_write_configs
 from datum.problem import types
-from datum.writer.tfrecord_writer import TFRecordWriter
+from datum.writer.tfrecord_writer import TFRecordWriter, create_records_concurrently
 
 
 def export_to_tfrecord(input_path: str, output_path: str, problem_type: str,
@@ -38,6 +38,42 @@ def export_to_tfrecord(input_path: str, output_path: str, problem_type: str,
     generator: Generator class.
     serializer: Serializer instance.
     splits: A dict with split names as keys and split attributes as values.
+    num_workers: Number of processes used to serialize examples. Default - 1
+    flush_workers: Number of processes used to write tfrecord shards. Default - 1
+    spill_strategy: How examples are written to disk when they do not fit in memory, `buckets`
+      or `runs`. Default - `buckets`
+    memory_budget: Size in bytes of the examples held in memory before they are written to disk.
+      Default - 1GB
+    buckets_number: Number of buckets used by the `buckets` spill strategy. Default - derived
+      from the number of examples of the split and their size.
+    hash_fn: Hash function used to shuffle examples, `md5` or `blake2b`. Default - `md5`
+    detect_duplicates: Whether to check example keys are unique while examples are generated.
+      Default - False
+    spill_compression: Codec to compress examples written to disk with, `zlib` or `lzma`.
+      Default - no compression
+    spill_compression_level: Compression level of spill_compression. Default - codec default
+    resume: Whether to checkpoint the conversion progress and resume from the last checkpoint of
+      a previous run, the generator must yield examples in a deterministic order. Default - False
+    checkpoint_interval: Minimum time in seconds between two checkpoints. Default - 600
+    append: Whether to append the examples to existing splits as additional shards, existing
+      shards are left untouched. Default - False
+    shuffle: How examples are shuffled, `full`, `window` (within memory_budget bytes) or `none`.
+      `window` and `none` stream examples to shards as they are generated. Default - `full`
+    compression_type: Compression type of the tfrecord shards, `GZIP` or `ZLIB`, read back
+      transparently by the reader. Default - no compression
+    shard_size: Target size in bytes of a tfrecord shard. Default - power of two number of shards
+      of 64MiB to 1GiB
+    min_shards: Minimum number of shards of a split. Default - 1
+    shards_multiple: Number of shards of a split is a multiple of shards_multiple, e.g. the
+      number of hosts reading the dataset. Default - 1
+    write_index: Whether to write the record index of each shard next to it, as `<shard>.idx`,
+      to seek to records. Not supported with compression_type. Default - False
+    write_key_index: Whether to write the key index of each shard next to it, as `<shard>.keys`,
+      to find examples by key. Requires write_index. Default - False
+    write_checksums: Whether to record the sha256 digest of each shard in the dataset info, shards
+      are then read back once written. Default - False
+    split_workers: Number of splits written concurrently, each in its own process, the generator
+      and serializer must then be picklable. Default - 1
 
     Following split attributes are supported:
 
@@ -73,15 +109,42 @@ def export_to_tfrecord(input_path: str, output_path: str, problem_type: str,
     raise ValueError(f"Splits must be a dict in the input config: {write_configs}")
   generator = write_configs.generator(input_path)
   Path(output_path).mkdir(parents=True, exist_ok=True)
+  writers_kwargs = []
   for split, split_kwargs in splits.items():
-    logging.info(f'Creating tfrecord writer for split: {split}.')
-    tfr_writer = TFRecordWriter(generator,
-                                write_configs.serializer,
-                                output_path,
-                                split,
-                                split_kwargs["num_examples"],
-                                sparse_features=write_configs.sparse_features,
-                                **split_kwargs)
+    writers_kwargs.append(
+        dict(generator=generator,
+             serializer=write_configs.serializer,
+             path=output_path,
+             split=split,
+             total_examples=split_kwargs["num_examples"],
+             sparse_features=write_configs.sparse_features,
+             num_workers=write_configs.num_workers,
+             flush_workers=write_configs.flush_workers,
+             spill_strategy=write_configs.spill_strategy,
+             memory_budget=write_configs.memory_budget,
+             buckets_number=write_configs.buckets_number,
+             hash_fn=write_configs.hash_fn,
+             detect_duplicates=write_configs.detect_duplicates,
+             spill_compression=write_configs.spill_compression,
+             spill_compression_level=write_configs.spill_compression_level,
+             resume=write_configs.resume,
+             checkpoint_interval=write_configs.checkpoint_interval,
+             append=write_configs.append,
+             shuffle=write_configs.shuffle,
+             compression_type=write_configs.compression_type,
+             shard_size=write_configs.shard_size,
+             min_shards=write_configs.min_shards,
+             shards_multiple=write_configs.shards_multiple,
+             write_index=write_configs.write_index,
+             write_key_index=write_configs.write_key_index,
+             write_checksums=write_configs.write_checksums,
+             **split_kwargs))
+  if write_configs.split_workers > 1 and len(writers_kwargs) > 1:
+    create_records_concurrently(output_path, writers_kwargs, write_configs.split_workers)
+    return
+  for writer_kwargs in writers_kwargs:
+    logging.info(f'Creating tfrecord writer for split: {writer_kwargs["split"]}.')
+    tfr_writer = TFRecordWriter(**writer_kwargs)
     logging.info('Starting conversion process.')
     tfr_writer.create_records()
-    logging.info(f'Completed tfrecord conversion for input split: {split}')
+    logging.info(f'Completed tfrecord conversion for input split: {writer_kwargs["split"]}')
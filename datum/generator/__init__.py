@@ -14,6 +14,7 @@
 
 from datum.generator.generator import DatumGenerator
 from datum.generator.image import (ClfDatumGenerator, DetDatumGenerator, SegDatumGenerator)
+from datum.generator.synthetic import SyntheticDatumGenerator
 from datum.generator.text import TextJsonDatumGenerator
 from datum.utils.common_utils import deserialize_object
 
@@ -22,6 +23,7 @@ clf = CLF = ClfDatumGenerator
 det = DET = DetDatumGenerator
 seg = SEG = SegDatumGenerator
 textjson = TEXTJSON = TextJsonDatumGenerator
+synthetic = SYNTHETIC = SyntheticDatumGenerator
 
 
 def deserialize(name: str) -> DatumGenerator:
@@ -0,0 +1,268 @@
+# Copyright 2020 The OpenAGI Datum Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import zlib
+from typing import Any, Optional, Union
+
+import numpy as np
+import tensorflow as tf
+
+from datum.configs import ConfigBase
+from datum.generator import DatumGenerator
+from datum.utils.common_utils import AttrDict
+from datum.utils.types_utils import GeneratorReturnType
+
+KEYS_SEQUENTIAL = 'sequential'
+KEYS_RANDOM = 'random'
+IMAGE_FORMATS = ('jpeg', 'png')
+DTYPES = ('int', 'float', 'string', 'image')
+
+# Examples are generated in chunks of _CHUNK_SIZE, each with its own random generator.
+_CHUNK_SIZE = 1024
+# Odd multiplier of the bijection from example indexes to random keys.
+_KEY_MULTIPLIER = 0x9E3779B97F4A7C15
+_FEATURE_DEFAULTS = {
+    'shape': (),
+    'min_length': 1,
+    'max_length': None,
+    'low': 0,
+    'high': 1000,
+    'vocab_size': 1000,
+    'min_words': 1,
+    'max_words': 1,
+    'height': 256,
+    'width': 256,
+    'channels': 3,
+    'format': 'jpeg',
+    'quality': 90,
+    'num_distinct_images': 64,
+}
+
+
+def _check_feature_spec(name: str, spec: dict[str, Any]) -> dict[str, Any]:
+  """Returns the feature spec with its defaults.
+
+  Raises:
+    ValueError: if the spec is not valid.
+  """
+  spec = {**_FEATURE_DEFAULTS, **spec}
+  if spec.get('dtype') not in DTYPES:
+    raise ValueError(f'Feature {name} dtype must be one of {DTYPES}, got {spec.get("dtype")}.')
+  spec['shape'] = tuple(spec['shape'])
+  if spec['dtype'] == 'image':
+    if spec['shape']:
+      raise ValueError(f'Image feature {name} shape is set by its height, width and channels.')
+    if spec['channels'] not in (1, 3):
+      raise ValueError(f'Image feature {name} must have 1 or 3 channels.')
+    if spec['format'] not in IMAGE_FORMATS:
+      raise ValueError(f'Image feature {name} format must be one of {IMAGE_FORMATS}.')
+  if None in spec['shape'] and not spec['max_length']:
+    raise ValueError(f'Feature {name} has a variable shape, max_length must be set.')
+  if spec['min_length'] < 1 or (spec['max_length'] and spec['max_length'] < spec['min_length']):
+    raise ValueError(f'Feature {name} lengths must verify 1 <= min_length <= max_length.')
+  if spec['max_words'] < spec['min_words']:
+    raise ValueError(f'Feature {name} must verify min_words <= max_words.')
+  # Variable length features must be written as sparse features to be read back.
+  spec.setdefault('sparse', None in spec['shape'])
+  return spec
+
+
+def encode_random_image(rng: np.random.Generator,
+                        height: int,
+                        width: int,
+                        channels: int = 3,
+                        image_format: str = 'jpeg',
+                        quality: int = 90) -> bytes:
+  """Returns a smooth random image, whose encoded size is close to a natural image's.
+
+  Args:
+    rng: random generator the pixels are drawn from.
+    height, width, channels: shape of the image, channels is 1 or 3.
+    image_format: `jpeg` or `png`.
+    quality: JPEG quality.
+
+  Returns:
+    the encoded image.
+  """
+  coarse = rng.uniform(0, 255, size=(1, 8, 8, channels)).astype(np.float32)
+  image = tf.image.resize(coarse, (height, width))[0].numpy()
+  image += rng.normal(0, 8, size=image.shape)
+  image = tf.constant(np.clip(image, 0, 255).astype(np.uint8))
+  if image_format == 'png':
+    return tf.io.encode_png(image).numpy()
+  return tf.io.encode_jpeg(image, quality=quality).numpy()
+
+
+class SyntheticDatumGenerator(DatumGenerator):
+  """Synthetic data generator, no input data is required.
+
+  Examples are generated from a schema defined in the generator config, they are deterministic
+  given the seed, the split name and the example index. Examples are generated in chunks with
+  vectorized numpy operations, and encoded images are drawn from a pool of distinct images encoded
+  once, so that millions of examples can be generated quickly.
+
+  Following gen_config attributes are supported:
+
+  features: a dict with feature names as keys and feature specs as values, required.
+  num_examples: number of examples of each split, an int or a dict with split names as keys. The
+    `num_examples` keyword argument of the `__call__` method takes precedence.
+  seed: random seed, default - 0.
+  key_distribution: `sequential` keys, `<split>_<index>`, or `random` unique hex keys,
+    default - `sequential`.
+
+  Following feature spec attributes are supported:
+
+  dtype: `int`, `float`, `string` or `image`, required.
+  shape: feature shape, None for variable dimensions, default - () for scalars.
+  min_length, max_length: range of the variable dimensions, max_length is required for variable
+    shapes, default - min_length 1.
+  low, high: range of `int` and `float` values, default - [0, 1000).
+  vocab_size, min_words, max_words: `string` values are sentences of min_words to max_words words
+    out of vocab_size words, default - single words out of 1000.
+  height, width, channels, format, quality: size, number of channels (1 or 3), `jpeg` or `png`
+    format and JPEG quality of `image` values, default - 256x256x3 JPEG of quality 90.
+  num_distinct_images: number of distinct encoded images of an `image` feature, default - 64.
+  sparse: whether the feature is written as a sparse feature, default - True for variable shapes.
+    See `sparse_features`, to pass to the writer.
+
+  Usage:
+    gen_config = AttrDict(num_examples=1000000,
+                          features={
+                              'image': {'dtype': 'image', 'height': 224, 'width': 224},
+                              'label': {'dtype': 'int', 'high': 10},
+                              'boxes': {'dtype': 'float', 'shape': [None, 4], 'max_length': 8},
+                          })
+    generator = SyntheticDatumGenerator(gen_config=gen_config)
+    for key, datum in generator(split='train'):
+      ...
+
+  Args:
+    path: unused, for compatibility with the other generators.
+    gen_config: generator config, see above.
+
+  Raises:
+    ValueError: if gen_config does not define valid features.
+  """
+
+  # pylint: disable=super-init-not-called
+  def __init__(self, path: Optional[str] = None, gen_config: Union[AttrDict, ConfigBase] = None):
+    self.path = path
+    self.gen_config = gen_config
+    if not gen_config or not gen_config.get('features'):
+      raise ValueError('Synthetic generator config must define the `features` to generate.')
+    self._features = {
+        name: _check_feature_spec(name, spec)
+        for name, spec in gen_config['features'].items()
+    }
+    self._seed = gen_config.get('seed', 0)
+    self._key_distribution = gen_config.get('key_distribution', KEYS_SEQUENTIAL)
+    if self._key_distribution not in (KEYS_SEQUENTIAL, KEYS_RANDOM):
+      raise ValueError(f'Unsupported key distribution: {self._key_distribution}.')
+    self._images: dict[str, list[bytes]] = {}
+    self._vocabs: dict[str, np.ndarray] = {}
+
+  @property
+  def sparse_features(self) -> list[str]:
+    """Names of the features to write as sparse features."""
+    return [name for name, spec in self._features.items() if spec['sparse']]
+
+  def generate_datum(self, **kwargs: Any) -> GeneratorReturnType:
+    """Generator yielding the examples of a split.
+
+    Args:
+      kwargs: keyword arguments, `split` name of the split, required, and `num_examples` number of
+        examples of the split, defaults to the gen_config `num_examples`.
+
+    Returns:
+      a tuple of a unique key and a dict with feature names as keys and feature values as values.
+
+    Raises:
+      ValueError: if the split name or its number of examples is not provided.
+    """
+    split = kwargs.get('split')
+    if not split:
+      raise ValueError('Pass a valid split name to generate data.')
+    num_examples = kwargs.get('num_examples', self.gen_config.get('num_examples'))
+    if isinstance(num_examples, dict):
+      num_examples = num_examples.get(split)
+    if num_examples is None:
+      raise ValueError(f'Number of examples of split {split} is not provided.')
+    split_seed = zlib.crc32(split.encode())
+    for start in range(0, num_examples, _CHUNK_SIZE):
+      size = min(_CHUNK_SIZE, num_examples - start)
+      rng = np.random.default_rng([self._seed, split_seed, start // _CHUNK_SIZE])
+      columns = {
+          name: self._generate_feature(name, spec, rng, size)
+          for name, spec in self._features.items()
+      }
+      for offset in range(size):
+        yield (self._get_key(split, split_seed, start + offset), {
+            name: column[offset]
+            for name, column in columns.items()
+        })
+
+  def _get_key(self, split: str, split_seed: int, index: int) -> str:
+    if self._key_distribution == KEYS_RANDOM:
+      return f'{((index + split_seed) * _KEY_MULTIPLIER + self._seed) % (1 << 64):016x}'
+    return f'{split}_{index:012d}'
+
+  def _generate_feature(self, name: str, spec: dict[str, Any], rng: np.random.Generator,
+                        size: int) -> list:
+    """Returns the values of a feature for size examples."""
+    if spec['dtype'] == 'image':
+      images = self._get_images(name, spec)
+      return [images[idx] for idx in rng.integers(len(images), size=size)]
+    # Values of features with dimensions are numpy arrays, slices of the arrays of the chunk.
+    if not spec['shape']:
+      return self._sample(name, spec, rng, (size,)).tolist()
+    if None not in spec['shape']:
+      return list(self._sample(name, spec, rng, (size, *spec['shape'])))
+    if None not in spec['shape'][1:]:
+      lengths = rng.integers(spec['min_length'], spec['max_length'] + 1, size=size)
+      ends = np.cumsum(lengths).tolist()
+      rows = self._sample(name, spec, rng, (ends[-1], *spec['shape'][1:]))
+      return [rows[start:end] for start, end in zip([0] + ends[:-1], ends)]
+    values = []
+    for _ in range(size):
+      shape = tuple(
+          int(rng.integers(spec['min_length'], spec['max_length'] + 1)) if dim is None else dim
+          for dim in spec['shape'])
+      values.append(self._sample(name, spec, rng, shape))
+    return values
+
+  def _sample(self, name: str, spec: dict[str, Any], rng: np.random.Generator,
+              shape: tuple) -> np.ndarray:
+    """Returns an array of random values of the feature dtype."""
+    if spec['dtype'] == 'int':
+      return rng.integers(spec['low'], spec['high'], size=shape)
+    if spec['dtype'] == 'float':
+      return rng.uniform(spec['low'], spec['high'], size=shape).astype(np.float32)
+    if name not in self._vocabs:
+      self._vocabs[name] = np.array([f'w{idx}' for idx in range(spec['vocab_size'])], dtype=object)
+    count = int(np.prod(shape, dtype=np.int64))
+    ends = np.cumsum(rng.integers(spec['min_words'], spec['max_words'] + 1, size=count)).tolist()
+    words = self._vocabs[name][rng.integers(spec['vocab_size'], size=ends[-1] if ends else 0)]
+    words = words.tolist()
+    sentences = [' '.join(words[start:end]) for start, end in zip([0] + ends[:-1], ends)]
+    return np.array(sentences, dtype=object).reshape(shape)
+
+  def _get_images(self, name: str, spec: dict[str, Any]) -> list[bytes]:
+    """Returns the pool of encoded images of a feature, encoded on first use."""
+    if name not in self._images:
+      rng = np.random.default_rng([self._seed, zlib.crc32(name.encode())])
+      self._images[name] = [
+          encode_random_image(rng, spec['height'], spec['width'], spec['channels'], spec['format'],
+                              spec['quality']) for _ in range(spec['num_distinct_images'])
+      ]
+    return self._images[name]
@@ -14,14 +14,18 @@
 
 import json
 import os
-from typing import Callable, Optional
+from collections.abc import Sequence
+from typing import Any, Callable, Optional
 
+import numpy as np
 import tensorflow as tf
 from absl import logging
 
 from datum.configs import ConfigBase
 from datum.reader.tfrecord_reader import Reader
+from datum.utils import info_utils, shard_utils
 from datum.utils.common_utils import memoized_property
+from datum.utils.hashing import HASH_MD5, Hasher
 from datum.utils.types_utils import DatasetType
 
 
@@ -37,6 +41,12 @@ class Dataset():
     self._path = path
     self._dataset_configs = dataset_configs
     self._reader = Reader(self._path, self._dataset_configs.read_config)
+    # Shard filenames and example start indexes of the splits, and record indexes of the shards,
+    # loaded on first random access.
+    self._split_shards: dict[str, tuple[list[str], np.ndarray]] = {}
+    self._record_indexes: dict[str, np.ndarray] = {}
+    # Hashers of the splits and hkey ranges of their shards, see `_get_key_ranges`.
+    self._key_ranges: dict[str, tuple[Hasher, np.ndarray, np.ndarray, np.ndarray]] = {}
 
   @property
   def dataset_configs(self) -> ConfigBase:
@@ -109,13 +119,13 @@ class Dataset():
       dataset = dataset.bucket_by_sequence_length(bucket_fn,
                                                   self._dataset_configs.bucket_op.bucket_boundaries,
                                                   self._dataset_configs.bucket_op.bucket_batch_sizes,
-                                                  padded_shapes=dataset.element_spec,
+                                                  padded_shapes=self._element_shapes(dataset),
                                                   padding_values=None,
                                                   drop_remainder=drop_remainder,
                                                   pad_to_bucket_boundary=False)
     elif batch_size and (use_tf_padding or use_datum_padding):
       if use_tf_padding:
-        padded_shapes = dataset.element_spec
+        padded_shapes = self._element_shapes(dataset)
       else:
         padded_shapes = self.padded_shapes
       dataset = dataset.padded_batch(batch_size,
@@ -141,6 +151,11 @@ class Dataset():
       return tf.data.experimental.get_single_element(dataset)
     return dataset
 
+  @staticmethod
+  def _element_shapes(dataset: DatasetType) -> dict[str, tf.TensorShape]:
+    """Returns the TF interpreted shapes of the dataset elements, to pad them."""
+    return tf.nest.map_structure(lambda spec: spec.shape, dataset.element_spec)
+
   @memoized_property
   def padded_shapes(self) -> dict[str, list]:
     """Returns padded shapes from dataset metadata."""
@@ -154,6 +169,148 @@ class Dataset():
         padded_shapes[key] = []
     return padded_shapes
 
+  def _get_split_shards(self, split: str) -> tuple[list[str], np.ndarray]:
+    """Returns the shard filenames of the split and the global index of their first example.
+
+    The start indexes have an extra last entry, the number of examples of the split.
+    """
+    if split not in self._split_shards:
+      shard_info = info_utils.load_shard_info(self._path)
+      if split not in shard_info:
+        raise ValueError(f'Split {split} not found in {self._path}.')
+      if not info_utils.load_dataset_info(self._path).get(split, {}).get('record_index'):
+        raise ValueError(f'Split {split} has no record index, random access requires the split '
+                         'to be written with `write_index=True`.')
+      num_examples = list(shard_info[split].values())
+      self._split_shards[split] = (list(shard_info[split].keys()),
+                                   np.concatenate([[0], np.cumsum(num_examples, dtype=np.int64)]))
+    return self._split_shards[split]
+
+  def _get_record_index(self, filename: str) -> np.ndarray:
+    """Returns the record index of a shard, see `shard_utils.read_record_index`."""
+    if filename not in self._record_indexes:
+      self._record_indexes[filename] = shard_utils.read_record_index(
+          os.path.join(self._path, filename))
+    return self._record_indexes[filename]
+
+  def get(self, split: str, index: int) -> dict[str, tf.Tensor]:
+    """Get a single example of a split by its position, without reading the preceding examples.
+
+    Args:
+      split: name of the split, written with `write_index=True`.
+      index: global index of the example in the split, in read order, negative indexes count from
+        the end of the split.
+
+    Returns:
+      a dict, deserialized example data, feature name to value.
+    """
+    return self.get_many(split, [index])[0]
+
+  def get_many(self, split: str, indices: Sequence[int]) -> list[dict[str, tf.Tensor]]:
+    """Get examples of a split by their position, without reading the preceding examples.
+
+    Global indices are mapped to shard records using the `shard_info.json` lengths, each record is
+    read directly from its shard at the offset of the shard record index and parsed with the
+    dataset `DatumParser`. Shards and record indexes are opened once per call and shard.
+
+    Args:
+      split: name of the split, written with `write_index=True`.
+      indices: global indexes of the examples in the split, in read order, negative indexes count
+        from the end of the split.
+
+    Returns:
+      a list of dicts, deserialized examples data in the order of indices.
+
+    Raises:
+      ValueError: if the split does not exist or was written without record index.
+      IndexError: if an index is out of the split range.
+    """
+    filenames, shard_starts = self._get_split_shards(split)
+    num_examples = shard_starts[-1]
+    indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+    out_of_range = indices[(indices < -num_examples) | (indices >= num_examples)]
+    if out_of_range.size:
+      raise IndexError(f'Index {out_of_range[0]} out of range for split {split} with '
+                       f'{num_examples} examples.')
+    if not indices.size:
+      return []
+    indices = np.where(indices < 0, indices + num_examples, indices)
+    # Shards without examples share their start with the next shard, side='right' skips them.
+    shard_ids = np.searchsorted(shard_starts, indices, side='right') - 1
+    serialized_examples: list[bytes] = [b''] * len(indices)
+    for shard_id in np.unique(shard_ids):
+      positions = np.flatnonzero(shard_ids == shard_id)
+      record_index = self._get_record_index(filenames[shard_id])
+      records = shard_utils.read_records(os.path.join(self._path, filenames[shard_id]),
+                                         record_index[indices[positions] - shard_starts[shard_id]])
+      for position, record in zip(positions, records):
+        serialized_examples[position] = record
+    return [self._reader.parser.parse_fn(example) for example in serialized_examples]
+
+  def _get_key_ranges(self, split: str) -> tuple[Hasher, np.ndarray, np.ndarray, np.ndarray]:
+    """Returns the hasher of the split and the hkey ranges of its shards.
+
+    Ranges are read from the shard digests of the dataset info, see
+    `shard_utils.read_key_index_range`. Shards without examples are left out, shards written before
+    the ranges were recorded get the full range.
+
+    Returns:
+      the hasher, and the ids of the shards with their first and last hkeys (`S16` arrays), sorted
+      by first hkey.
+    """
+    if split not in self._key_ranges:
+      filenames, _ = self._get_split_shards(split)
+      split_info = info_utils.load_dataset_info(self._path)[split]
+      if not split_info.get('key_index'):
+        raise ValueError(f'Split {split} has no key index, lookup requires the split to be '
+                         'written with `write_key_index=True`.')
+      digests = split_info.get('shards', {})
+      shard_ids, firsts, lasts = [], [], []
+      for shard_id, filename in enumerate(filenames):
+        hkey_range = digests.get(filename, {}).get('hkey_range', ['0' * 32, 'f' * 32])
+        if hkey_range:
+          shard_ids.append(shard_id)
+          firsts.append(bytes.fromhex(hkey_range[0]))
+          lasts.append(bytes.fromhex(hkey_range[1]))
+      shard_ids = np.array(shard_ids, dtype=np.int64)
+      firsts, lasts = np.array(firsts, dtype='S16'), np.array(lasts, dtype='S16')
+      order = np.argsort(firsts, kind='stable')
+      self._key_ranges[split] = (Hasher(split, split_info.get('hash_fn', HASH_MD5)),
+                                 shard_ids[order], firsts[order], lasts[order])
+    return self._key_ranges[split]
+
+  def lookup(self, split: str, key: Any) -> dict[str, tf.Tensor]:
+    """Get an example of a split by the key it was generated with.
+
+    The key is hashed like the writer does, salted with the split name. The shards whose hkey range
+    holds the hashed key are found by a binary search of the ranges recorded in the dataset info,
+    and only their key indexes, sorted arrays of hashed keys, are read and searched. Shards of a
+    fully shuffled split are written in hkey order, a single key index is then read.
+
+    Args:
+      split: name of the split, written with `write_key_index=True`.
+      key: the key yielded by the generator along with the example.
+
+    Returns:
+      a dict, deserialized example data, feature name to value.
+
+    Raises:
+      ValueError: if the split does not exist or was written without key index.
+      KeyError: if no example of the split has this key.
+    """
+    hasher, shard_ids, firsts, lasts = self._get_key_ranges(split)
+    hkey = hasher.hash_key(key)
+    target = np.array(hkey.to_bytes(16, 'big'), dtype='S16')
+    # Ranges overlap when examples are streamed or appended, candidates are then checked in turn.
+    end = np.searchsorted(firsts, target, side='right')
+    filenames, shard_starts = self._get_split_shards(split)
+    for shard_id in shard_ids[:end][lasts[:end] >= target]:
+      key_index = shard_utils.read_key_index(os.path.join(self._path, filenames[shard_id]))
+      index = shard_utils.search_key_index(key_index, hkey)
+      if index >= 0:
+        return self.get(split, int(shard_starts[shard_id]) + index)
+    raise KeyError(f'Key {key!r} not found in split {split}.')
+
   def train_fn(self,
                instruction: str = 'train',
                repeat: Optional[int] = None,
@@ -24,6 +24,7 @@ from absl import logging
 
 from datum.configs import ConfigBase
 from datum.reader.parser import DatumParser
+from datum.utils import info_utils
 from datum.utils.common_utils import zip_dict
 from datum.utils.reader_utils import ReadInstruction
 from datum.utils.shard_utils import get_read_instructions
@@ -46,6 +47,11 @@ class Reader:
     self._parser = DatumParser(self._path)
     self._buffer_size = buffer_size or 8 << 20 # 8 MiB per file.
 
+  @property
+  def parser(self) -> DatumParser:
+    """Returns the parser used to deserialize the examples of the dataset."""
+    return self._parser
+
   def read(
       self,
       instructions: Union[ReadInstruction, list[ReadInstruction], dict[str, ReadInstruction]],
@@ -87,6 +93,7 @@ class Reader:
       file_instructions: The files information.
         The filenames contains the relative path, not absolute.
         skip/take indicates which example read in the shard: `ds.skip().take()`
+        compression_type, if any, is the compression type of the file, `GZIP`, `ZLIB` or empty.
       num_examples_per_shard: A list of integer representing number of example per tfrecord
         files.
       shuffle_files: If True, input files are shuffled before being read.
@@ -109,7 +116,7 @@ class Reader:
     do_take = any(f['take'] > -1 for f in files)
 
     tensor_inputs = {
-        k: list(vals) if k == 'filename' else np.array(vals, dtype=np.int64)
+        k: list(vals) if k in ('filename', 'compression_type') else np.array(vals, dtype=np.int64)
         for k, vals in zip_dict(*files)
     }
 
@@ -145,6 +152,7 @@ class Reader:
 
     ds = tf.data.TFRecordDataset(
         filename,
+        compression_type=filename_skip_take.get('compression_type'),
         buffer_size=self._buffer_size,
         num_parallel_reads=1,
     )
@@ -184,10 +192,20 @@ def make_file_instructions(path: str, instruction: str) -> tuple[list[int], list
   # Create the absolute instruction (per split)
   absolute_instructions = instruction.to_absolute(split2len)
 
-  return _make_file_instructions_from_absolutes(
+  num_examples_per_shard, file_instructions = _make_file_instructions_from_absolutes(
       split2shard_props=split2shard_props,
       absolute_instructions=absolute_instructions,
   )
+  # Splits can be written with different compression types, set it for every file.
+  dataset_info = info_utils.load_dataset_info(path)
+  compression_types = {
+      filename: dataset_info.get(split, {}).get('compression_type') or ''
+      for split, filenames_examples in shard_info.items()
+      for filename in filenames_examples
+  }
+  for file_instruction in file_instructions:
+    file_instruction['compression_type'] = compression_types[file_instruction['filename']]
+  return num_examples_per_shard, file_instructions
 
 
 def _make_file_instructions_from_absolutes(
@@ -46,9 +46,19 @@ class DatumSerializer():
     Returns:
       a serialized binary string.
     """
+    return self.serializer(self.encode(datum))
+
+  def encode(self, datum: DatumType) -> DatumType:
+    """Encode the features of a datum with their encoders.
+
+    Args:
+      a dict with feature name to value,
+
+    Returns:
+      a dict with feature name to encoded value.
+    """
     feature_to_encoder = self.feature_converter(datum, self.problem_type)
-    encoded_datum = {key: value[0](value[1]) for key, value in zip_dict(feature_to_encoder, datum)}
-    return self.serializer(encoded_datum)
+    return {key: value[0](value[1]) for key, value in zip_dict(feature_to_encoder, datum)}
 
 
 def serialize_datum(encoded_datum: DatumType) -> bytes:
@@ -61,7 +71,9 @@ def serialize_datum(encoded_datum: DatumType) -> bytes:
     bytes, the serialized `tf.train.Example` string.
   """
   example = datum_to_tf_example(encoded_datum)
-  return example.SerializeToString()
+  # Deterministic serialization sorts the feature map by key, so that the serialized bytes do not
+  # depend on the hash seed of the process building the example.
+  return example.SerializeToString(deterministic=True)
 
 
 def datum_to_tf_example(datum: DatumType) -> tf.train.Example:
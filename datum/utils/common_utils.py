@@ -16,6 +16,7 @@ import abc
 import contextlib
 import copy
 import importlib.util as module_util
+import io
 import sys
 from itertools import chain
 from typing import Any, Callable, Optional, no_type_check
@@ -25,6 +26,9 @@ from tensorflow.python.util import tf_inspect
 
 from datum.utils.types_utils import DatumType, ValueType
 
+# Leading bytes of JPEG and PNG encoded images.
+IMAGE_MAGIC_NUMBERS = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n')
+
 
 def load_module(module_name: str, module_path: str) -> object:
   """Load python module using a given path; the path can be absolute or relative.
@@ -255,7 +259,7 @@ def item_to_type_and_shape(item: ValueType) -> tuple[str, list]:
 
 
 def check_and_image_shape(item: ValueType, shape: list) -> list:
-  """Check whether a string is image filename.
+  """Check whether a string is image filename or encoded image bytes.
 
   Args:
     item: input string to check.
@@ -264,7 +268,13 @@ def check_and_image_shape(item: ValueType, shape: list) -> list:
     a list, item shape.
   """
   if len(item.shape) > 0:
-    item = str(item[0])
+    item = item[0]
+  if isinstance(item, bytes):
+    if item.startswith(IMAGE_MAGIC_NUMBERS):
+      from PIL import Image
+      return list(np.asarray(Image.open(io.BytesIO(item))).shape)
+    return shape
+  item = str(item)
   if item.endswith(('.jpg', '.jpeg', '.png')):
     from PIL import Image
     im = Image.open(item)
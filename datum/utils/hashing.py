@@ -38,26 +38,54 @@ Note that if we were to find a dataset for which two different keys give the
 same hash (collision), a solution could be to append the key to its hash.
 The split name is being used as salt to avoid having the same keys in two splits
 result in same order.
+As changing it would change the order of existing datasets, md5 stays the
+default. New datasets can opt in to blake2b (with a 128 bits digest), which is
+faster on small keys. The hash function used to write a split is recorded in
+the dataset info, see `datum.utils.info_utils`.
 """
 import hashlib
-from typing import Union
+from collections.abc import Iterable
+from typing import Any, Union
 
-import tensorflow as tf
+HASH_MD5 = 'md5'
+HASH_BLAKE2B = 'blake2b'
 
+# Constructors of the supported hash functions, all have a 128 bits digest.
+_HASH_FUNCTIONS = {
+    HASH_MD5: hashlib.md5,
+    HASH_BLAKE2B: lambda data: hashlib.blake2b(data, digest_size=16),
+}
 
-def _to_bytes(data: Union[str, bytes]) -> bytes:
-  if not isinstance(data, ((str,), bytes)):
+
+def _to_bytes(data: Any) -> bytes:
+  if isinstance(data, bytes):
+    return data
+  if not isinstance(data, str):
     data = str(data)
-  return tf.compat.as_bytes(data)
+  return data.encode('utf-8')
 
 
 class Hasher:
-  """Hasher: to initialize a md5 with salt."""
+  """Hasher: to initialize a md5 (or blake2b) hash with salt."""
+
+  def __init__(self, salt: Union[str, bytes], hash_fn: str = HASH_MD5):
+    """Initialize Hasher.
+
+    Args:
+      salt (string or bytes): salt prepended to the hashed keys.
+      hash_fn (string): name of the hash function, one of `HASH_MD5` or `HASH_BLAKE2B`.
+    """
+    if hash_fn not in _HASH_FUNCTIONS:
+      raise ValueError(f'Unsupported hash function: {hash_fn}, should be one of '
+                       f'{sorted(_HASH_FUNCTIONS)}.')
+    self._hash_fn = hash_fn
+    self._hash = _HASH_FUNCTIONS[hash_fn](_to_bytes(salt))
 
-  def __init__(self, salt: str):
-    self._md5 = hashlib.md5(_to_bytes(salt))
+  @property
+  def hash_fn(self) -> str:
+    return self._hash_fn
 
-  def hash_key(self, key: Union[bytes, str]) -> int:
+  def hash_key(self, key: Any) -> int:
     """Returns 128 bits hash of given key.
 
     Args:
@@ -71,6 +99,17 @@ class Hasher:
     Returns:
       128 bits integer, hash of key.
     """
-    md5 = self._md5.copy()
-    md5.update(_to_bytes(key))
-    return int(md5.hexdigest(), 16)
+    hash_obj = self._hash.copy()
+    hash_obj.update(_to_bytes(key))
+    return int.from_bytes(hash_obj.digest(), 'big')
+
+  def hash_keys(self, keys: Iterable[Any]) -> list[int]:
+    """Returns the 128 bits hashes of given keys, see `hash_key`."""
+    copy = self._hash.copy
+    from_bytes = int.from_bytes
+    hkeys = []
+    for key in keys:
+      hash_obj = copy()
+      hash_obj.update(key if isinstance(key, bytes) else _to_bytes(key))
+      hkeys.append(from_bytes(hash_obj.digest(), 'big'))
+    return hkeys
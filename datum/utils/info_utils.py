@@ -0,0 +1,235 @@
+# Copyright 2020 The OpenAGI Datum Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Dataset metadata: shard info, datum types and shapes, and dataset info describing how each split
+of a dataset was written.
+
+Writers running concurrently, one per split, do not update the metadata files themselves: each
+writes the metadata of its split to a `<split>.manifest.json` file, and `merge_manifests` merges
+them once all the writers are done.
+"""
+
+import json
+import os
+from collections.abc import Sequence
+from typing import Any
+
+import tensorflow as tf
+from absl import logging
+
+DATASET_INFO_FILENAME = "dataset_info.json"
+SHARD_INFO_FILENAME = "shard_info.json"
+TYPES_SHAPES_FILENAME = "datum_to_type_and_shape_mapping.json"
+MANIFEST_SUFFIX = ".manifest.json"
+WRITE_STATS_FILENAME = "write_stats.json"
+
+
+def load_dataset_info(path: str) -> dict[str, dict[str, Any]]:
+  """Returns the dataset info of a dataset, a dict with split names as keys.
+
+  Args:
+    path: path to the tfrecord dataset directory.
+
+  Returns:
+    a dict with split names as keys and split info dicts as values, empty for datasets written
+    before the dataset info was introduced.
+  """
+  info_path = os.path.join(path, DATASET_INFO_FILENAME)
+  if not tf.io.gfile.exists(info_path):
+    return {}
+  with tf.io.gfile.GFile(info_path, "r") as info_f:
+    return json.load(info_f)
+
+
+def load_shard_info(path: str) -> dict[str, dict[str, int]]:
+  """Returns the shard info of a dataset, empty if there is none.
+
+  Args:
+    path: path to the tfrecord dataset directory.
+
+  Returns:
+    a dict with split names as keys and dicts of shard filenames to number of examples as values.
+  """
+  shard_info_path = os.path.join(path, SHARD_INFO_FILENAME)
+  if not tf.io.gfile.exists(shard_info_path):
+    return {}
+  with tf.io.gfile.GFile(shard_info_path, "r") as si_f:
+    return json.load(si_f)
+
+
+def merge_split_shard_info(shard_info: dict[str, dict[str, int]], split: str,
+                           split_shard_info: dict[str, int], append: bool) -> None:
+  """Merge the shards of a split into shard_info, in place.
+
+  Args:
+    shard_info: shard info of the dataset.
+    split: name of the split.
+    split_shard_info: shard filenames of the split to their number of examples.
+    append: whether the shards are appended after the existing shards of the split, instead of
+      replacing them.
+  """
+  if append:
+    shard_info[split].update(split_shard_info)
+  else:
+    shard_info[split] = split_shard_info
+
+
+def merge_split_info(dataset_info: dict[str, dict[str, Any]], split: str, split_info: dict[str, Any],
+                     append: bool) -> None:
+  """Merge the info of a split into dataset_info, in place.
+
+  Args:
+    dataset_info: dataset info of the dataset.
+    split: name of the split.
+    split_info: info of the split, merged with any existing info of the split. Its `shards`
+      digests replace the digests of the split, or when appending, are added to them.
+    append: whether the shards of the split were appended to its existing shards.
+  """
+  prev_split_info = dataset_info.setdefault(split, {})
+  shards = prev_split_info.get("shards", {}) if append else {}
+  prev_split_info.update(split_info)
+  if "shards" in split_info:
+    prev_split_info["shards"] = {**shards, **split_info["shards"]}
+
+
+def update_split_info(path: str,
+                      split: str,
+                      split_info: dict[str, Any],
+                      append: bool = False) -> None:
+  """Update the info of a split in the dataset info of a dataset.
+
+  Args:
+    path: path to the tfrecord dataset directory.
+    split: name of the split.
+    split_info: info of the split, see `merge_split_info`.
+    append: whether the shards of the split were appended to its existing shards.
+  """
+  dataset_info = load_dataset_info(path)
+  merge_split_info(dataset_info, split, split_info, append)
+  write_json(os.path.join(path, DATASET_INFO_FILENAME), dataset_info, indent=2, sort_keys=True)
+
+
+def update_write_stats(path: str, split: str, write_stats: dict[str, Any]) -> None:
+  """Set the write stats of a split in the write stats report of a dataset.
+
+  Args:
+    path: path to the tfrecord dataset directory.
+    split: name of the split.
+    write_stats: stats of the last write of the split, see `stats_utils.WriteStats`.
+  """
+  _write_stats_report(path, {split: write_stats})
+
+
+def _write_stats_report(path: str, splits_write_stats: dict[str, dict[str, Any]]) -> None:
+  """Updates the write stats report with the write stats of splits."""
+  report_path = os.path.join(path, WRITE_STATS_FILENAME)
+  report = {}
+  if tf.io.gfile.exists(report_path):
+    with tf.io.gfile.GFile(report_path, "r") as report_f:
+      report = json.load(report_f)
+  report.update(splits_write_stats)
+  write_json(report_path, report, indent=2)
+
+
+def write_manifest(path: str, split: str, manifest: dict[str, Any]) -> None:
+  """Write the metadata of a split to its manifest, to be merged by `merge_manifests`.
+
+  Args:
+    path: path to the tfrecord dataset directory.
+    split: name of the split.
+    manifest: a dict with `shard_info` (shard filenames to number of examples), `append`,
+      `split_info` (see `update_split_info`), `types_shapes` (datum types and shapes) and
+      `write_stats` (see `update_write_stats`).
+  """
+  write_json(os.path.join(path, split + MANIFEST_SUFFIX), manifest)
+
+
+def remove_manifest(path: str, split: str) -> None:
+  """Remove the manifest of a split, if any, e.g. left by an earlier run that was not merged."""
+  manifest_path = os.path.join(path, split + MANIFEST_SUFFIX)
+  if tf.io.gfile.exists(manifest_path):
+    tf.io.gfile.remove(manifest_path)
+
+
+def _check_manifest_shards(path: str, manifest: dict[str, Any]) -> list[str]:
+  """Returns the shards of a manifest missing from path, or of another size than written."""
+  digests = manifest["split_info"].get("shards", {})
+  problems = []
+  for filename in manifest["shard_info"]:
+    shard_path = os.path.join(path, filename)
+    if not tf.io.gfile.exists(shard_path):
+      problems.append(filename)
+    elif filename in digests and tf.io.gfile.stat(shard_path).length != digests[filename]["size"]:
+      problems.append(filename)
+  return problems
+
+
+def merge_manifests(path: str, splits: Sequence[str]) -> list[str]:
+  """Merge the manifests of splits into the metadata files of a dataset, and remove them.
+
+  Manifests of other splits, e.g. left by an earlier run, are ignored. A manifest whose shards are
+  missing, or of another size than written, is not merged either and is left in place.
+
+  Args:
+    path: path to the tfrecord dataset directory.
+    splits: names of the splits written, in the order they were started. As when splits are
+      written one after the other, the types and shapes of the last merged split are kept. Splits
+      without manifest, e.g. whose writer failed, are skipped.
+
+  Returns:
+    the names of the merged splits.
+  """
+  shard_info = load_shard_info(path)
+  dataset_info = load_dataset_info(path)
+  types_shapes = None
+  merged = []
+  splits_write_stats = {}
+  for split in splits:
+    manifest_path = os.path.join(path, split + MANIFEST_SUFFIX)
+    if not tf.io.gfile.exists(manifest_path):
+      continue
+    with tf.io.gfile.GFile(manifest_path, "r") as manifest_f:
+      manifest = json.load(manifest_f)
+    problems = _check_manifest_shards(path, manifest)
+    if problems:
+      logging.warning(f"Manifest of split {split} not merged, its shards {problems} are missing "
+                      "or were modified.")
+      continue
+    merge_split_shard_info(shard_info, split, manifest["shard_info"], manifest["append"])
+    merge_split_info(dataset_info, split, manifest["split_info"], manifest["append"])
+    types_shapes = manifest["types_shapes"]
+    splits_write_stats[split] = manifest["write_stats"]
+    merged.append(split)
+  if not merged:
+    return []
+  write_json(os.path.join(path, TYPES_SHAPES_FILENAME), types_shapes)
+  write_json(os.path.join(path, SHARD_INFO_FILENAME), shard_info)
+  write_json(os.path.join(path, DATASET_INFO_FILENAME), dataset_info, indent=2, sort_keys=True)
+  _write_stats_report(path, splits_write_stats)
+  for split in merged:
+    tf.io.gfile.remove(os.path.join(path, split + MANIFEST_SUFFIX))
+  return merged
+
+
+def write_json(path: str, obj: Any, **kwargs: Any) -> None:
+  """Write obj as json to path atomically, readers never see a partially written file.
+
+  Args:
+    path: path of the json file.
+    obj: json serializable object.
+    kwargs: optional keyword arguments of `json.dump`.
+  """
+  tmp_path = path + ".tmp"
+  with tf.io.gfile.GFile(tmp_path, "w") as json_f:
+    json.dump(obj, json_f, **kwargs)
+  tf.io.gfile.rename(tmp_path, path, overwrite=True)
@@ -12,16 +12,46 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import collections
+import hashlib
+import math
+import os
+import zlib
 from collections.abc import Iterator, Sequence
-from typing import Union
+from typing import Any, Optional, Union
 
+import numpy as np
 import tensorflow as tf
 from absl import logging
 
 MIN_SHARD_SIZE = 64 << 20 # 64 MiB
 MAX_SHARD_SIZE = 1024 << 20 # 2 GiB
+ROLLING_SHARD_SIZE = 256 << 20 # 256 MiB, maximum size of a shard written by RollingShardWriter.
 
 TFRECORD_REC_OVERHEAD = 16
+# Offset of the serialized example in a tfrecord record, after its length and the length crc.
+_RECORD_DATA_OFFSET = 12
+
+# Record index of a shard, written next to it as `<shard>.idx`: a little-endian int64 array of
+# shape (num_records, 2) holding the offset in the shard of each record (of its header) and the
+# length of its serialized example.
+INDEX_SUFFIX = ".idx"
+_INDEX_DTYPE = np.dtype("<i8")
+
+# Key index of a shard, written next to it as `<shard>.keys`: an array of (hkey, record) rows
+# sorted by hkey, the 128 bits hash of the example key as 16 big-endian bytes and the position of
+# the example in the shard.
+KEY_INDEX_SUFFIX = ".keys"
+_KEY_INDEX_DTYPE = np.dtype([("hkey", "S16"), ("record", "<i8")])
+
+# Compression types of tfrecord shards, as named by `tf.io.TFRecordOptions`.
+COMPRESSION_GZIP = "GZIP"
+COMPRESSION_ZLIB = "ZLIB"
+COMPRESSION_TYPES = (COMPRESSION_GZIP, COMPRESSION_ZLIB)
+# Size in bytes of the sample of records compressed to estimate the compression ratio of shards.
+COMPRESSION_SAMPLE_SIZE = 1 << 20 # 1 MiB
+
+# Size of the chunks read to compute the digest of a shard.
+DIGEST_CHUNK_SIZE = 8 << 20 # 8 MiB
 
 # Spec to write a final tfrecord shard.
 _ShardSpec = collections.namedtuple(
@@ -48,8 +78,13 @@ def raise_error_for_duplicated_keys(err: Exception) -> None:
   raise AssertionError(msg)
 
 
-def get_shard_specs(num_examples: int, total_size: int, bucket_lengths: Sequence[int],
-                    path: str) -> list[_ShardSpec]:
+def get_shard_specs(num_examples: int,
+                    total_size: int,
+                    bucket_lengths: Sequence[int],
+                    path: str,
+                    shard_size: Optional[int] = None,
+                    min_shards: int = 1,
+                    shards_multiple: int = 1) -> list[_ShardSpec]:
   """Returns list of _ShardSpec instances, corresponding to shards to write.
 
   Args:
@@ -57,11 +92,14 @@ def get_shard_specs(num_examples: int, total_size: int, bucket_lengths: Sequence
     total_size: sum of example sizes.
     bucket_lengths: number of examples in each bucket.
     path: path to store tfrecord files.
+    shard_size: target size in bytes of a shard, see `get_number_shards`.
+    min_shards: minimum number of shards.
+    shards_multiple: the number of shards is rounded up to a multiple of shards_multiple.
 
   Retuns:
     a list of ShardSpec objects,
   """
-  num_shards = _get_number_shards(total_size, num_examples)
+  num_shards = get_number_shards(total_size, num_examples, shard_size, min_shards, shards_multiple)
   shard_boundaries = _get_shard_boundaries(num_examples, num_shards)
   shard_specs = []
   bucket_indexes = list(range(len(bucket_lengths)))
@@ -95,12 +133,345 @@ def _get_shard_boundaries(num_examples: int, number_of_shards: int) -> list[int]
   ]
 
 
-def write_tfrecord(path: str, iterator: Iterator) -> None:
-  """Write single (non sharded) TFrecord file from iterator."""
-  with tf.io.TFRecordWriter(path) as writer:
+def check_compression_type(compression_type: Optional[str]) -> None:
+  """Raise a ValueError if compression_type is not None or one of `COMPRESSION_TYPES`."""
+  if compression_type is not None and compression_type not in COMPRESSION_TYPES:
+    raise ValueError(f"Unsupported tfrecord compression type: {compression_type}, expected one "
+                     f"of {COMPRESSION_TYPES}.")
+
+
+class CompressionRatioEstimator:
+  """Estimates the compression ratio of tfrecord shards from a sample of the first records.
+
+  GZIP and ZLIB tfrecord files are both deflate streams, the ratio is the one of the sample
+  compressed with zlib at the default level, as the TFRecord writer does.
+  """
+
+  def __init__(self, compression_type: Optional[str]):
+    self._compression_type = compression_type
+    self._sample = bytearray()
+    self._ratio = 1.0
+    self._ratio_sample_size = 0
+
+  def add(self, serialized_example: bytes) -> None:
+    """Add a record to the sample, until it reaches `COMPRESSION_SAMPLE_SIZE`."""
+    if self._compression_type and len(self._sample) < COMPRESSION_SAMPLE_SIZE:
+      self._sample += serialized_example
+
+  @property
+  def ratio(self) -> float:
+    """Compressed over uncompressed size of the sample, 1 without compression."""
+    if self._compression_type and self._ratio_sample_size != len(self._sample):
+      self._ratio = len(zlib.compress(self._sample)) / len(self._sample)
+      self._ratio_sample_size = len(self._sample)
+    return self._ratio
+
+
+def write_record_index(path: str, lengths: Sequence[int]) -> None:
+  """Write the record index of the uncompressed tfrecord shard at path.
+
+  Args:
+    path: path of the tfrecord shard, the index is written to `path + INDEX_SUFFIX`.
+    lengths: length of the serialized examples of the shard, in order.
+  """
+  index = np.empty((len(lengths), 2), dtype=_INDEX_DTYPE)
+  index[:, 1] = lengths
+  record_sizes = index[:, 1] + TFRECORD_REC_OVERHEAD
+  index[:, 0] = np.cumsum(record_sizes) - record_sizes
+  with tf.io.gfile.GFile(path + INDEX_SUFFIX, "wb") as index_f:
+    index_f.write(index.tobytes())
+
+
+def read_record_index(path: str) -> np.ndarray:
+  """Returns the record index of the tfrecord shard at path, see `INDEX_SUFFIX`."""
+  with tf.io.gfile.GFile(path + INDEX_SUFFIX, "rb") as index_f:
+    return np.frombuffer(index_f.read(), dtype=_INDEX_DTYPE).reshape(-1, 2)
+
+
+def write_key_index(path: str, hkeys: Sequence[int]) -> None:
+  """Write the key index of the tfrecord shard at path.
+
+  Args:
+    path: path of the tfrecord shard, the index is written to `path + KEY_INDEX_SUFFIX`.
+    hkeys: hashed keys of the examples of the shard, in order.
+  """
+  index = np.empty(len(hkeys), dtype=_KEY_INDEX_DTYPE)
+  index["hkey"] = [hkey.to_bytes(16, "big") for hkey in hkeys]
+  index["record"] = np.arange(len(hkeys))
+  # Examples are usually written in hkey order, the index is then already sorted.
+  index = index[np.argsort(index["hkey"], kind="stable")]
+  with tf.io.gfile.GFile(path + KEY_INDEX_SUFFIX, "wb") as index_f:
+    index_f.write(index.tobytes())
+
+
+def read_key_index(path: str) -> np.ndarray:
+  """Returns the key index of the tfrecord shard at path, see `KEY_INDEX_SUFFIX`."""
+  with tf.io.gfile.GFile(path + KEY_INDEX_SUFFIX, "rb") as index_f:
+    return np.frombuffer(index_f.read(), dtype=_KEY_INDEX_DTYPE)
+
+
+def read_key_index_range(path: str) -> Optional[list[str]]:
+  """Returns the first and last hkeys of the key index of the tfrecord shard at path.
+
+  Only the first and last entries of the key index are read. The range is recorded with the shard
+  digest in the dataset info, as `hkey_range`, so that a lookup only reads the key indexes of the
+  shards whose range holds the hkey.
+
+  Args:
+    path: path of the tfrecord shard.
+
+  Returns:
+    the first and last hkeys as 32 digits hex strings, None if the shard has no examples.
+  """
+  size = tf.io.gfile.stat(path + KEY_INDEX_SUFFIX).length
+  if not size:
+    return None
+  with tf.io.gfile.GFile(path + KEY_INDEX_SUFFIX, "rb") as index_f:
+    first = index_f.read(_KEY_INDEX_DTYPE.itemsize)
+    index_f.seek(size - _KEY_INDEX_DTYPE.itemsize)
+    last = index_f.read(_KEY_INDEX_DTYPE.itemsize)
+  return [first[:16].hex(), last[:16].hex()]
+
+
+def search_key_index(index: np.ndarray, hkey: int) -> int:
+  """Returns the record position of hkey in the sorted key index, -1 if it is not indexed."""
+  target = np.array(hkey.to_bytes(16, "big"), dtype="S16")
+  position = np.searchsorted(index["hkey"], target)
+  if position < len(index) and index["hkey"][position] == target:
+    return int(index["record"][position])
+  return -1
+
+
+def read_records(path: str, offsets_lengths: np.ndarray) -> list[bytes]:
+  """Read serialized examples of the uncompressed tfrecord shard at path, without parsing it.
+
+  Local shards are read with `os.pread`, other filesystems through `tf.io.gfile`.
+
+  Args:
+    path: path of the tfrecord shard.
+    offsets_lengths: rows of the shard record index, see `read_record_index`, of the records to
+      read.
+
+  Returns:
+    the serialized examples, in the order of offsets_lengths.
+  """
+  if "://" in path:
+    records = []
+    with tf.io.gfile.GFile(path, "rb") as shard_f:
+      for offset, length in offsets_lengths:
+        shard_f.seek(int(offset) + _RECORD_DATA_OFFSET)
+        records.append(shard_f.read(int(length)))
+    return records
+  shard_fd = os.open(path, os.O_RDONLY)
+  try:
+    return [
+        os.pread(shard_fd, int(length),
+                 int(offset) + _RECORD_DATA_OFFSET) for offset, length in offsets_lengths
+    ]
+  finally:
+    os.close(shard_fd)
+
+
+def get_shard_digest(path: str, num_examples: int, checksum: bool = True) -> dict[str, Any]:
+  """Returns the digest of the tfrecord shard at path, recorded in the dataset info.
+
+  Args:
+    path: path of the tfrecord shard.
+    num_examples: number of examples written to the shard.
+    checksum: whether to read the shard to compute its sha256 digest, otherwise only the file
+      metadata is read.
+
+  Returns:
+    a dict with the `num_examples`, the `size` in bytes and, with checksum, the `sha256` hex
+    digest of the shard.
+  """
+  if not checksum:
+    return {"num_examples": num_examples, "size": tf.io.gfile.stat(path).length}
+  sha256 = hashlib.sha256()
+  size = 0
+  with tf.io.gfile.GFile(path, "rb") as shard_f:
+    while chunk := shard_f.read(DIGEST_CHUNK_SIZE):
+      sha256.update(chunk)
+      size += len(chunk)
+  return {"num_examples": num_examples, "size": size, "sha256": sha256.hexdigest()}
+
+
+def write_tfrecord(path: str,
+                   iterator: Iterator,
+                   compression_type: Optional[str] = None,
+                   write_index: bool = False,
+                   checksum: bool = False) -> dict[str, Any]:
+  """Write single (non sharded) TFrecord file from iterator.
+
+  Serialized examples can be bytes, or memoryview slices of memory-mapped cache files, which are
+  copied to bytes one at a time, as required by the TFRecord writer binding.
+
+  Args:
+    path: path of the tfrecord file.
+    iterator: iterator of serialized examples.
+    compression_type: None, `GZIP` or `ZLIB`.
+    write_index: whether to write the record index of the file, see `write_record_index`. Only
+      supported for uncompressed files.
+    checksum: whether to compute the sha256 digest of the file. The file is then read back once
+      written, while it is likely still in the page cache.
+
+  Returns:
+    the digest of the file, see `get_shard_digest`.
+  """
+  lengths = []
+  num_examples = 0
+  with tf.io.TFRecordWriter(path, options=compression_type) as writer:
     for serialized_example in iterator:
+      if isinstance(serialized_example, memoryview):
+        # The TFRecord writer binding only accepts bytes.
+        serialized_example = serialized_example.tobytes()
       writer.write(serialized_example)
+      num_examples += 1
+      if write_index:
+        lengths.append(len(serialized_example))
     writer.flush()
+  if write_index:
+    write_record_index(path, lengths)
+  return get_shard_digest(path, num_examples, checksum)
+
+
+class RollingShardWriter:
+  """Writes examples to shards of bounded size, as they are generated.
+
+  A new shard is started when the current one would exceed max_shard_size. The number of shards is
+  only known once all the examples are written, shards are thus written to temporary files which
+  are renamed to `<path>-xxxxx-of-yyyyy.tfrecord` by `close`. The size of compressed shards is
+  estimated from the compression ratio of the first records.
+  """
+
+  def __init__(self,
+               path: str,
+               max_shard_size: Optional[int] = None,
+               compression_type: Optional[str] = None,
+               write_index: bool = False,
+               write_key_index: bool = False,
+               checksum: bool = False):
+    """Initialize RollingShardWriter.
+
+    Args:
+      path: path prefix of the shards.
+      max_shard_size: maximum size in bytes of a shard, a shard holds at least one example,
+        defaults to `ROLLING_SHARD_SIZE`.
+      compression_type: None, `GZIP` or `ZLIB`.
+      write_index: whether to write the record index of the shards, see `write_record_index`.
+      write_key_index: whether to write the key index of the shards, see `write_key_index`.
+      checksum: whether to compute the sha256 digest of the shards, see `get_shard_digest`.
+    """
+    self._path = path
+    self._checksum = checksum
+    self._write_index = write_index
+    self._write_key_index = write_key_index
+    self._lengths: list[list[int]] = []
+    self._hkeys: list[list[int]] = []
+    self._max_shard_size = ROLLING_SHARD_SIZE if max_shard_size is None else max_shard_size
+    self._compression_type = compression_type
+    self._compression_ratio = CompressionRatioEstimator(compression_type)
+    self._writer = None
+    self._shard_size = 0
+    self._shard_lengths: list[int] = []
+    # Digests of the shards, by shard filename, set by `close`.
+    self.digests: dict[str, dict[str, Any]] = {}
+
+  def _tmp_path(self, shard_index: int) -> str:
+    return "%s-%05d.tfrecord.tmp" % (self._path, shard_index)
+
+  def write(self, serialized_example: bytes, hkey: Optional[int] = None) -> None:
+    """Write a serialized example to the current shard, starting a new shard if needed.
+
+    Args:
+      serialized_example: the serialized example.
+      hkey: hash of the example key, required to write the key index.
+    """
+    size = len(serialized_example) + TFRECORD_REC_OVERHEAD
+    self._compression_ratio.add(serialized_example)
+    shard_size = self._shard_size + size
+    # The compression ratio is only estimated once the shard is too large uncompressed.
+    if self._writer is None or (shard_size > self._max_shard_size and self._shard_lengths[-1] and
+                                shard_size * self._compression_ratio.ratio > self._max_shard_size):
+      self._roll()
+    self._writer.write(serialized_example)
+    self._shard_size += size
+    self._shard_lengths[-1] += 1
+    if self._write_index:
+      self._lengths[-1].append(len(serialized_example))
+    if self._write_key_index:
+      self._hkeys[-1].append(hkey)
+
+  def _roll(self) -> None:
+    if self._writer is not None:
+      self._writer.close()
+    self._writer = tf.io.TFRecordWriter(self._tmp_path(len(self._shard_lengths)),
+                                        options=self._compression_type)
+    self._shard_size = 0
+    self._shard_lengths.append(0)
+    self._lengths.append([])
+    self._hkeys.append([])
+
+  def close(self) -> dict[str, int]:
+    """Close the current shard and rename the shards.
+
+    Returns:
+      a dict with shard filenames as keys and their number of examples as values.
+    """
+    if self._writer is None:
+      raise AssertionError("No examples were yielded.")
+    self._writer.close()
+    self._writer = None
+    num_shards = len(self._shard_lengths)
+    shard_info = {}
+    for shard_index, length in enumerate(self._shard_lengths):
+      path = "%s-%05d-of-%05d.tfrecord" % (self._path, shard_index, num_shards)
+      tf.io.gfile.rename(self._tmp_path(shard_index), path, overwrite=True)
+      if self._write_index:
+        write_record_index(path, self._lengths[shard_index])
+      shard_info[os.path.basename(path)] = length
+      self.digests[os.path.basename(path)] = get_shard_digest(path, length, self._checksum)
+      if self._write_key_index:
+        write_key_index(path, self._hkeys[shard_index])
+        self.digests[os.path.basename(path)]["hkey_range"] = read_key_index_range(path)
+    return shard_info
+
+
+def get_number_shards(total_size: int,
+                      num_examples: int,
+                      shard_size: Optional[int] = None,
+                      min_shards: int = 1,
+                      shards_multiple: int = 1) -> int:
+  """Returns number of shards for num_examples of total_size in bytes, given sharding targets.
+
+  The number of shards is total_size / shard_size, or the power of two chosen by
+  `_get_number_shards` without shard_size. It is then raised to min_shards, and rounded up to a
+  multiple of shards_multiple (e.g. the number of hosts reading the dataset) so that shards can
+  be evenly split among readers. Every shard holds at least one example: with fewer examples, it
+  is the largest multiple of shards_multiple not greater than num_examples, or num_examples.
+
+  Args:
+    total_size: the size of the data (serialized, not couting any overhead).
+    num_examples: the number of records in the data.
+    shard_size: target size in bytes of a shard.
+    min_shards: minimum number of shards.
+    shards_multiple: the number of shards is rounded up to a multiple of shards_multiple.
+
+  Returns:
+    number of shards to use.
+  """
+  if min_shards < 1 or shards_multiple < 1 or (shard_size is not None and shard_size <= 0):
+    raise ValueError(f"Invalid sharding targets: shard_size={shard_size}, min_shards={min_shards}, "
+                     f"shards_multiple={shards_multiple}.")
+  if shard_size is None:
+    num_shards = _get_number_shards(total_size, num_examples)
+  else:
+    num_shards = math.ceil((total_size + num_examples * TFRECORD_REC_OVERHEAD) / shard_size)
+  num_shards = max(num_shards, min_shards)
+  num_shards = math.ceil(num_shards / shards_multiple) * shards_multiple
+  if num_shards > num_examples:
+    num_shards = num_examples // shards_multiple * shards_multiple or num_examples
+  return max(num_shards, 1)
 
 
 def _get_number_shards(total_size: int, num_examples: int) -> int:
@@ -0,0 +1,125 @@
+# Copyright 2020 The OpenAGI Datum Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Timers and counters of the stages of the tfrecord write pipeline, see `WriteStats`."""
+
+import dataclasses
+import time
+from typing import Any, Optional
+
+from absl import logging
+
+# Stages of the write pipeline, in pipeline order.
+STAGE_GENERATE = "generate" # Examples yielded by the generator.
+STAGE_ENCODE = "encode" # Features encoded by the `DatumSerializer` encoders.
+STAGE_SERIALIZE = "serialize" # `tf.train.Example` built and serialized.
+STAGE_HASH = "hash" # Example keys hashed.
+STAGE_CACHE = "cache" # Examples added to the shuffler, including writing spill files.
+STAGE_WRITE = "write" # Examples written to tfrecord shards.
+STAGES = (STAGE_GENERATE, STAGE_ENCODE, STAGE_SERIALIZE, STAGE_HASH, STAGE_CACHE, STAGE_WRITE)
+
+
+def _per_second(value: float, seconds: float) -> float:
+  return value / seconds if seconds > 0 else 0.0
+
+
+@dataclasses.dataclass
+class StageStats:
+  """Time spent in a stage, and the number of examples and bytes it processed."""
+  seconds: float = 0.0
+  count: int = 0
+  bytes: int = 0
+
+  def to_dict(self) -> dict[str, Any]:
+    return {
+        "seconds": self.seconds,
+        "count": self.count,
+        "bytes": self.bytes,
+        "examples_per_second": _per_second(self.count, self.seconds),
+        "bytes_per_second": _per_second(self.bytes, self.seconds),
+    }
+
+
+class WriteStats:
+  """Stage-level timers and counters of a `TFRecordWriter` run.
+
+  Stages are timed around each call in the writer process. Examples serialized by worker
+  processes are timed in the workers, the time of these stages is then the sum of the time spent
+  by every worker, and can exceed the wall time of the run.
+  """
+
+  def __init__(self):
+    self.stages: dict[str, StageStats] = {}
+    self.examples = 0
+    self.bytes = 0
+    self.spill_bytes = 0
+    self.peak_buffer_size = 0
+    self._start = time.perf_counter()
+    self._seconds: Optional[float] = None
+
+  @property
+  def seconds(self) -> float:
+    """Wall time of the run, until `stop` is called."""
+    if self._seconds is None:
+      return time.perf_counter() - self._start
+    return self._seconds
+
+  def add(self, stage: str, seconds: float, count: int = 1, nbytes: int = 0) -> None:
+    """Add the time spent in a stage processing count examples of nbytes bytes."""
+    stage_stats = self.stages.get(stage)
+    if stage_stats is None:
+      stage_stats = self.stages[stage] = StageStats()
+    stage_stats.seconds += seconds
+    stage_stats.count += count
+    stage_stats.bytes += nbytes
+
+  def merge(self, other: "WriteStats") -> None:
+    """Add the stage stats of other, e.g. the stats of a worker process."""
+    for stage, stage_stats in other.stages.items():
+      self.add(stage, stage_stats.seconds, stage_stats.count, stage_stats.bytes)
+
+  def stop(self) -> None:
+    """Stops the wall time of the run."""
+    self._seconds = time.perf_counter() - self._start
+
+  def to_dict(self) -> dict[str, Any]:
+    """Returns the stats as a JSON serializable dict, stages in pipeline order."""
+    seconds = self.seconds
+    ordered_stages = sorted(self.stages,
+                            key=lambda stage: STAGES.index(stage)
+                            if stage in STAGES else len(STAGES))
+    return {
+        "examples": self.examples,
+        "bytes": self.bytes,
+        "seconds": seconds,
+        "examples_per_second": _per_second(self.examples, seconds),
+        "bytes_per_second": _per_second(self.bytes, seconds),
+        "spill_bytes": self.spill_bytes,
+        "peak_buffer_size": self.peak_buffer_size,
+        "stages": {
+            stage: self.stages[stage].to_dict()
+            for stage in ordered_stages
+        },
+    }
+
+  def log(self) -> None:
+    """Logs a summary of the stats."""
+    stats = self.to_dict()
+    logging.info(f"Wrote {stats['examples']} examples ({stats['bytes']} bytes) in "
+                 f"{stats['seconds']:.2f}s, {stats['examples_per_second']:.1f} examples/s, "
+                 f"spilled {stats['spill_bytes']} bytes, peak buffer size "
+                 f"{stats['peak_buffer_size']} bytes.")
+    for stage, stage_stats in stats["stages"].items():
+      logging.info(f"  {stage}: {stage_stats['seconds']:.2f}s, "
+                   f"{stage_stats['examples_per_second']:.1f} examples/s, "
+                   f"{stage_stats['bytes_per_second'] / (1 << 20):.1f} MB/s.")
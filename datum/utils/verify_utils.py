@@ -0,0 +1,149 @@
+# Copyright 2020 The OpenAGI Datum Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Integrity verification of tfrecord datasets, against the shard digests of the dataset info.
+
+The writer records the number of examples, size and, with write_checksums, sha256 digest of each
+shard in the dataset info, see `shard_utils.get_shard_digest`. Shards are verified in one of two
+modes:
+ - `cheap`: shard sizes, and record indexes when written, are checked against the dataset info.
+   Only the file metadata and indexes are read, truncated and missing shards are detected.
+ - `full`: in addition, shards are read to check their sha256 digest if recorded, the CRCs and
+   number of their records.
+Datasets written before digests were introduced can only be verified in `full` mode, against the
+number of examples of their shard info.
+"""
+
+import multiprocessing
+import os
+from collections.abc import Sequence
+from typing import Any, Optional
+
+import tensorflow as tf
+from absl import logging
+
+from datum.utils import info_utils, shard_utils
+
+VERIFY_CHEAP = "cheap"
+VERIFY_FULL = "full"
+
+# Arguments of `verify_shard`.
+_VerifyTask = tuple[str, int, Optional[dict[str, Any]], Optional[str], bool, str]
+
+
+def _count_records(path: str, compression_type: Optional[str]) -> int:
+  """Returns the number of records of a tfrecord file, CRCs are checked while reading it."""
+  dataset = tf.data.TFRecordDataset(path, compression_type=compression_type or "")
+  return int(dataset.reduce(0, lambda count, _: count + 1))
+
+
+def verify_shard(path: str,
+                 num_examples: int,
+                 digest: Optional[dict[str, Any]] = None,
+                 compression_type: Optional[str] = None,
+                 record_index: bool = False,
+                 mode: str = VERIFY_CHEAP) -> list[str]:
+  """Verify a tfrecord shard.
+
+  Args:
+    path: path of the tfrecord shard.
+    num_examples: number of examples of the shard, from the shard info.
+    digest: digest of the shard recorded in the dataset info, if any.
+    compression_type: compression type of the shard, None, `GZIP` or `ZLIB`.
+    record_index: whether the shard was written with a record index.
+    mode: `cheap` or `full`, see module docstring.
+
+  Returns:
+    the problems found, empty if the shard is valid.
+  """
+  if not tf.io.gfile.exists(path):
+    return ["missing shard"]
+  problems = []
+  size = tf.io.gfile.stat(path).length
+  if digest:
+    if digest["num_examples"] != num_examples:
+      problems.append(f"{digest['num_examples']} examples written, {num_examples} in shard info")
+    if size != digest["size"]:
+      problems.append(f"size is {size} bytes, {digest['size']} bytes written" +
+                      (" (truncated)" if size < digest["size"] else ""))
+  if record_index:
+    if not tf.io.gfile.exists(path + shard_utils.INDEX_SUFFIX):
+      problems.append("missing record index")
+    else:
+      index = shard_utils.read_record_index(path)
+      end = int(index[-1].sum()) + shard_utils.TFRECORD_REC_OVERHEAD if len(index) else 0
+      if len(index) != num_examples or end != size:
+        problems.append(f"record index of {len(index)} records ending at byte {end} does not "
+                        "match the shard")
+  if mode == VERIFY_CHEAP:
+    return problems
+  if digest and "sha256" in digest and shard_utils.get_shard_digest(
+      path, num_examples)["sha256"] != digest["sha256"]:
+    problems.append("sha256 digest mismatch")
+  try:
+    num_records = _count_records(path, compression_type)
+  except tf.errors.DataLossError as err:
+    problems.append(f"corrupted records: {err.message}")
+  else:
+    if num_records != num_examples:
+      problems.append(f"{num_records} records read, {num_examples} examples expected")
+  return problems
+
+
+def _verify_shard_task(task: _VerifyTask) -> tuple[str, list[str]]:
+  return os.path.basename(task[0]), verify_shard(*task)
+
+
+def verify_dataset(path: str,
+                   mode: str = VERIFY_CHEAP,
+                   splits: Optional[Sequence[str]] = None,
+                   num_workers: int = 1) -> dict[str, list[str]]:
+  """Verify the shards of a tfrecord dataset against its metadata.
+
+  Args:
+    path: path to the tfrecord dataset directory.
+    mode: `cheap` or `full`, see module docstring.
+    splits: names of the splits to verify, defaults to all the splits.
+    num_workers: number of processes verifying shards concurrently.
+
+  Returns:
+    the problems found, by shard filename, for the shards which are not valid only.
+
+  Raises:
+    ValueError: if the mode is not supported or a split does not exist.
+  """
+  if mode not in (VERIFY_CHEAP, VERIFY_FULL):
+    raise ValueError(f"Unsupported verification mode: {mode}.")
+  shard_info = info_utils.load_shard_info(path)
+  dataset_info = info_utils.load_dataset_info(path)
+  splits = list(shard_info) if splits is None else splits
+  tasks: list[_VerifyTask] = []
+  for split in splits:
+    if split not in shard_info:
+      raise ValueError(f"Split {split} not found in {path}.")
+    split_info = dataset_info.get(split, {})
+    digests = split_info.get("shards", {})
+    if not digests and mode == VERIFY_CHEAP:
+      logging.warning(f"Split {split} has no shard digests, only its record indexes, if any, are "
+                      "verified, use the full mode.")
+    for filename, num_examples in shard_info[split].items():
+      tasks.append((os.path.join(path, filename), num_examples, digests.get(filename),
+                    split_info.get("compression_type"), split_info.get("record_index", False), mode))
+  logging.info(f"Verifying {len(tasks)} shards of {path} in {mode} mode.")
+  if num_workers > 1:
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(min(num_workers, len(tasks)) or 1) as pool:
+      results = list(pool.imap_unordered(_verify_shard_task, tasks))
+  else:
+    results = [_verify_shard_task(task) for task in tasks]
+  return {filename: problems for filename, problems in sorted(results) if problems}
@@ -0,0 +1,45 @@
+# Copyright 2020 The OpenAGI Datum Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Any
+
+from absl import app, flags, logging
+
+from datum.utils.verify_utils import VERIFY_CHEAP, VERIFY_FULL, verify_dataset
+
+flags.DEFINE_string('path', None, 'Path to the tfrecord dataset to verify.')
+flags.DEFINE_enum('mode', VERIFY_CHEAP, [VERIFY_CHEAP, VERIFY_FULL],
+                  'Check shard sizes and counts (cheap), or also digests and record CRCs (full).')
+flags.DEFINE_string('splits', None,
+                    'Single split name or comma seperated multiple split names to verify.')
+flags.DEFINE_integer('num_workers', 1, 'Number of processes verifying shards concurrently.')
+FLAGS = flags.FLAGS
+
+
+def main(_: Any) -> int:
+  splits = FLAGS.splits.split(',') if FLAGS.splits else None
+  problems = verify_dataset(FLAGS.path, FLAGS.mode, splits, FLAGS.num_workers)
+  for filename, shard_problems in problems.items():
+    logging.error(f'Invalid shard {filename}: {"; ".join(shard_problems)}.')
+  if problems:
+    logging.error(f'{len(problems)} invalid shards in {FLAGS.path}.')
+    return 1
+  logging.info(f'All shards of {FLAGS.path} are valid.')
+  return 0
+
+
+if __name__ == '__main__':
+  logging.set_verbosity(logging.INFO)
+  flags.mark_flag_as_required('path')
+  app.run(main)
@@ -12,21 +12,221 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import concurrent.futures
+import hashlib
 import json
+import multiprocessing
+import multiprocessing.pool
 import os
-from itertools import islice
+import re
+import time
+from collections.abc import Iterable, Iterator, Sequence
+from itertools import chain, islice
 from typing import Any, Callable, Optional
 
 import numpy as np
 import tensorflow as tf
 from absl import logging
 
-from datum.cache.bucket import DuplicatedKeysError, Shuffler
-from datum.utils import shard_utils
+from datum.cache.bucket import (SPILL_BUCKETS, DuplicatedKeysError, Shuffler, SpillCodec,
+                                WindowShuffler, get_bucket_range, iter_sorted_bucket_file)
+from datum.serializer.serializer import DatumSerializer
+from datum.utils import info_utils, shard_utils
 from datum.utils.common_utils import datum_to_type_and_shape
+from datum.utils.hashing import HASH_MD5, Hasher
+from datum.utils.stats_utils import (STAGE_CACHE, STAGE_ENCODE, STAGE_GENERATE, STAGE_HASH,
+                                     STAGE_SERIALIZE, STAGE_WRITE, WriteStats)
 from datum.utils.tqdm_utils import tqdm
 from datum.utils.types_utils import DatumType
 
+# Number of examples sent to a serialization worker in a single task.
+SERIALIZE_CHUNK_SIZE = 32
+
+# Minimum time in seconds between two checkpoints of a resumable writer.
+CHECKPOINT_INTERVAL = 600
+
+# Write modes: examples are fully shuffled (default), shuffled within a bounded window, or
+# written in generation order.
+SHUFFLE_FULL = "full"
+SHUFFLE_WINDOW = "window"
+SHUFFLE_NONE = "none"
+
+# Serializer and hasher of the current serialization worker process, set by the pool initializer.
+_WORKER_CONTEXT: dict[str, Any] = {}
+
+
+def _init_serialization_worker(serializer: Callable, hash_salt: str, hash_fn: str) -> None:
+  """Initialize a serialization worker process."""
+  _WORKER_CONTEXT["serializer"] = serializer
+  _WORKER_CONTEXT["hasher"] = Hasher(hash_salt, hash_fn)
+
+
+def _serialize(serializer: Callable, datum: DatumType, stats: WriteStats) -> bytes:
+  """Serialize a datum, the encoding of a `DatumSerializer` is timed as a separate stage."""
+  start = time.perf_counter()
+  if isinstance(serializer, DatumSerializer):
+    datum = serializer.encode(datum)
+    encoded = time.perf_counter()
+    stats.add(STAGE_ENCODE, encoded - start)
+    serialized = serializer.serializer(datum)
+    start = encoded
+  else:
+    serialized = serializer(datum)
+  stats.add(STAGE_SERIALIZE, time.perf_counter() - start, nbytes=len(serialized))
+  return serialized
+
+
+def _timed(iterable: Iterable, stats: WriteStats, stage: str) -> Iterator:
+  """Yields the elements of iterable, the time spent computing them is added to stage."""
+  iterator = iter(iterable)
+  while True:
+    start = time.perf_counter()
+    try:
+      element = next(iterator)
+    except StopIteration:
+      return
+    stats.add(stage, time.perf_counter() - start)
+    yield element
+
+
+def _serialize_chunk(
+    chunk: list[tuple[Any, DatumType]]) -> tuple[list[tuple[int, bytes]], WriteStats]:
+  """Returns (hkey, serialized example) tuples for a chunk of (key, datum) tuples, and the
+  stats of the chunk."""
+  serializer = _WORKER_CONTEXT["serializer"]
+  hasher = _WORKER_CONTEXT["hasher"]
+  stats = WriteStats()
+  start = time.perf_counter()
+  hkeys = hasher.hash_keys([key for key, _ in chunk])
+  stats.add(STAGE_HASH, time.perf_counter() - start, count=len(chunk))
+  records = [(hkey, _serialize(serializer, datum, stats)) for hkey, (_, datum) in zip(hkeys, chunk)]
+  return records, stats
+
+
+def _iter_sorted_bucket_slice(
+    instruction: dict[str, Any],
+    codec: Optional[SpillCodec] = None) -> Iterator[Sequence[tuple[int, bytes]]]:
+  """Yields the sorted (hkey, data) records of a bucket file slice, as sorted sequences.
+
+  Args:
+    instruction: a dict with the `bucket_file` to read, its `hkey_range` and `max_bucket_size` (see
+      `iter_sorted_bucket_file`), the number of records to `skip` and to `take` (-1 to take all
+      remaining records) once sorted.
+    codec: codec the bucket file is compressed with, if any.
+
+  Raises:
+    DuplicatedKeysError: if the first record of the slice shares its hkey with the previous record
+      of the bucket, which is written by another shard.
+  """
+  skip, take = instruction["skip"], instruction["take"]
+  stop = None if take == -1 else skip + take
+  index = 0 # Index in the sorted bucket of the first record of records.
+  previous_record = None # Last record of the previous records list.
+  for records in iter_sorted_bucket_file(instruction["bucket_file"], instruction["hkey_range"],
+                                         instruction["max_bucket_size"], codec):
+    if skip and index <= skip < index + len(records):
+      before = records[skip - index - 1] if skip > index else previous_record
+      if before[0] == records[skip - index][0]:
+        raise DuplicatedKeysError(records[skip - index][1], before[1])
+    start = max(skip - index, 0)
+    end = len(records) if stop is None else min(stop - index, len(records))
+    if start < end:
+      yield records[start:end]
+    index += len(records)
+    previous_record = records[-1]
+    if stop is not None and index >= stop:
+      return
+
+
+def _prefetch(iterator: Iterator) -> Iterator:
+  """Yields the elements of iterator, computing the next one in a background thread."""
+  end = object()
+  with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+    next_element = executor.submit(next, iterator, end)
+    while True:
+      element = next_element.result()
+      if element is end:
+        return
+      next_element = executor.submit(next, iterator, end)
+      yield element
+
+
+def _iter_records_data(records: Iterable[tuple[int, bytes]],
+                       hkeys: Optional[list[int]] = None) -> Iterator[bytes]:
+  """Yields the data of (hkey, data) records, appending their hkey to hkeys if not None."""
+  for hkey, data in records:
+    if hkeys is not None:
+      hkeys.append(hkey)
+    yield data
+
+
+def _write_shard_from_buckets(path: str,
+                              instructions: list[dict[str, Any]],
+                              spill_compression: Optional[str] = None,
+                              compression_type: Optional[str] = None,
+                              write_index: bool = False,
+                              write_key_index: bool = False,
+                              checksum: bool = False) -> tuple[dict[str, Any], int, float]:
+  """Write a single tfrecord shard from slices of bucket files.
+
+  The next bucket slice is read and sorted in a background thread, while the current one is
+  written.
+
+  Args:
+    path: path of the tfrecord shard to write.
+    instructions: bucket file slices to write, see `_iter_sorted_bucket_slice`.
+    spill_compression: codec the bucket files are compressed with, if any.
+    compression_type: compression type of the tfrecord shard, None, `GZIP` or `ZLIB`.
+    write_index: whether to write the record index of the shard.
+    write_key_index: whether to write the key index of the shard.
+    checksum: whether to compute the sha256 digest of the shard.
+
+  Returns:
+    the digest of the shard (see `shard_utils.get_shard_digest`), the number of bytes decompressed
+    and the time spent decompressing them, in seconds.
+  """
+  codec = SpillCodec(spill_compression) if spill_compression else None
+
+  def iter_records() -> Iterator[tuple[int, bytes]]:
+    slices = chain.from_iterable(
+        _iter_sorted_bucket_slice(instruction, codec) for instruction in instructions)
+    previous_hkey, previous_data = None, None
+    for records in _prefetch(slices):
+      for hkey, data in records:
+        if hkey == previous_hkey:
+          raise DuplicatedKeysError(data, previous_data)
+        previous_hkey, previous_data = hkey, data
+        yield hkey, data
+
+  hkeys = [] if write_key_index else None
+  digest = shard_utils.write_tfrecord(path, _iter_records_data(iter_records(), hkeys),
+                                      compression_type, write_index, checksum)
+  if hkeys is not None:
+    shard_utils.write_key_index(path, hkeys)
+    digest["hkey_range"] = shard_utils.read_key_index_range(path)
+  if not codec:
+    return digest, 0, 0.0
+  return digest, codec.raw_bytes_read, codec.decompress_seconds
+
+
+# Arguments of `_write_shard_from_buckets`.
+_ShardTask = tuple[str, list[dict[str, Any]], Optional[str], Optional[str], bool, bool, bool]
+
+
+def _write_shard_from_buckets_task(task: _ShardTask) -> tuple[str, dict[str, Any], int, float]:
+  return (task[0], *_write_shard_from_buckets(*task))
+
+
+def _chunked(iterable: Iterable, size: int) -> Iterator[list]:
+  """Yields successive lists of at most size elements from iterable."""
+  iterator = iter(iterable)
+  while True:
+    chunk = list(islice(iterator, size))
+    if not chunk:
+      return
+    yield chunk
+
 
 class TFRecordWriter():
   """TFRecord writer interface.
@@ -41,6 +241,63 @@ class TFRecordWriter():
     path: absolute path to store the tfrecords data and metadata.
     split: name of the split.
     total_examples: number of examples to write.
+    sparse_features: optional list of sparse features name.
+    num_workers: number of processes used to serialize and hash examples, when greater than 1
+      the serializer must be picklable.
+    flush_workers: number of processes used to write tfrecord shards, used only when the cached
+      examples have been spilled to disk buckets.
+    spill_strategy: how the cache writes examples to disk when they do not fit in memory, either
+      `buckets` (hash partitioning) or `runs` (sorted runs merged at flush time).
+    memory_budget: size in bytes of the examples held in memory before they are written to disk,
+      defaults to `bucket.MAX_MEM_BUFFER_SIZE`.
+    buckets_number: number of buckets used by the `buckets` spill strategy, defaults to a number
+      derived from total_examples and the size of the first examples.
+    hash_fn: name of the hash function used to shuffle examples, `md5` (default) or `blake2b`.
+      It is recorded in the dataset info.
+    detect_duplicates: whether to check example keys are unique as examples are cached, so that
+      a duplicated key is reported as soon as it is generated instead of when writing shards.
+    spill_compression: codec to compress the cache files with when examples do not fit in memory,
+      `zlib` or `lzma`, defaults to no compression.
+    spill_compression_level: compression level of spill_compression.
+    resume: whether to checkpoint the progress of the writer, and to resume from the last
+      checkpoint of a previous run if any. The cached examples, number of examples generated and
+      shards written are checkpointed, the generator is then assumed to be deterministic: on resume
+      the examples generated before the checkpoint are skipped (neither serialized nor cached).
+      Examples are only checkpointed once written to disk, a split held in memory is generated
+      again.
+    checkpoint_interval: minimum time in seconds between two checkpoints, used with resume.
+    append: whether to append the generated examples to an existing split, instead of writing
+      the split. The examples are shuffled and written as additional shards named
+      `<split>-appendNNN-xxxxx-of-yyyyy.tfrecord`, existing shards are left untouched. The keys
+      of the appended examples are not checked against the keys of the existing examples.
+    shuffle: how examples are shuffled, `full` (default) to shuffle the whole split, `window` to
+      shuffle examples within a window of memory_budget bytes, or `none` to keep the generator
+      order. With `window` and `none`, examples are written to shards of at most
+      `shard_utils.ROLLING_SHARD_SIZE` bytes as they are generated, nothing is written to disk
+      but the shards, and duplicated keys are not detected (`none`) or only within the window.
+    compression_type: compression type of the tfrecord shards, `GZIP` or `ZLIB`, defaults to no
+      compression. It is recorded in the dataset info, the number of shards is derived from the
+      compressed size of the examples, estimated by compressing the first examples.
+    shard_size: target size in bytes of a shard, defaults to a power of two number of shards
+      between `shard_utils.MIN_SHARD_SIZE` and `shard_utils.MAX_SHARD_SIZE` bytes. With `window`
+      and `none` shuffle modes, the maximum size of a shard (`shard_utils.ROLLING_SHARD_SIZE`).
+    min_shards: minimum number of shards, e.g. to read small datasets with parallel interleave.
+    shards_multiple: the number of shards is rounded up to a multiple of shards_multiple, e.g. the
+      number of hosts reading the dataset. min_shards and shards_multiple are not supported by the
+      `window` and `none` shuffle modes. The number of shards and the targets are recorded in the
+      dataset info.
+    write_index: whether to write the record index of each shard next to it, as
+      `<shard>.idx`, see `shard_utils.write_record_index`. Not supported with compression_type.
+      It is recorded in the dataset info.
+    write_key_index: whether to write the key index of each shard next to it, as `<shard>.keys`,
+      to find examples by key with `Dataset.lookup`, see `shard_utils.write_key_index`. Requires
+      write_index. It is recorded in the dataset info.
+    write_checksums: whether to record the sha256 digest of each shard in the dataset info, to
+      verify the shards contents, see `verify_utils`. Shards are then read back once written,
+      which doubles the I/O of the write stage. Their size is recorded in any case.
+    merge_metadata: whether to merge the metadata of the split into the dataset metadata files,
+      when False it is written to a split manifest instead, see `create_records_concurrently`.
+      The stats of the run (`stats`) are written to `write_stats.json` with the metadata.
     gen_kwargs: optional keyword arguments to used when calling geenrator.
   """
 
@@ -51,44 +308,369 @@ class TFRecordWriter():
                split: str,
                total_examples: int,
                sparse_features: Optional[list[str]] = None,
+               num_workers: int = 1,
+               flush_workers: int = 1,
+               spill_strategy: str = SPILL_BUCKETS,
+               memory_budget: Optional[int] = None,
+               buckets_number: Optional[int] = None,
+               hash_fn: str = HASH_MD5,
+               detect_duplicates: bool = False,
+               spill_compression: Optional[str] = None,
+               spill_compression_level: Optional[int] = None,
+               resume: bool = False,
+               checkpoint_interval: float = CHECKPOINT_INTERVAL,
+               append: bool = False,
+               shuffle: str = SHUFFLE_FULL,
+               compression_type: Optional[str] = None,
+               shard_size: Optional[int] = None,
+               min_shards: int = 1,
+               shards_multiple: int = 1,
+               write_index: bool = False,
+               write_key_index: bool = False,
+               write_checksums: bool = False,
+               merge_metadata: bool = True,
                **gen_kwargs: Any):
     """Path = /tmp/test/ split = train/val/test."""
+    if shuffle not in (SHUFFLE_FULL, SHUFFLE_WINDOW, SHUFFLE_NONE):
+      raise ValueError(f"Unsupported shuffle mode: {shuffle}.")
+    if resume and shuffle != SHUFFLE_FULL:
+      raise ValueError(f"Resume is not supported with shuffle mode {shuffle}.")
+    shard_utils.check_compression_type(compression_type)
+    if write_index and compression_type:
+      raise ValueError("Record indexes are not supported for compressed shards.")
+    if write_key_index and not write_index:
+      raise ValueError("Key indexes require the record indexes, set write_index.")
+    if shuffle != SHUFFLE_FULL and (min_shards > 1 or shards_multiple > 1):
+      raise ValueError(f"min_shards and shards_multiple are not supported with shuffle mode "
+                       f"{shuffle}, the number of shards is not known in advance.")
     self.generator = generator
     self.serializer = serializer
-    self.shuffler = Shuffler(os.path.dirname(path), split)
+    self.shuffle = shuffle
+    self.hash_fn = hash_fn
+    self.compression_type = compression_type
+    self.shard_size = shard_size
+    self.min_shards = min_shards
+    self.shards_multiple = shards_multiple
+    self.write_index = write_index
+    self.write_key_index = write_key_index
+    self.write_checksums = write_checksums
+    self.merge_metadata = merge_metadata
+    self._types_shapes: Optional[dict[str, Any]] = None
+    self._compression_ratio = shard_utils.CompressionRatioEstimator(compression_type)
+    # A resumable writer gets the same cache files names from one run to the next.
+    shuffler_name = None
+    if resume:
+      path_hash = hashlib.md5(os.path.abspath(path).encode("utf-8")).hexdigest()[:12]
+      shuffler_name = f"{split}_{path_hash}"
+    self.shuffler: Optional[Shuffler] = None
+    self.window_shuffler: Optional[WindowShuffler] = None
+    if shuffle == SHUFFLE_FULL:
+      self.shuffler = Shuffler(os.path.dirname(path),
+                               split,
+                               spill_strategy=spill_strategy,
+                               memory_budget=memory_budget,
+                               buckets_number=buckets_number,
+                               total_examples=total_examples,
+                               hash_fn=hash_fn,
+                               detect_duplicates=detect_duplicates,
+                               spill_compression=spill_compression,
+                               spill_compression_level=spill_compression_level,
+                               name=shuffler_name)
+    elif shuffle == SHUFFLE_WINDOW:
+      self.window_shuffler = WindowShuffler(split, memory_budget=memory_budget, hash_fn=hash_fn)
+    # Hashes the keys of streamed examples, with the salt of the shufflers.
+    self._hasher = Hasher(split, hash_fn)
     self._base_path = path
-    self.path = os.path.join(path, split)
     self.current_examples = 0
     self.total_examples = total_examples
     self.split = split
+    self.append = append
+    self.path = os.path.join(path, self._shards_prefix() if append else split)
+    self._stream_size = 0
+    # Digests of the shards written, by shard filename.
+    self._shard_digests: dict[str, dict[str, Any]] = {}
+    self._rolling_writer = None
+    if shuffle != SHUFFLE_FULL:
+      self._rolling_writer = shard_utils.RollingShardWriter(self.path,
+                                                            max_shard_size=shard_size,
+                                                            compression_type=compression_type,
+                                                            write_index=write_index,
+                                                            write_key_index=write_key_index,
+                                                            checksum=write_checksums)
     self.sparse_features = sparse_features or []
+    self.num_workers = num_workers
+    self.flush_workers = flush_workers
+    self.resume = resume
+    self.checkpoint_interval = checkpoint_interval
+    self._checkpoint_path = os.path.join(path, f"{split}.checkpoint.json")
+    self._checkpoint: Optional[dict[str, Any]] = None
+    self._checkpoint_time = time.monotonic()
     self.gen_kwargs = gen_kwargs or {}
     self.gen_kwargs.update({"split": self.split})
+    self.stats = WriteStats()
 
   def cache_records(self) -> None:
     """Write data to cache."""
-    for key, datum in tqdm(self.generator(**self.gen_kwargs),
-                           unit=" examples",
-                           total=self.total_examples,
-                           leave=False):
-      if self.sparse_features:
-        logging.debug(f"Adding shapes info to datum for sparse features: {self.sparse_features}.")
-        datum = self.add_shape_fields(datum)
-      serialized_record = self.serializer(datum)
-      self.shuffler.add(key, serialized_record)
-      self.current_examples += 1
-    with tf.io.gfile.GFile(os.path.join(self._base_path, "datum_to_type_and_shape_mapping.json"),
-                           "w") as js_f:
+    if not self.merge_metadata:
+      # The manifest of an earlier run of the split must not be merged if this run fails.
+      info_utils.remove_manifest(self._base_path, self.split)
+    if self.resume and self._restore_checkpoint() == "flush":
+      logging.info(f"Examples of split {self.split} already cached, resuming writing shards.")
+      self._types_shapes = self._checkpoint["types_shapes"]
+      return
+    examples = _timed(self.generator(**self.gen_kwargs), self.stats, STAGE_GENERATE)
+    datum = self._skip_examples(examples) if self.current_examples else None
+    examples = tqdm(examples,
+                    unit=" examples",
+                    total=self.total_examples,
+                    initial=self.current_examples,
+                    leave=False)
+    if self.append:
+      examples = self._check_first_appended(examples)
+    try:
+      if self.num_workers > 1:
+        datum = self._cache_records_parallel(examples) or datum
+      else:
+        for key, datum in examples:
+          if self.sparse_features:
+            logging.debug(
+                f"Adding shapes info to datum for sparse features: {self.sparse_features}.")
+            datum = self.add_shape_fields(datum)
+          serialized_record = _serialize(self.serializer, datum, self.stats)
+          self._add_record(key, serialized_record)
+          self.current_examples += 1
+          self._maybe_checkpoint(key)
+    except DuplicatedKeysError as err:
+      logging.error(f"Duplicated example key: {err.item1!r}.")
+      shard_utils.raise_error_for_duplicated_keys(err)
+    if self.shuffler:
+      self.stats.spill_bytes = self.shuffler.spilled_bytes
+    if self.shuffler or self.window_shuffler:
+      self.stats.peak_buffer_size = (self.shuffler or self.window_shuffler).peak_buffer_size
+    types_shapes = datum_to_type_and_shape(datum, self.sparse_features)
+    if self.append:
+      self._check_appended_types(types_shapes)
+    self._types_shapes = types_shapes
+    if self.merge_metadata:
       logging.info(f"Saving datum type and shape metadata to {self._base_path}.")
-      types_shapes = datum_to_type_and_shape(datum, self.sparse_features)
-      json.dump(types_shapes, js_f)
+      info_utils.write_json(os.path.join(self._base_path, info_utils.TYPES_SHAPES_FILENAME),
+                            types_shapes)
+    if self.resume and not self.shuffler.in_memory:
+      # Examples held in memory only are generated again on resume.
+      self._save_checkpoint("flush")
+
+  def _shards_prefix(self) -> str:
+    """Returns the name prefix of the shards appended to the split, `<split>-appendNNN`."""
+    split_info = info_utils.load_shard_info(self._base_path).get(self.split)
+    if not split_info:
+      raise ValueError(f"Cannot append examples to split {self.split}, it does not exist in "
+                       f"{self._base_path}.")
+    prev_split_info = info_utils.load_dataset_info(self._base_path).get(self.split, {})
+    compression_type = prev_split_info.get("compression_type")
+    if compression_type != self.compression_type:
+      raise ValueError(f"Cannot append examples with compression type {self.compression_type} to "
+                       f"split {self.split} compressed with {compression_type}.")
+    if prev_split_info.get("record_index", False) != self.write_index:
+      raise ValueError(f"Cannot append examples with write_index={self.write_index} to split "
+                       f"{self.split}, all the shards of a split must have a record index or none.")
+    if prev_split_info.get("key_index", False) != self.write_key_index:
+      raise ValueError(f"Cannot append examples with write_key_index={self.write_key_index} to "
+                       f"split {self.split}, all the shards of a split must have a key index or "
+                       "none.")
+    # Splits written before the hash function and shuffle mode were recorded used the defaults.
+    hash_fn = prev_split_info.get("hash_fn", HASH_MD5)
+    if hash_fn != self.hash_fn:
+      raise ValueError(f"Cannot append examples with hash function {self.hash_fn} to split "
+                       f"{self.split} hashed with {hash_fn}, keys of the existing shards could not "
+                       "be looked up anymore.")
+    shuffle = prev_split_info.get("shuffle", SHUFFLE_FULL)
+    if shuffle != self.shuffle:
+      raise ValueError(f"Cannot append examples with shuffle mode {self.shuffle} to split "
+                       f"{self.split} written with shuffle mode {shuffle}.")
+    pattern = re.compile(rf"{re.escape(self.split)}-append(\d+)-")
+    appends = [int(match.group(1)) for match in map(pattern.match, split_info) if match]
+    return f"{self.split}-append{max(appends, default=0) + 1:03d}"
+
+  def _check_appended_types(self, types_shapes: dict[str, Any]) -> None:
+    """Checks appended examples have the same features, with the same types, as the split."""
+    with tf.io.gfile.GFile(os.path.join(self._base_path, info_utils.TYPES_SHAPES_FILENAME),
+                           "r") as js_f:
+      prev_types_shapes = json.load(js_f)
+    features = {key: (value["type"], value["dense"]) for key, value in types_shapes.items()}
+    prev_features = {
+        key: (value["type"], value["dense"])
+        for key, value in prev_types_shapes.items()
+    }
+    if features != prev_features:
+      raise ValueError(f"Appended examples features {features} do not match the features of "
+                       f"split {self.split}: {prev_features}.")
+
+  def _check_first_appended(self, examples: Iterable) -> Iterator:
+    """Yields the examples, the features of the first one are checked before it is cached.
+
+    A mismatch with the features of the split is then reported before the appended examples are
+    generated and cached, see `_check_appended_types`.
+    """
+    iterator = iter(examples)
+    first = next(iterator, None)
+    if first is None:
+      return
+    datum = self.add_shape_fields(dict(first[1])) if self.sparse_features else first[1]
+    self._check_appended_types(datum_to_type_and_shape(datum, self.sparse_features))
+    yield first
+    yield from iterator
+
+  def _restore_checkpoint(self) -> Optional[str]:
+    """Restores the shuffler and progress of the last checkpoint, if any, and returns its phase.
+
+    The phase is `cache` if examples were being cached, `flush` if shards were being written.
+    """
+    if not tf.io.gfile.exists(self._checkpoint_path):
+      return None
+    with tf.io.gfile.GFile(self._checkpoint_path, "r") as ckpt_f:
+      self._checkpoint = json.load(ckpt_f)
+    self.shuffler.restore(self._checkpoint["shuffler"])
+    self.current_examples = self._checkpoint["examples"]
+    logging.info(f"Resuming split {self.split} from checkpoint {self._checkpoint_path}: "
+                 f"{self.current_examples} examples cached, "
+                 f"{len(self._checkpoint['shards'])} shards written.")
+    return self._checkpoint["phase"]
+
+  def _skip_examples(self, examples: Iterator) -> DatumType:
+    """Skips the examples cached before the restored checkpoint, returns the last one.
+
+    Raises:
+      ValueError: if the key of the last skipped example is not the one of the checkpoint, the
+        generator is then not deterministic and the split cannot be resumed.
+    """
+    logging.info(f"Skipping the first {self.current_examples} generated examples.")
+    key, datum = None, None
+    for key, datum in islice(examples, self.current_examples):
+      pass
+    if str(key) != self._checkpoint["last_key"]:
+      raise ValueError(f"Cannot resume split {self.split}: example {self.current_examples} has "
+                       f"key {key}, while key {self._checkpoint['last_key']} was checkpointed.")
+    return datum
+
+  def _maybe_checkpoint(self, key: Any) -> None:
+    """Checkpoints cached examples if resumable and checkpoint_interval has elapsed.
+
+    Only the examples already written to spill files are checkpointed: examples held in memory are
+    generated again on resume, rather than written to disk early. Until the shuffler first spills,
+    nothing is checkpointed, then with the `runs` spill strategy checkpoints are taken right after
+    a sorted run is spilled.
+    """
+    if (self.resume and not self.shuffler.in_memory and not self.shuffler.buffered_records
+        and time.monotonic() - self._checkpoint_time >= self.checkpoint_interval):
+      self._save_checkpoint("cache", last_key=key)
+
+  def _save_checkpoint(self, phase: str, last_key: Any = None) -> None:
+    """Writes a checkpoint, atomically.
 
-  def create_records(self) -> None:
-    """Create tfrecords from given generator."""
+    Args:
+      phase: `cache` while examples are cached, the shuffler is then checkpointed, or `flush`
+        while shards are written.
+      last_key: key of the last cached example.
+    """
+    if phase == "cache" or not self._checkpoint or self._checkpoint["phase"] == "cache":
+      self._checkpoint = {
+          "phase": phase,
+          "examples": self.current_examples,
+          "last_key": str(last_key),
+          "compression_ratio": self._compression_ratio.ratio,
+          "shuffler": self.shuffler.checkpoint(),
+          # Types and shapes of the examples, once all of them are cached.
+          "types_shapes": self._types_shapes,
+          "shards": [],
+      }
+    self._checkpoint["phase"] = phase
+    info_utils.write_json(self._checkpoint_path, self._checkpoint)
+    self._checkpoint_time = time.monotonic()
+
+  def _cache_records_parallel(self, examples: Iterable) -> DatumType:
+    """Serialize and hash examples in a process pool and write them to cache.
+
+    Examples are sent to the workers in chunks of `SERIALIZE_CHUNK_SIZE`, at most two chunks per
+    worker are in flight at any time. Results are added to the cache in generator order, so the
+    output is identical to the single process path.
+
+    Args:
+      examples: an iterable of (key, datum) tuples.
+
+    Returns:
+      the last datum yielded by the generator.
+    """
+    logging.info(f"Serializing examples with {self.num_workers} worker processes.")
+    max_in_flight = 2 * self.num_workers
+    pending: collections.deque = collections.deque()
+    datum = None
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(self.num_workers,
+                      initializer=_init_serialization_worker,
+                      initargs=(self.serializer, self.split, self.hash_fn)) as pool:
+      for chunk in _chunked(examples, SERIALIZE_CHUNK_SIZE):
+        if self.sparse_features:
+          chunk = [(key, self.add_shape_fields(datum)) for key, datum in chunk]
+        datum = chunk[-1][1]
+        if len(pending) >= max_in_flight:
+          self._add_serialized(*pending.popleft())
+        pending.append(([key for key, _ in chunk], pool.apply_async(_serialize_chunk, (chunk,))))
+      while pending:
+        self._add_serialized(*pending.popleft())
+    return datum
+
+  def _add_serialized(self, keys: list[Any], result: multiprocessing.pool.AsyncResult) -> None:
+    """Add the serialized (hkey, record) tuples of a chunk to cache."""
+    records, stats = result.get()
+    self.stats.merge(stats)
+    for key, (hkey, serialized_record) in zip(keys, records):
+      self._add_record(key, serialized_record, hkey)
+      self.current_examples += 1
+      self._maybe_checkpoint(key)
+
+  def _add_record(self, key: Any, serialized_record: bytes, hkey: Optional[int] = None) -> None:
+    """Add a serialized example to the shuffler or, when streaming, to the shards.
+
+    Args:
+      key: the example key.
+      serialized_record: the serialized example.
+      hkey: hash of the example key, computed if None.
+    """
+    if hkey is None and (self.shuffle != SHUFFLE_NONE or self.write_key_index):
+      start = time.perf_counter()
+      hkey = self._hasher.hash_key(key)
+      self.stats.add(STAGE_HASH, time.perf_counter() - start)
+    start = time.perf_counter()
+    if self.shuffler:
+      self._compression_ratio.add(serialized_record)
+      self.shuffler.add_hashed(hkey, serialized_record, key)
+      self.stats.add(STAGE_CACHE, time.perf_counter() - start, nbytes=len(serialized_record))
+      return
+    records = [(hkey, serialized_record)]
+    if self.window_shuffler:
+      records = self.window_shuffler.add_hashed_items(hkey, serialized_record)
+      cached = time.perf_counter()
+      self.stats.add(STAGE_CACHE, cached - start, nbytes=len(serialized_record))
+      start = cached
+    for record_hkey, record in records:
+      self._rolling_writer.write(record, record_hkey)
+    self.stats.add(STAGE_WRITE,
+                   time.perf_counter() - start,
+                   count=len(records),
+                   nbytes=sum(len(record) for _, record in records))
+    self._stream_size += len(serialized_record)
+
+  def create_records(self) -> WriteStats:
+    """Create tfrecords from given generator.
+
+    Returns:
+      the stats of the write pipeline stages, also written to `write_stats.json`.
+    """
     logging.info("Caching serialized binary example to cache.")
     self.cache_records()
     logging.info("Writing data from cache to disk in `.tfrecord` format.")
     self.flush()
+    return self.stats
 
   def add_shape_fields(self, datum: DatumType) -> DatumType:
     """Add tensor shape information to dataset metadat json file and tfrecords. This is required when
@@ -120,36 +702,267 @@ class TFRecordWriter():
     Returns:
       a tuple containing a dict with shard info and the size of shuffler.
     """
+    if not self.shuffler:
+      return self._flush_stream()
     logging.info(f"Shuffling and writing examples to {self.path}")
-    shard_specs = shard_utils.get_shard_specs(self.current_examples, self.shuffler.size,
-                                              self.shuffler.bucket_lengths, self.path)
-    examples_generator = iter(
-        tqdm(self.shuffler, total=self.current_examples, unit=" examples", leave=False))
+    compression_ratio = self._compression_ratio.ratio
+    if self._checkpoint:
+      # Shards written before resuming were sized with the checkpointed ratio.
+      compression_ratio = self._checkpoint["compression_ratio"]
+    if self.compression_type:
+      logging.info(f"Estimated {self.compression_type} compression ratio: {compression_ratio:.3f}")
+    shard_specs = shard_utils.get_shard_specs(self.current_examples,
+                                              int(self.shuffler.size * compression_ratio),
+                                              self.shuffler.bucket_lengths,
+                                              self.path,
+                                              shard_size=self.shard_size,
+                                              min_shards=self.min_shards,
+                                              shards_multiple=self.shards_multiple)
+    start = time.perf_counter()
     try:
-      for shard_spec in shard_specs:
-        iterator = islice(examples_generator, 0, shard_spec.examples_number)
-        shard_utils.write_tfrecord(shard_spec.path, iterator)
+      if (self.flush_workers > 1 and not self.shuffler.in_memory
+          and self.shuffler.spill_strategy == SPILL_BUCKETS):
+        self._write_shards_parallel(shard_specs)
+      else:
+        self._write_shards(shard_specs)
     except DuplicatedKeysError as err:
       shard_utils.raise_error_for_duplicated_keys(err)
+    if self._checkpoint:
+      # Cache files are kept until all the shards are written, to resume writing shards.
+      self.shuffler.del_files()
+      tf.io.gfile.remove(self._checkpoint_path)
+    write_seconds = time.perf_counter() - start
     shard_info = {
         self.split: {
             spec.path.split("/")[-1]: int(spec.examples_number)
             for spec in shard_specs
         }
     }
-    self.save_shard_info(shard_info)
+    for spec in shard_specs:
+      if os.path.basename(spec.path) not in self._shard_digests:
+        # Shards written before resuming.
+        digest = shard_utils.get_shard_digest(spec.path, int(spec.examples_number),
+                                              self.write_checksums)
+        if self.write_key_index:
+          digest["hkey_range"] = shard_utils.read_key_index_range(spec.path)
+        self._shard_digests[os.path.basename(spec.path)] = digest
+    split_info = {
+        "hash_fn": self.hash_fn,
+        "shuffle": self.shuffle,
+        "compression_type": self.compression_type,
+        "record_index": self.write_index,
+        "key_index": self.write_key_index,
+        # Sharding plan of the last write of the split (the appended shards when appending).
+        "sharding": {
+            "num_shards": len(shard_specs),
+            "shard_size": self.shard_size,
+            "min_shards": self.min_shards,
+            "shards_multiple": self.shards_multiple,
+        },
+        "shards": {
+            filename: self._shard_digests[filename]
+            for filename in shard_info[self.split]
+        },
+    }
+    self.stats.add(STAGE_WRITE,
+                   write_seconds,
+                   count=self.current_examples,
+                   nbytes=sum(digest["size"] for digest in split_info["shards"].values()))
+    self._stop_stats(self.shuffler.size)
+    self._save_info(shard_info, split_info)
     logging.info(f"Done writing {self.path}. Shard lengths: {list(shard_info[self.split].values())}")
     return shard_info, self.shuffler.size
 
+  def _flush_stream(self) -> tuple[dict[str, dict[str, int]], int]:
+    """Write the examples left in the shuffle window and finalize the streamed shards."""
+    start = time.perf_counter()
+    count, nbytes = 0, 0
+    try:
+      for hkey, record in self.window_shuffler.items() if self.window_shuffler else ():
+        self._rolling_writer.write(record, hkey)
+        count += 1
+        nbytes += len(record)
+    except DuplicatedKeysError as err:
+      shard_utils.raise_error_for_duplicated_keys(err)
+    shard_info = {self.split: self._rolling_writer.close()}
+    self.stats.add(STAGE_WRITE, time.perf_counter() - start, count=count, nbytes=nbytes)
+    split_info = {
+        "shuffle": self.shuffle,
+        "compression_type": self.compression_type,
+        "record_index": self.write_index,
+        "key_index": self.write_key_index,
+        "sharding": {
+            "num_shards": len(shard_info[self.split]),
+            "shard_size": self.shard_size,
+        },
+        "shards": self._rolling_writer.digests,
+    }
+    if self.window_shuffler or self.write_key_index:
+      split_info["hash_fn"] = self.hash_fn
+    self._stop_stats(self._stream_size)
+    self._save_info(shard_info, split_info)
+    logging.info(f"Done writing {self.path}. Shard lengths: {list(shard_info[self.split].values())}")
+    return shard_info, self._stream_size
+
+  def _write_shards(self, shard_specs: list[shard_utils._ShardSpec]) -> None:
+    """Write tfrecord shards sequentially from the shuffled examples.
+
+    Shards take consecutive slices of the shuffled examples, which never exhaust the examples
+    iterator, so it is closed explicitly to remove the spill files.
+
+    Args:
+      shard_specs: specs of the shards to write.
+    """
+    items = self.shuffler.items()
+    try:
+      examples_generator = iter(
+          tqdm(items, total=self.current_examples, unit=" examples", leave=False))
+      for shard_spec in shard_specs:
+        iterator = islice(examples_generator, 0, shard_spec.examples_number)
+        if self._is_shard_written(shard_spec.path):
+          collections.deque(iterator, maxlen=0)
+        else:
+          self._shard_digests[os.path.basename(shard_spec.path)] = self._write_shard(
+              shard_spec.path, iterator)
+          self._checkpoint_shard(shard_spec.path)
+    finally:
+      items.close()
+      if not self._checkpoint:
+        self.shuffler.del_files()
+
+  def _write_shard(self, path: str, records: Iterable[tuple[int, bytes]]) -> dict[str, Any]:
+    """Write the (hkey, data) records to the shard at path and its indexes, returns its digest."""
+    hkeys = [] if self.write_key_index else None
+    data = _iter_records_data(records, hkeys)
+    digest = shard_utils.write_tfrecord(path, data, self.compression_type, self.write_index,
+                                        self.write_checksums)
+    if hkeys is not None:
+      shard_utils.write_key_index(path, hkeys)
+      digest["hkey_range"] = shard_utils.read_key_index_range(path)
+    return digest
+
+  def _stop_stats(self, size: int) -> None:
+    """Stops the stats of the run, once size bytes of examples are written, and logs them."""
+    self.stats.examples = self.current_examples
+    self.stats.bytes = size
+    self.stats.stop()
+    self.stats.log()
+
+  def _is_shard_written(self, path: str) -> bool:
+    """Returns whether the shard at path was written before the restored checkpoint."""
+    return bool(self._checkpoint) and os.path.basename(path) in self._checkpoint["shards"]
+
+  def _checkpoint_shard(self, path: str) -> None:
+    """Checkpoints the shard at path as written, if the cached examples were checkpointed."""
+    if self._checkpoint:
+      self._checkpoint["shards"].append(os.path.basename(path))
+      self._save_checkpoint("flush")
+
+  def _write_shards_parallel(self, shard_specs: list[shard_utils._ShardSpec]) -> None:
+    """Write tfrecord shards concurrently from the shuffler bucket files.
+
+    Each worker process reads and sorts the buckets covered by the reading instructions of its
+    shard, and writes the shard file.
+
+    Args:
+      shard_specs: specs of the shards to write.
+    """
+    logging.info(f"Writing {len(shard_specs)} shards with {self.flush_workers} worker processes.")
+    bucket_files = self.shuffler.bucket_files()
+    tasks = []
+    for spec in shard_specs:
+      if self._is_shard_written(spec.path):
+        continue
+      instructions = [
+          dict(bucket_file=bucket_files[instruction["bucket_index"]],
+               hkey_range=get_bucket_range(instruction["bucket_index"], len(bucket_files)),
+               max_bucket_size=self.shuffler.max_bucket_size,
+               skip=instruction["skip"],
+               take=instruction["take"]) for instruction in spec.reading_instructions
+      ]
+      tasks.append((spec.path, instructions, self.shuffler.spill_compression, self.compression_type,
+                    self.write_index, self.write_key_index, self.write_checksums))
+    codec = SpillCodec(self.shuffler.spill_compression) if self.shuffler.spill_compression else None
+    context = multiprocessing.get_context("spawn")
+    try:
+      with context.Pool(max(min(self.flush_workers, len(tasks)), 1)) as pool:
+        results = pool.imap_unordered(_write_shard_from_buckets_task, tasks)
+        for path, digest, raw_bytes_read, decompress_seconds in tqdm(results,
+                                                                     total=len(tasks),
+                                                                     unit=" shards",
+                                                                     leave=False):
+          self._shard_digests[os.path.basename(path)] = digest
+          self._checkpoint_shard(path)
+          if codec:
+            codec.raw_bytes_read += raw_bytes_read
+            codec.decompress_seconds += decompress_seconds
+    finally:
+      if not self._checkpoint:
+        self.shuffler.del_files()
+    if codec:
+      codec.log_read_stats()
+
+  def _save_info(self, shard_info: dict[str, dict[str, int]], split_info: dict[str, Any]) -> None:
+    """Save the shard info and split info of the split, or its manifest if not merge_metadata."""
+    if self.merge_metadata:
+      self.save_shard_info(shard_info)
+      info_utils.update_split_info(self._base_path, self.split, split_info, self.append)
+      info_utils.update_write_stats(self._base_path, self.split, self.stats.to_dict())
+      return
+    logging.info(f"Saving split {self.split} manifest to {self._base_path}.")
+    manifest = {
+        "shard_info": shard_info[self.split],
+        "append": self.append,
+        "split_info": split_info,
+        "types_shapes": self._types_shapes,
+        "write_stats": self.stats.to_dict(),
+    }
+    info_utils.write_manifest(self._base_path, self.split, manifest)
+
   def save_shard_info(self, shard_info: dict[str, dict[str, int]]) -> None:
     """Save shard info to disk.
 
+    The shards of the split replace the previous shards of the split, or when appending, are added
+    after them so that slicing the split reads the appended examples last.
+
     Args:
       shard_info: input shard info dict.
     """
-    if os.path.isfile(os.path.join(self._base_path, "shard_info.json")):
-      with tf.io.gfile.GFile(os.path.join(self._base_path, "shard_info.json"), "r") as si_f:
-        prev_shard_info = json.load(si_f)
-        shard_info.update(prev_shard_info)
-    with tf.io.gfile.GFile(os.path.join(self._base_path, "shard_info.json"), "w") as si_f:
-      json.dump(shard_info, si_f)
+    prev_shard_info = info_utils.load_shard_info(self._base_path)
+    info_utils.merge_split_shard_info(prev_shard_info, self.split, shard_info[self.split],
+                                      self.append)
+    info_utils.write_json(os.path.join(self._base_path, info_utils.SHARD_INFO_FILENAME),
+                          prev_shard_info)
+
+
+def _create_split_records(writer_kwargs: dict[str, Any]) -> str:
+  """Create the tfrecords of a split, in a worker process of `create_records_concurrently`."""
+  logging.set_verbosity(logging.INFO)
+  writer = TFRecordWriter(**writer_kwargs, merge_metadata=False)
+  writer.create_records()
+  return writer.split
+
+
+def create_records_concurrently(path: str, writers_kwargs: list[dict[str, Any]],
+                                max_workers: int) -> None:
+  """Create the tfrecords of several splits concurrently, each split in its own process.
+
+  Each writer saves the metadata of its split to a manifest, the manifests are merged into the
+  dataset metadata files once all the splits are written, so that metadata files are never
+  concurrently updated. The generators and serializers must be picklable.
+
+  Args:
+    path: path to store the tfrecords data and metadata, shared by all the splits.
+    writers_kwargs: `TFRecordWriter` keyword arguments of each split.
+    max_workers: maximum number of splits written at once.
+  """
+  logging.info(f"Writing {len(writers_kwargs)} splits with {max_workers} worker processes.")
+  context = multiprocessing.get_context("spawn")
+  try:
+    with concurrent.futures.ProcessPoolExecutor(max_workers, mp_context=context) as executor:
+      futures = [executor.submit(_create_split_records, kwargs) for kwargs in writers_kwargs]
+      for future in concurrent.futures.as_completed(futures):
+        logging.info(f"Completed tfrecord conversion for input split: {future.result()}")
+  finally:
+    # Splits written before a failure are still added to the dataset metadata.
+    info_utils.merge_manifests(path, [kwargs["split"] for kwargs in writers_kwargs])
@@ -34,7 +34,7 @@ TESTS_REQUIRE = [
     "pytest",
     "pytest-xdist",
 ]
-packages = find_namespace_packages(exclude=["tests*", "tools*"],)
+packages = find_namespace_packages(exclude=["tests*", "tools*", "benchmarks*"],)
 
 setup(
     name=project_name,
@@ -0,0 +1,343 @@
+# Copyright 2021 The OpenAGI Datum Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import tempfile
+from shutil import rmtree
+from unittest import mock
+
+from absl.testing import absltest
+
+from datum.cache import bucket
+from datum.utils.hashing import Hasher
+
+_RECORDS = [(f'key_{idx}', f'value {idx}'.encode() * (idx % 7 + 1)) for idx in range(500)]
+
+
+class TestMemBuffer(absltest.TestCase):
+
+  def test_sorted_items(self):
+    hasher = Hasher('train')
+    records = [(hasher.hash_key(key), value) for key, value in _RECORDS]
+    buffer = bucket._MemBuffer(capacity=4)
+    for hkey, value in records:
+      buffer.add(hkey, value)
+    self.assertLen(buffer, len(records))
+    self.assertEqual(list(buffer.items()), records)
+    self.assertEqual(list(buffer.sorted_items()), sorted(records))
+    self.assertGreater(buffer.nbytes, sum(len(value) for _, value in records))
+
+
+class TestFilePool(absltest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    rmtree(self.tempdir)
+
+  def test_write(self):
+    pool = bucket._FilePool(max_open_files=2, buffer_size=16)
+    paths = [os.path.join(self.tempdir, 'sub', f'file_{idx}') for idx in range(5)]
+    expected = {path: b'' for path in paths}
+    for idx in range(100):
+      path = paths[idx * 7 % len(paths)]
+      data = f'data {idx};'.encode() * (idx % 3)
+      pool.write(path, data)
+      expected[path] += data
+      self.assertLessEqual(len(pool._files), 2)
+    pool.close_all()
+    for path in paths:
+      with open(path, 'rb') as f:
+        self.assertEqual(f.read(), expected[path])
+
+
+class TestReadBucketFile(absltest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    hasher = Hasher('train')
+    self.records = [(hasher.hash_key(key), value) for key, value in _RECORDS]
+    self.path = os.path.join(self.tempdir, 'bucket.tmp')
+    bucket_ = bucket._Bucket(self.path)
+    for hkey, value in self.records:
+      bucket_.add(hkey, value)
+    bucket_.flush()
+
+  def tearDown(self):
+    rmtree(self.tempdir)
+
+  def test_read(self):
+    records = list(bucket.read_bucket_file(self.path))
+    self.assertIsInstance(records[0][1], memoryview)
+    self.assertEqual([(hkey, bytes(value)) for hkey, value in records], self.records)
+    # Records and record headers span several read buffers.
+    for buffer_size in [7, 100]:
+      with mock.patch.object(bucket, 'READ_BUFFER_SIZE', buffer_size):
+        self.assertEqual(list(bucket.read_bucket_file(self.path)), self.records)
+
+  def test_mmap(self):
+    table = bucket._RecordsTable(*bucket._parse_records_table(bucket._map_file(self.path)))
+    self.assertEqual([(hkey, bytes(value)) for hkey, value in table], self.records)
+    with mock.patch.object(bucket, '_is_local_path', return_value=False):
+      self.assertEqual(list(bucket._read_sorted_bucket_file(self.path)), sorted(self.records))
+
+  def test_fixed_length_records_table(self):
+    records = [(hkey, value[:8].ljust(8)) for hkey, value in self.records]
+    path = os.path.join(self.tempdir, 'fixed.tmp')
+    bucket_ = bucket._Bucket(path)
+    for hkey, value in records:
+      bucket_.add(hkey, value)
+    bucket_.flush()
+    table = bucket._RecordsTable(*bucket._parse_records_table(bucket._map_file(path)))
+    self.assertEqual([(hkey, bytes(value)) for hkey, value in table], records)
+
+  def test_sorted_records_table(self):
+    expected = sorted(self.records)
+    table = bucket._read_sorted_bucket_file(self.path)
+    self.assertIsInstance(table, bucket._RecordsTable)
+    self.assertLen(table, len(expected))
+    self.assertEqual([(hkey, bytes(value)) for hkey, value in table], expected)
+    self.assertEqual(table[-1][0], expected[-1][0])
+    self.assertEqual(bytes(table[3][1]), expected[3][1])
+    self.assertEqual([hkey for hkey, _ in table[10:20]], [hkey for hkey, _ in expected[10:20]])
+
+
+class TestShuffler(absltest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    rmtree(self.tempdir)
+
+  def _shuffle(self, records, **kwargs):
+    shuffler = bucket.Shuffler(self.tempdir, 'train', **kwargs)
+    for key, value in records:
+      shuffler.add(key, value)
+    return shuffler, list(shuffler)
+
+  def test_in_memory(self):
+    shuffler, values = self._shuffle(_RECORDS)
+    self.assertTrue(shuffler.in_memory)
+    self.assertEmpty(os.listdir(self.tempdir))
+    self.assertEqual(sorted(values), sorted(value for _, value in _RECORDS))
+
+  def test_spilled(self):
+    _, expected = self._shuffle(_RECORDS)
+    with mock.patch.object(bucket, 'MAX_MEM_BUFFER_SIZE', 1 << 10):
+      shuffler, values = self._shuffle(_RECORDS)
+    self.assertFalse(shuffler.in_memory)
+    self.assertEqual(values, expected)
+    self.assertEmpty(os.listdir(self.tempdir))
+
+  def test_spilled_oversized_buckets(self):
+    _, expected = self._shuffle(_RECORDS)
+    shuffler, values = self._shuffle(_RECORDS, memory_budget=1 << 10, buckets_number=3)
+    self.assertFalse(shuffler.in_memory)
+    self.assertEqual(values, expected)
+    self.assertEmpty(os.listdir(self.tempdir))
+    # Bucket and sub-bucket files are removed when the records are not all read.
+    shuffler = bucket.Shuffler(self.tempdir, 'train', memory_budget=1 << 10, buckets_number=3)
+    for key, value in _RECORDS:
+      shuffler.add(key, value)
+    items = shuffler.items()
+    next(items)
+    items.close()
+    self.assertEmpty(os.listdir(self.tempdir))
+
+  def test_buckets_number(self):
+    shuffler, _ = self._shuffle(_RECORDS, memory_budget=1 << 10, buckets_number=7)
+    self.assertLen(shuffler.bucket_lengths, 7)
+    shuffler, _ = self._shuffle(_RECORDS, memory_budget=1 << 10, total_examples=len(_RECORDS))
+    self.assertBetween(len(shuffler.bucket_lengths), bucket.MIN_BUCKETS_NUMBER, 100)
+    shuffler, _ = self._shuffle(_RECORDS, memory_budget=0, total_examples=10**9)
+    self.assertLen(shuffler.bucket_lengths, bucket.MAX_BUCKETS_NUMBER)
+
+  def test_spill_compression(self):
+    _, expected = self._shuffle(_RECORDS)
+    spill_kwargs = [
+        dict(memory_budget=1 << 12, buckets_number=3),
+        dict(memory_budget=1 << 12, buckets_number=3, max_bucket_size=1 << 10),
+        # The in-memory buffer arrays alone take 32KB.
+        dict(memory_budget=40 << 10, spill_strategy=bucket.SPILL_RUNS),
+    ]
+    for compression in (bucket.SPILL_COMPRESSION_ZLIB, bucket.SPILL_COMPRESSION_LZMA):
+      for kwargs in spill_kwargs:
+        shuffler, values = self._shuffle(_RECORDS,
+                                         spill_compression=compression,
+                                         spill_compression_level=1,
+                                         **kwargs)
+        self.assertFalse(shuffler.in_memory)
+        self.assertEqual(values, expected)
+        codec = shuffler._codec
+        self.assertLess(codec.compressed_bytes_written, codec.raw_bytes_written)
+        self.assertGreaterEqual(codec.raw_bytes_read, codec.raw_bytes_written)
+        self.assertEmpty(os.listdir(self.tempdir))
+
+  def test_unsupported_spill_compression(self):
+    with self.assertRaises(ValueError):
+      bucket.Shuffler(self.tempdir, 'train', spill_compression='bz2')
+
+  def test_spilled_runs(self):
+    _, expected = self._shuffle(_RECORDS)
+    with mock.patch.object(bucket, 'MAX_MEM_BUFFER_SIZE', 1 << 12):
+      shuffler, values = self._shuffle(_RECORDS, spill_strategy=bucket.SPILL_RUNS)
+    self.assertFalse(shuffler.in_memory)
+    self.assertGreater(len(shuffler._runs), 1)
+    self.assertEqual(values, expected)
+    self.assertEmpty(os.listdir(self.tempdir))
+    # Run files are removed when the records are not all read.
+    with mock.patch.object(bucket, 'MAX_MEM_BUFFER_SIZE', 1 << 12):
+      shuffler = bucket.Shuffler(self.tempdir, 'train', spill_strategy=bucket.SPILL_RUNS)
+      for key, value in _RECORDS:
+        shuffler.add(key, value)
+    items = shuffler.items()
+    next(items)
+    items.close()
+    self.assertEmpty(os.listdir(self.tempdir))
+
+  def test_spilled_runs_fan_in(self):
+    _, expected = self._shuffle(_RECORDS)
+    read_values = bucket._Bucket.read_values
+    open_runs = []
+    max_open_runs = []
+
+    def counting_read_values(bucket_):
+      open_runs.append(bucket_)
+      max_open_runs.append(len(open_runs))
+      try:
+        yield from read_values(bucket_)
+      finally:
+        open_runs.remove(bucket_)
+
+    with mock.patch.object(bucket, 'MAX_MEM_BUFFER_SIZE', 1 << 10), \
+        mock.patch.object(bucket, 'MAX_MERGE_FAN_IN', 4), \
+        mock.patch.object(bucket._Bucket, 'read_values', counting_read_values):
+      shuffler, values = self._shuffle(_RECORDS, spill_strategy=bucket.SPILL_RUNS)
+    self.assertGreater(len(shuffler._runs), 16)
+    self.assertEqual(values, expected)
+    # At most 4 run files are read at once, intermediate runs are read too.
+    self.assertEqual(max(max_open_runs), 4)
+    self.assertGreater(len(max_open_runs), len(shuffler._runs))
+    self.assertEmpty(os.listdir(self.tempdir))
+
+  def test_detect_duplicates(self):
+    for kwargs in ({}, {'memory_budget': 1 << 10}, {'spill_strategy': bucket.SPILL_RUNS}):
+      shuffler, values = self._shuffle(_RECORDS, detect_duplicates=True, **kwargs)
+      self.assertLen(values, len(_RECORDS))
+      shuffler = bucket.Shuffler(self.tempdir, 'train', detect_duplicates=True, **kwargs)
+      for key, value in _RECORDS[:100]:
+        shuffler.add(key, value)
+      with self.assertRaises(bucket.DuplicatedKeysError) as err:
+        shuffler.add(_RECORDS[50][0], b'duplicate')
+      self.assertEqual(err.exception.item1, _RECORDS[50][0])
+      shuffler.del_files()
+      self.assertEmpty(os.listdir(self.tempdir))
+
+  def test_detect_duplicates_false_positives(self):
+    # A filter much smaller than the number of records, most keys are suspected.
+    with mock.patch.object(bucket, 'BLOOM_FILTER_BITS_PER_RECORD', 1):
+      shuffler, values = self._shuffle(_RECORDS, detect_duplicates=True, total_examples=1)
+    self.assertLen(values, len(_RECORDS))
+
+  def test_duplicates_detector_scales(self):
+    hasher = Hasher('train')
+    hkeys = hasher.hash_keys(range(20000))
+    # Small write buffers and blocks, so that partitions have merged segments of many blocks.
+    with mock.patch.object(bucket, 'HKEYS_WRITE_BUFFER_SIZE', 256), \
+        mock.patch.object(bucket, 'HKEYS_BLOCK_SIZE', 4):
+      detector = bucket._DuplicatesDetector(self.tempdir, 'train', capacity=1000)
+      with mock.patch.object(bucket._HkeysSegment,
+                             '__contains__',
+                             autospec=True,
+                             side_effect=bucket._HkeysSegment.__contains__) as contains:
+        for hkey in hkeys:
+          self.assertFalse(detector.add(hkey))
+        # The filters grow with the number of hkeys, segments are rarely read.
+        self.assertGreater(len(detector._filters), 3)
+        self.assertLess(contains.call_count, 100)
+        for hkey in hkeys[::1000]:
+          self.assertTrue(detector.add(hkey))
+    for segments in detector._segments:
+      self.assertLessEqual(len(segments), 5)
+    detector.del_files()
+    self.assertEmpty(os.listdir(self.tempdir))
+
+  def test_duplicated_keys(self):
+    with self.assertRaises(bucket.DuplicatedKeysError):
+      self._shuffle(_RECORDS + _RECORDS[:1])
+    with mock.patch.object(bucket, 'MAX_MEM_BUFFER_SIZE', 1 << 12):
+      with self.assertRaises(bucket.DuplicatedKeysError):
+        self._shuffle(_RECORDS + _RECORDS[:1], spill_strategy=bucket.SPILL_RUNS)
+
+  def test_checkpoint(self):
+    _, expected = self._shuffle(_RECORDS)
+    half = len(_RECORDS) // 2
+    for kwargs in [{}, dict(spill_strategy=bucket.SPILL_RUNS), dict(spill_compression='zlib')]:
+      shuffler = bucket.Shuffler(self.tempdir,
+                                 'train',
+                                 memory_budget=40 << 10,
+                                 buckets_number=3,
+                                 detect_duplicates=True,
+                                 name='checkpointed',
+                                 **kwargs)
+      for key, value in _RECORDS[:half]:
+        shuffler.add(key, value)
+      manifest = shuffler.checkpoint()
+      self.assertFalse(manifest['in_memory'])
+      # Records added after the checkpoint are discarded on restore.
+      for key, value in _RECORDS[half:]:
+        shuffler.add(key, value)
+      shuffler = bucket.Shuffler(self.tempdir,
+                                 'train',
+                                 memory_budget=40 << 10,
+                                 buckets_number=3,
+                                 detect_duplicates=True,
+                                 name='checkpointed',
+                                 **kwargs)
+      shuffler.restore(manifest)
+      with self.assertRaises(bucket.DuplicatedKeysError):
+        shuffler.add(*_RECORDS[0])
+      for key, value in _RECORDS[half:]:
+        shuffler.add(key, value)
+      self.assertEqual(list(shuffler), expected)
+      shuffler.del_files()
+      self.assertEmpty(os.listdir(self.tempdir))
+    with self.assertRaises(ValueError):
+      bucket.Shuffler(self.tempdir, 'train', name='other').restore(manifest)
+
+
+class TestWindowShuffler(absltest.TestCase):
+
+  def _shuffle(self, records, memory_budget):
+    shuffler = bucket.WindowShuffler('train', memory_budget=memory_budget)
+    values = []
+    for key, value in records:
+      values.extend(shuffler.add(key, value))
+    return values + list(shuffler)
+
+  def test_window(self):
+    # A window holding all the records releases them sorted by hkey.
+    hasher = Hasher('train')
+    expected = [value for _, value in sorted(_RECORDS, key=lambda r: hasher.hash_key(r[0]))]
+    self.assertEqual(self._shuffle(_RECORDS, 1 << 30), expected)
+    self.assertEqual(self._shuffle(_RECORDS, 0), [value for _, value in _RECORDS])
+    values = self._shuffle(_RECORDS, 1 << 10)
+    self.assertCountEqual(values, [value for _, value in _RECORDS])
+    self.assertNotEqual(values, expected)
+    self.assertNotEqual(values, [value for _, value in _RECORDS])
+
+  def test_duplicated_keys(self):
+    with self.assertRaises(bucket.DuplicatedKeysError):
+      self._shuffle(_RECORDS[:10] + _RECORDS[:1], 1 << 10)
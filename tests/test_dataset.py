@@ -11,14 +11,20 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import os
 import tempfile
 from shutil import rmtree
+from unittest import mock
 
 import numpy as np
 from absl.testing import absltest
 
-from datum.configs import DatasetConfigs
+from datum.configs import DatasetConfigs, TFRReadConfigs
 from datum.reader.dataset import Dataset
+from datum.reader.tfrecord_reader import Reader
+from datum.serializer.serializer import DatumSerializer
+from datum.utils import info_utils, shard_utils
+from datum.writer.tfrecord_writer import TFRecordWriter
 from tests.utils import (_test_create_clf_records, _test_create_det_records,
                          _test_create_seg_records, _test_create_textjson_records)
 
@@ -169,3 +175,99 @@ class TestTextJsonDataset(absltest.TestCase):
       }
     for _, value in batch_data.items():
       assert value in list(expected_data.values())
+
+
+def _text_generator(split, num_examples=300, **kwargs):
+  for idx in range(num_examples):
+    yield idx, {'text': f'{split} example {idx}', 'label': idx}
+
+
+class TestRandomAccess(absltest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    serializer = DatumSerializer('text')
+    writer = TFRecordWriter(_text_generator,
+                            serializer,
+                            self.tempdir,
+                            'train',
+                            300,
+                            shard_size=5 << 10,
+                            write_index=True,
+                            write_key_index=True)
+    writer.create_records()
+    writer = TFRecordWriter(_text_generator, serializer, self.tempdir, 'val', 300)
+    writer.create_records()
+    self._dataset = Dataset(self.tempdir, DatasetConfigs())
+
+  def tearDown(self):
+    rmtree(self.tempdir)
+
+  def test_get(self):
+    self.assertLen([name for name in os.listdir(self.tempdir) if name.endswith('.idx')], 4)
+    reader = Reader(self.tempdir, TFRReadConfigs())
+    expected = list(reader.read('train', False).as_numpy_iterator())
+    for index in [0, 1, 74, 75, 150, 299, -1, -300]:
+      example = self._dataset.get('train', index)
+      self.assertEqual(example['text'].numpy(), expected[index]['text'])
+      self.assertEqual(example['label'].numpy(), expected[index]['label'])
+    indices = [299, 0, 150, 151, 3, 150]
+    examples = self._dataset.get_many('train', indices)
+    self.assertEqual([example['text'].numpy() for example in examples],
+                     [expected[index]['text'] for index in indices])
+    self.assertEmpty(self._dataset.get_many('train', []))
+
+  def test_get_errors(self):
+    with self.assertRaises(IndexError):
+      self._dataset.get('train', 300)
+    with self.assertRaises(IndexError):
+      self._dataset.get_many('train', [0, -301])
+    with self.assertRaises(ValueError):
+      self._dataset.get('val', 0)
+    with self.assertRaises(ValueError):
+      self._dataset.get('test', 0)
+
+  def test_lookup(self):
+    serializer = DatumSerializer('text')
+    splits_kwargs = {
+        'spilled': dict(memory_budget=0, buckets_number=3, flush_workers=2, shard_size=5 << 10),
+        'window': dict(shuffle='window', memory_budget=1 << 10, shard_size=5 << 10),
+        'none': dict(shuffle='none', shard_size=5 << 10),
+    }
+    for split, kwargs in splits_kwargs.items():
+      writer = TFRecordWriter(_text_generator,
+                              serializer,
+                              self.tempdir,
+                              split,
+                              300,
+                              write_index=True,
+                              write_key_index=True,
+                              **kwargs)
+      writer.create_records()
+    self._dataset = Dataset(self.tempdir, DatasetConfigs())
+    for split in ['train', *splits_kwargs]:
+      for key in [0, 1, 150, 299]:
+        example = self._dataset.lookup(split, key)
+        self.assertEqual(example['text'].numpy(), f'{split} example {key}'.encode())
+        self.assertEqual(example['label'].numpy(), key)
+      with self.assertRaises(KeyError):
+        self._dataset.lookup(split, 300)
+    with self.assertRaises(ValueError):
+      self._dataset.lookup('val', 0)
+    # Shards of a fully shuffled split have disjoint hkey ranges, a single key index is read.
+    with mock.patch.object(shard_utils, 'read_key_index',
+                           wraps=shard_utils.read_key_index) as read_key_index:
+      for key in range(0, 300, 30):
+        self.assertEqual(self._dataset.lookup('spilled', key)['label'].numpy(), key)
+      self.assertEqual(read_key_index.call_count, 10)
+    # Datasets written before the hkey ranges were recorded.
+    dataset_info = info_utils.load_dataset_info(self.tempdir)
+    for digest in dataset_info['train']['shards'].values():
+      del digest['hkey_range']
+    info_utils.write_json(os.path.join(self.tempdir, info_utils.DATASET_INFO_FILENAME), dataset_info)
+    dataset = Dataset(self.tempdir, DatasetConfigs())
+    self.assertEqual(dataset.lookup('train', 299)['label'].numpy(), 299)
+    with self.assertRaises(KeyError):
+      dataset.lookup('train', 300)
+    with self.assertRaises(ValueError):
+      TFRecordWriter(_text_generator, serializer, self.tempdir, 'test', 300, write_key_index=True)
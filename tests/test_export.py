@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import json
 import os
 import tempfile
 
@@ -43,8 +44,46 @@ def test_export_to_tfrecord(problem_type, input_data):
     export.export_to_tfrecord(input_data, tempdir, problem_type, write_configs)
     files = sorted(os.listdir(tempdir))
     assert [
+        "dataset_info.json",
         "datum_to_type_and_shape_mapping.json",
         "shard_info.json",
         "train-00000-of-00001.tfrecord",
         "val-00000-of-00001.tfrecord",
+        "write_stats.json",
     ] == files
+
+
+@pytest.mark.parametrize(
+    "problem_type,input_data",
+    [
+        (types.IMAGE_CLF, "tests/dummy_data/clf"),
+        (types.IMAGE_DET, "tests/dummy_data/det/voc"),
+    ],
+)
+def test_export_to_tfrecord_split_workers(problem_type, input_data):
+  with tempfile.TemporaryDirectory() as tempdir:
+    outputs = []
+    for split_workers in [1, 2]:
+      output_path = os.path.join(tempdir, str(split_workers))
+      write_configs = TFRWriteConfigs()
+      write_configs.splits = {
+          "train": {
+              "num_examples": 1
+          },
+          "val": {
+              "num_examples": 1
+          },
+      }
+      write_configs.split_workers = split_workers
+      export.export_to_tfrecord(input_data, output_path, problem_type, write_configs)
+      output = {}
+      for filename in sorted(os.listdir(output_path)):
+        with open(os.path.join(output_path, filename), "rb") as output_f:
+          output[filename] = output_f.read()
+        if filename.endswith(".json"):
+          output[filename] = json.loads(output[filename])
+        if filename == "write_stats.json":
+          # Timings differ from one run to the next, only the splits are compared.
+          output[filename] = sorted(output[filename])
+      outputs.append(output)
+    assert outputs[0] == outputs[1]
@@ -0,0 +1,194 @@
+# Copyright 2020 The OpenAGI Datum Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import tempfile
+from shutil import rmtree
+
+import numpy as np
+import tensorflow as tf
+from absl.testing import absltest
+
+from datum.generator.synthetic import SyntheticDatumGenerator
+from datum.reader.loader import load
+from datum.serializer.serializer import DatumSerializer
+from datum.utils.common_utils import AttrDict
+from datum.writer.tfrecord_writer import TFRecordWriter
+
+
+class TestSyntheticDatumGenerator(absltest.TestCase):
+
+  def setUp(self):
+    self.features = {
+        'image': {
+            'dtype': 'image',
+            'height': 32,
+            'width': 48,
+            'num_distinct_images': 4
+        },
+        'mask': {
+            'dtype': 'image',
+            'height': 16,
+            'width': 16,
+            'channels': 1,
+            'format': 'png'
+        },
+        'label': {
+            'dtype': 'int',
+            'high': 10
+        },
+        'embedding': {
+            'dtype': 'float',
+            'shape': [2, 3]
+        },
+        'boxes': {
+            'dtype': 'float',
+            'shape': [None, 4],
+            'min_length': 2,
+            'max_length': 5
+        },
+        'text': {
+            'dtype': 'string',
+            'min_words': 3,
+            'max_words': 6,
+            'vocab_size': 50
+        },
+    }
+    self.gen = SyntheticDatumGenerator(
+        gen_config=AttrDict(features=self.features, num_examples={
+            'train': 2500,
+            'val': 10
+        }))
+
+  def test_generate_datum(self):
+    examples = list(self.gen(split='train'))
+    self.assertLen(examples, 2500)
+    key, datum = examples[0]
+    self.assertEqual(key, 'train_000000000000')
+    self.assertEqual(list(datum), list(self.features))
+    self.assertEqual(tf.io.decode_jpeg(datum['image']).shape, [32, 48, 3])
+    self.assertEqual(tf.io.decode_png(datum['mask']).shape, [16, 16, 1])
+    self.assertLen({datum['image'] for _, datum in examples}, 4)
+    for _, datum in examples:
+      self.assertBetween(datum['label'], 0, 9)
+      self.assertEqual(datum['embedding'].shape, (2, 3))
+      self.assertBetween(len(datum['boxes']), 2, 5)
+      self.assertEqual(datum['boxes'].shape[1], 4)
+      self.assertBetween(len(datum['text'].split()), 3, 6)
+    self.assertLen(list(self.gen(split='val')), 10)
+    self.assertLen(list(self.gen(split='test', num_examples=3)), 3)
+    self.assertEqual(self.gen.sparse_features, ['boxes'])
+
+  def test_deterministic(self):
+
+    def generate(gen, split):
+      return [(key, datum['label'], datum['boxes'].tolist(), datum['text'])
+              for key, datum in gen(split=split)]
+
+    gen = SyntheticDatumGenerator(
+        gen_config=AttrDict(features=self.features, num_examples={
+            'train': 2500,
+            'val': 10
+        }))
+    self.assertEqual(generate(self.gen, 'train'), generate(gen, 'train'))
+    self.assertNotEqual(generate(self.gen, 'train')[:10], generate(self.gen, 'val'))
+    gen = SyntheticDatumGenerator(
+        gen_config=AttrDict(features=self.features, num_examples=10, seed=1))
+    self.assertNotEqual(generate(self.gen, 'val'), generate(gen, 'val'))
+
+  def test_random_keys(self):
+    gen = SyntheticDatumGenerator(
+        gen_config=AttrDict(features=self.features, num_examples=5000, key_distribution='random'))
+    keys = [key for key, _ in gen(split='train')]
+    self.assertLen(set(keys), 5000)
+    self.assertNotEqual(keys, sorted(keys))
+
+  def test_errors(self):
+    with self.assertRaises(ValueError):
+      SyntheticDatumGenerator(gen_config=AttrDict(num_examples=10))
+    for spec in [{
+        'dtype': 'complex'
+    }, {
+        'dtype': 'int',
+        'shape': [None]
+    }, {
+        'dtype': 'int',
+        'shape': [None],
+        'min_length': 3,
+        'max_length': 2
+    }, {
+        'dtype': 'image',
+        'channels': 4
+    }, {
+        'dtype': 'image',
+        'format': 'gif'
+    }]:
+      with self.assertRaises(ValueError):
+        SyntheticDatumGenerator(gen_config=AttrDict(features={'feature': spec}))
+    with self.assertRaises(ValueError):
+      SyntheticDatumGenerator(gen_config=AttrDict(features=self.features, key_distribution='zipf'))
+    with self.assertRaises(ValueError):
+      list(self.gen())
+    with self.assertRaises(ValueError):
+      list(self.gen(split='test'))
+
+
+class TestSyntheticDataset(absltest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    rmtree(self.tempdir)
+
+  def test_write_and_read(self):
+    features = {
+        'image': {
+            'dtype': 'image',
+            'height': 32,
+            'width': 32
+        },
+        'label': {
+            'dtype': 'int',
+            'high': 10
+        },
+        'boxes': {
+            'dtype': 'float',
+            'shape': [None, 4],
+            'max_length': 3
+        },
+    }
+    gen = SyntheticDatumGenerator(gen_config=AttrDict(num_examples=20, features=features))
+    writer = TFRecordWriter(gen,
+                            DatumSerializer('image'),
+                            self.tempdir,
+                            'train',
+                            20,
+                            sparse_features=gen.sparse_features)
+    writer.create_records()
+    dataset = load(self.tempdir)
+    example = next(iter(dataset._reader.read('train', False)))
+    self.assertEqual(example['image'].shape, [32, 32, 3])
+    self.assertTrue(
+        any(
+            np.array_equal(example['boxes'].numpy(), datum['boxes'])
+            for _, datum in gen(split='train')))
+    dataset_configs = dataset.dataset_configs
+    dataset_configs.batch_size_train = 4
+    dataset_configs.use_datum_padding = True
+    batch = next(iter(dataset.train_fn('train', False)))
+    self.assertEqual(batch['image'].shape, [4, 32, 32, 3])
+    self.assertEqual(batch['boxes'].shape[-1], 4)
+
+
+if __name__ == '__main__':
+  absltest.main()
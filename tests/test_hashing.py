@@ -0,0 +1,54 @@
+# Copyright 2021 The OpenAGI Datum Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+
+from absl.testing import absltest
+
+from datum.utils import hashing
+
+_KEYS = ['a', b'a', 1, 'é', 2.5, b'\x00\xff'] + [f'key_{i}' for i in range(100)]
+
+
+class TestHasher(absltest.TestCase):
+
+  def test_md5_order_is_stable(self):
+    # Datasets written with md5 must keep their order.
+    hasher = hashing.Hasher('train')
+    self.assertEqual(hasher.hash_fn, hashing.HASH_MD5)
+    for key in _KEYS:
+      key_bytes = key if isinstance(key, bytes) else str(key).encode('utf-8')
+      expected = int(hashlib.md5(b'train' + key_bytes).hexdigest(), 16)
+      self.assertEqual(hasher.hash_key(key), expected)
+    self.assertEqual(hasher.hash_key('1'), hasher.hash_key(1))
+
+  def test_hash_keys(self):
+    for hash_fn in (hashing.HASH_MD5, hashing.HASH_BLAKE2B):
+      hasher = hashing.Hasher('train', hash_fn)
+      self.assertEqual(hasher.hash_keys(_KEYS), [hasher.hash_key(key) for key in _KEYS])
+      self.assertEqual(hasher.hash_keys([]), [])
+
+  def test_blake2b(self):
+    hasher = hashing.Hasher('train', hashing.HASH_BLAKE2B)
+    hkey = hasher.hash_key('key')
+    self.assertEqual(hkey, int(hashlib.blake2b(b'trainkey', digest_size=16).hexdigest(), 16))
+    self.assertNotEqual(hkey, hashing.Hasher('train').hash_key('key'))
+    self.assertLess(hkey, 1 << 128)
+
+  def test_unsupported_hash_fn(self):
+    with self.assertRaises(ValueError):
+      hashing.Hasher('train', 'sha1')
+
+
+if __name__ == '__main__':
+  absltest.main()
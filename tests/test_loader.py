@@ -103,3 +103,20 @@ class TestDataset(absltest.TestCase):
     self.assertEqual(batch_2['image'].shape, [2, 224, 224, 3])
     with self.assertRaises(StopIteration):
       next(ds)
+
+  def test_tf_padding(self):
+    dataset_configs = self._dataset.dataset_configs
+    dataset_configs.batch_size_train = 2
+    dataset_configs.use_tf_padding = True
+    ds = self._dataset.train_fn('train', False)
+    batch = next(iter(ds))
+    self.assertEqual(batch['xmin'].shape[0], 2)
+
+  def test_bucketing(self):
+    dataset_configs = self._dataset.dataset_configs
+    dataset_configs.bucket_fn = lambda example: tf.shape(example['xmin'])[0]
+    dataset_configs.bucket_op.bucket_boundaries = [3]
+    dataset_configs.bucket_op.bucket_batch_sizes = [1, 1]
+    ds = self._dataset.train_fn('train', False)
+    batch = next(iter(ds))
+    self.assertEqual(batch['image'].shape[0], 1)
@@ -15,6 +15,7 @@ import numpy as np
 import tensorflow as tf
 from absl.testing import absltest
 
+from datum.encoder.encoder import ImageEncoder
 from datum.serializer.serializer import (DatumSerializer, _item_to_tf_feature, serialize_datum)
 from datum.utils.common_utils import is_string
 
@@ -92,3 +93,12 @@ class TestDatumSerializer(absltest.TestCase):
     self.assertEqual(1, parsed_example['label2'].numpy())
     self.assertEqual('test', parsed_example['label4'].numpy().decode('utf-8'))
     self.assertEqual(np.array(1.1, dtype=np.float32), np.array(parsed_example['label3'].numpy()))
+
+
+class TestImageEncoder(absltest.TestCase):
+
+  def test_encode_bytes(self):
+    image = tf.io.gfile.GFile('tests/dummy_data/clf/train/image_232.jpg', mode="rb").read()
+    self.assertEqual(image, ImageEncoder()(image))
+    with self.assertRaises(ValueError):
+      ImageEncoder()(b'not an image')
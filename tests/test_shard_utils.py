@@ -0,0 +1,53 @@
+# Copyright 2021 The OpenAGI Datum Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from absl.testing import absltest
+
+from datum.utils import shard_utils
+
+
+class TestGetNumberShards(absltest.TestCase):
+
+  def test_default(self):
+    self.assertEqual(shard_utils.get_number_shards(100 << 20, 10**6), 1)
+    self.assertEqual(shard_utils.get_number_shards(10 << 30, 10**6), 128)
+    self.assertEqual(shard_utils.get_number_shards(10 << 30, 10**6),
+                     shard_utils._get_number_shards(10 << 30, 10**6))
+
+  def test_shard_size(self):
+    self.assertEqual(shard_utils.get_number_shards(100 << 20, 10**6, shard_size=16 << 20), 8)
+    self.assertEqual(shard_utils.get_number_shards(1 << 20, 10**4, shard_size=16 << 20), 1)
+
+  def test_min_shards(self):
+    self.assertEqual(shard_utils.get_number_shards(100 << 20, 10**6, min_shards=16), 16)
+    self.assertEqual(shard_utils.get_number_shards(10 << 30, 10**6, min_shards=16), 128)
+
+  def test_shards_multiple(self):
+    self.assertEqual(shard_utils.get_number_shards(10 << 30, 10**6, shards_multiple=48), 144)
+    self.assertEqual(
+        shard_utils.get_number_shards(100 << 20, 10**6, min_shards=10, shards_multiple=8), 16)
+
+  def test_few_examples(self):
+    self.assertEqual(shard_utils.get_number_shards(1 << 30, 20, min_shards=32, shards_multiple=8),
+                     16)
+    self.assertEqual(shard_utils.get_number_shards(1 << 30, 5, min_shards=32, shards_multiple=8), 5)
+
+  def test_invalid_targets(self):
+    with self.assertRaises(ValueError):
+      shard_utils.get_number_shards(1 << 30, 100, min_shards=0)
+    with self.assertRaises(ValueError):
+      shard_utils.get_number_shards(1 << 30, 100, shard_size=0)
+
+
+if __name__ == '__main__':
+  absltest.main()
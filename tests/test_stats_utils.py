@@ -0,0 +1,48 @@
+# Copyright 2020 The OpenAGI Datum Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from absl.testing import absltest
+
+from datum.utils import stats_utils
+
+
+class TestWriteStats(absltest.TestCase):
+
+  def test_add_merge(self):
+    stats = stats_utils.WriteStats()
+    stats.add(stats_utils.STAGE_WRITE, 2.0, count=10, nbytes=100)
+    stats.add(stats_utils.STAGE_GENERATE, 0.5)
+    stats.add(stats_utils.STAGE_GENERATE, 0.5)
+    worker_stats = stats_utils.WriteStats()
+    worker_stats.add(stats_utils.STAGE_SERIALIZE, 1.0, nbytes=50)
+    stats.merge(worker_stats)
+    stats.examples = 10
+    stats.bytes = 50
+    stats.stop()
+    stats_dict = stats.to_dict()
+    self.assertEqual(list(stats_dict['stages']), ['generate', 'serialize', 'write'])
+    self.assertEqual(stats_dict['stages']['generate'], {
+        'seconds': 1.0,
+        'count': 2,
+        'bytes': 0,
+        'examples_per_second': 2.0,
+        'bytes_per_second': 0.0,
+    })
+    self.assertEqual(stats_dict['stages']['write']['bytes_per_second'], 50.0)
+    self.assertEqual(stats_dict['stages']['serialize']['bytes'], 50)
+    self.assertEqual(stats_dict['seconds'], stats.seconds)
+    self.assertEqual(stats_dict['examples_per_second'], 10 / stats.seconds)
+
+
+if __name__ == '__main__':
+  absltest.main()
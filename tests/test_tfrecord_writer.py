@@ -11,15 +11,22 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import json
 import os
 import tempfile
 from pathlib import Path
 from shutil import rmtree
+from unittest import mock
 
+import tensorflow as tf
 from absl.testing import absltest, parameterized
 
+from datum.cache import bucket
+from datum.configs import TFRReadConfigs
 from datum.generator import image
+from datum.reader.tfrecord_reader import Reader
 from datum.serializer.serializer import DatumSerializer
+from datum.utils import info_utils, shard_utils, stats_utils
 from datum.utils.common_utils import AttrDict
 from datum.writer.tfrecord_writer import TFRecordWriter
 
@@ -61,3 +68,444 @@ class TestClfTFRecordWriter(absltest.TestCase):
                                  **gen_kwargs)
     self.writer.cache_records()
     self.writer.flush()
+
+  def test_cache_records_parallel(self, *args):
+    generator, num_examples = args
+    gen_kwargs = {'image_set': 'ImageSets'}
+    outputs = []
+    for num_workers in [1, 2]:
+      path = os.path.join(self.tempdir, str(num_workers))
+      Path(path).mkdir(parents=True, exist_ok=True)
+      self.writer = TFRecordWriter(generator,
+                                   self.serializer,
+                                   path,
+                                   'train',
+                                   num_examples,
+                                   num_workers=num_workers,
+                                   **gen_kwargs)
+      self.writer.create_records()
+      self.assertEqual(self.writer.current_examples, num_examples)
+      with open(os.path.join(path, 'train-00000-of-00001.tfrecord'), 'rb') as tfr_f:
+        outputs.append(tfr_f.read())
+    self.assertEqual(outputs[0], outputs[1])
+
+
+def _text_generator(split, num_examples=300, **kwargs):
+  for idx in range(num_examples):
+    yield idx, {'text': f'{split} example {idx}', 'label': idx}
+
+
+class TestSpilledTFRecordWriter(absltest.TestCase):
+
+  def setUp(self):
+    self.serializer = DatumSerializer('text')
+    self.tempdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    rmtree(self.tempdir)
+
+  def _create_records(self,
+                      name,
+                      memory_budget,
+                      generator=_text_generator,
+                      serializer=None,
+                      **kwargs):
+    path = os.path.join(self.tempdir, name)
+    Path(path).mkdir(parents=True, exist_ok=True)
+    with mock.patch.object(shard_utils, 'MIN_SHARD_SIZE', 1 << 10):
+      writer = TFRecordWriter(generator,
+                              serializer or self.serializer,
+                              path,
+                              'train',
+                              300,
+                              memory_budget=memory_budget,
+                              **kwargs)
+      writer.create_records()
+    outputs = {}
+    for filename in sorted(os.listdir(path)):
+      if filename.endswith('.tfrecord'):
+        with open(os.path.join(path, filename), 'rb') as tfr_f:
+          outputs[filename] = tfr_f.read()
+    return outputs
+
+  def test_flush_parallel(self):
+    in_memory = self._create_records('in_memory', 1 << 30)
+    self.assertGreater(len(in_memory), 1)
+    self.assertEqual(in_memory, self._create_records('spilled', 0, buckets_number=1000))
+    self.assertEqual(in_memory, self._create_records('derived', 1 << 10))
+    self.assertEqual(in_memory,
+                     self._create_records('parallel', 0, buckets_number=1000, flush_workers=2))
+    self.assertEqual(in_memory,
+                     self._create_records('oversized', 1 << 10, buckets_number=3, flush_workers=2))
+
+  def test_buckets_number(self):
+    shuffler = bucket.Shuffler(self.tempdir, 'train', memory_budget=1 << 10, total_examples=300)
+    for key, example in _text_generator('train'):
+      shuffler.add(key, self.serializer(example))
+    # ~300 records of ~80 bytes, buckets are about half the memory budget.
+    self.assertBetween(len(shuffler.bucket_lengths), 30, 100)
+    self.assertLen(list(shuffler), 300)
+
+  def test_spill_compression(self):
+    in_memory = self._create_records('in_memory', 1 << 30)
+    self.assertEqual(
+        in_memory, self._create_records('zlib', 1 << 10, buckets_number=3, spill_compression='zlib'))
+    self.assertEqual(
+        in_memory,
+        self._create_records('lzma',
+                             1 << 10,
+                             buckets_number=3,
+                             flush_workers=2,
+                             spill_compression='lzma'))
+
+  def test_hash_fn(self):
+    md5 = self._create_records('md5', 1 << 30)
+    blake2b = self._create_records('blake2b', 1 << 30, hash_fn='blake2b')
+    self.assertNotEqual(md5, blake2b)
+    self.assertEqual(
+        blake2b, self._create_records('blake2b_parallel', 1 << 30, hash_fn='blake2b', num_workers=2))
+    for name, hash_fn in (('md5', 'md5'), ('blake2b', 'blake2b')):
+      dataset_info = info_utils.load_dataset_info(os.path.join(self.tempdir, name))
+      self.assertEqual(list(dataset_info), ['train'])
+      self.assertEqual(dataset_info['train']['hash_fn'], hash_fn)
+
+  def test_detect_duplicates(self):
+
+    def generator(split):
+      yield from _text_generator(split, num_examples=100)
+      yield 10, {'text': 'duplicate', 'label': 10}
+      for idx in range(100, 1000):
+        yield idx, {'text': f'{split} example {idx}', 'label': idx}
+
+    for num_workers in (1, 2):
+      writer = TFRecordWriter(generator,
+                              self.serializer,
+                              self.tempdir,
+                              'train',
+                              1001,
+                              num_workers=num_workers,
+                              detect_duplicates=True)
+      with self.assertRaisesRegex(AssertionError, 'same hashed key'):
+        writer.cache_records()
+      # Reported while examples are generated, not when writing shards.
+      self.assertLess(writer.current_examples, 200)
+
+  def test_resume(self):
+    in_memory = self._create_records('in_memory', 1 << 30)
+
+    def preempted_generator(split):
+      for key, example in _text_generator(split):
+        if key == 200:
+          raise RuntimeError('Preempted.')
+        yield key, example
+
+    serialized = []
+
+    def serializer(datum):
+      serialized.append(datum['label'])
+      return self.serializer(datum)
+
+    write_tfrecord = shard_utils.write_tfrecord
+
+    def preempted_write_tfrecord(path, iterator, *args):
+      if '-00000-of-' not in path:
+        raise RuntimeError('Preempted.')
+      return write_tfrecord(path, iterator, *args)
+
+    types_shapes = json.load(
+        open(os.path.join(self.tempdir, 'in_memory', info_utils.TYPES_SHAPES_FILENAME)))
+    kwargs = dict(buckets_number=3, resume=True, checkpoint_interval=0)
+    for spill_strategy in ('buckets', 'runs'):
+      name = f'resumed_{spill_strategy}'
+      with self.assertRaisesRegex(RuntimeError, 'Preempted'):
+        self._create_records(name,
+                             1 << 10,
+                             preempted_generator,
+                             spill_strategy=spill_strategy,
+                             **kwargs)
+      with mock.patch.object(shard_utils, 'write_tfrecord', preempted_write_tfrecord):
+        with self.assertRaisesRegex(RuntimeError, 'Preempted'):
+          self._create_records(name,
+                               1 << 10,
+                               serializer=serializer,
+                               spill_strategy=spill_strategy,
+                               **kwargs)
+      # The 200 first examples were cached before being preempted, sorted runs are checkpointed
+      # once spilled.
+      self.assertEqual(serialized, list(range(serialized[0], 300)))
+      if spill_strategy == 'buckets':
+        self.assertEqual(serialized[0], 200)
+      else:
+        self.assertBetween(serialized[0], 150, 200)
+      serialized.clear()
+      self.assertEqual(
+          in_memory,
+          self._create_records(name,
+                               1 << 10,
+                               serializer=serializer,
+                               spill_strategy=spill_strategy,
+                               merge_metadata=False,
+                               **kwargs))
+      # All the examples were cached before writing shards was preempted.
+      self.assertEmpty(serialized)
+      self.assertEqual(info_utils.merge_manifests(os.path.join(self.tempdir, name), ['train']),
+                       ['train'])
+      self.assertEqual(
+          types_shapes,
+          json.load(open(os.path.join(self.tempdir, name, info_utils.TYPES_SHAPES_FILENAME))))
+      self.assertCountEqual(
+          os.listdir(self.tempdir), ['in_memory'] +
+          [f'resumed_{strategy}' for strategy in ('buckets', 'runs') if strategy <= spill_strategy])
+    self.assertNotIn('train.checkpoint.json', os.listdir(os.path.join(self.tempdir, name)))
+
+  def test_resume_flush_parallel(self):
+    in_memory = self._create_records('in_memory', 1 << 30)
+
+    def preempted_generator(split):
+      yield from _text_generator(split, num_examples=200)
+      raise RuntimeError('Preempted.')
+
+    kwargs = dict(buckets_number=3, flush_workers=2, resume=True, checkpoint_interval=0)
+    with self.assertRaisesRegex(RuntimeError, 'Preempted'):
+      self._create_records('resumed', 1 << 10, preempted_generator, **kwargs)
+    self.assertEqual(in_memory, self._create_records('resumed', 1 << 10, **kwargs))
+    self.assertCountEqual(os.listdir(self.tempdir), ['in_memory', 'resumed'])
+
+  def test_resume_in_memory(self):
+    in_memory = self._create_records('in_memory', 1 << 30)
+
+    def preempted_generator(split):
+      yield from _text_generator(split, num_examples=200)
+      raise RuntimeError('Preempted.')
+
+    for spill_strategy in ('buckets', 'runs'):
+      name = f'resumed_{spill_strategy}'
+      kwargs = dict(spill_strategy=spill_strategy, resume=True, checkpoint_interval=0)
+      with self.assertRaisesRegex(RuntimeError, 'Preempted'):
+        self._create_records(name, 1 << 30, preempted_generator, **kwargs)
+      # Examples held in memory are not written to disk to be checkpointed.
+      self.assertEmpty(os.listdir(os.path.join(self.tempdir, name)))
+      self.assertFalse(
+          [filename for filename in os.listdir(self.tempdir) if filename.endswith('.tmp')])
+      self.assertEqual(in_memory, self._create_records(name, 1 << 30, **kwargs))
+
+  def test_merge_manifests(self):
+    self._create_records('manifests', 1 << 30, merge_metadata=False)
+    path = os.path.join(self.tempdir, 'manifests')
+    with open(os.path.join(path, 'train' + info_utils.MANIFEST_SUFFIX)) as manifest_f:
+      manifest = json.load(manifest_f)
+    # Manifest left by an earlier run, whose shards were since removed.
+    stale_manifest = dict(manifest, shard_info={'val-00000-of-00001.tfrecord': 300})
+    info_utils.write_manifest(path, 'val', stale_manifest)
+    info_utils.write_manifest(path, 'test', manifest)
+    self.assertEqual(info_utils.merge_manifests(path, ['val', 'train']), ['train'])
+    self.assertEqual(list(info_utils.load_shard_info(path)), ['train'])
+    self.assertCountEqual([name for name in os.listdir(path) if name.endswith('.manifest.json')],
+                          ['val.manifest.json', 'test.manifest.json'])
+
+    def preempted_generator(split):
+      yield from _text_generator(split, num_examples=200)
+      raise RuntimeError('Preempted.')
+
+    # A new run of the split removes the manifest of the earlier run.
+    info_utils.write_manifest(path, 'train', manifest)
+    with self.assertRaisesRegex(RuntimeError, 'Preempted'):
+      self._create_records('manifests', 1 << 30, preempted_generator, merge_metadata=False)
+    self.assertFalse(os.path.exists(os.path.join(path, 'train' + info_utils.MANIFEST_SUFFIX)))
+
+  def test_append(self):
+    in_memory = self._create_records('appended', 1 << 30)
+
+    def delta_generator(split, day):
+      for idx in range(day * 1000, day * 1000 + 30):
+        yield idx, {'text': f'{split} example {idx}', 'label': idx}
+
+    for day in (1, 2):
+      self._create_records('appended', 1 << 30, delta_generator, append=True, day=day)
+    path = os.path.join(self.tempdir, 'appended')
+    outputs = self._create_records('appended', 1 << 30, delta_generator, append=True, day=3)
+    # Existing shards are left untouched.
+    self.assertEqual(outputs, {**outputs, **in_memory})
+    shard_info = json.load(open(os.path.join(path, 'shard_info.json')))['train']
+    self.assertEqual(list(shard_info)[:len(in_memory)], sorted(in_memory))
+    self.assertTrue(list(shard_info)[-1].startswith('train-append003-'))
+    self.assertEqual(sum(shard_info.values()), 390)
+    reader = Reader(path, TFRReadConfigs())
+    labels = [int(datum['label']) for datum in reader.read('train[300:]', False)]
+    self.assertCountEqual(labels, [day * 1000 + idx for day in (1, 2, 3) for idx in range(30)])
+    labels = [int(datum['label']) for datum in reader.read('train[:300]', False)]
+    self.assertCountEqual(labels, range(300))
+
+    def other_features_generator(split):
+      yield 5000, {'text': 'example', 'label': 'label'}
+      raise AssertionError('Features are checked on the first appended example.')
+
+    with self.assertRaisesRegex(ValueError, 'features'):
+      self._create_records('appended', 1 << 30, other_features_generator, append=True)
+    with self.assertRaisesRegex(ValueError, 'does not exist'):
+      self._create_records('new', 1 << 30, append=True)
+    with self.assertRaisesRegex(ValueError, 'hash function'):
+      self._create_records('appended',
+                           1 << 30,
+                           delta_generator,
+                           append=True,
+                           day=4,
+                           hash_fn='blake2b')
+    with self.assertRaisesRegex(ValueError, 'shuffle mode'):
+      self._create_records('appended', 1 << 30, delta_generator, append=True, day=4, shuffle='none')
+
+  def test_streaming(self):
+
+    def read_labels(name):
+      reader = Reader(os.path.join(self.tempdir, name), TFRReadConfigs())
+      return [int(datum['label']) for datum in reader.read('train', False)]
+
+    self._create_records('full', 1 << 30)
+    with mock.patch.object(shard_utils, 'ROLLING_SHARD_SIZE', 1 << 10):
+      unshuffled = self._create_records('none', 0, shuffle='none')
+      self._create_records('window', 1 << 10, shuffle='window')
+      self._create_records('window_parallel', 1 << 10, shuffle='window', num_workers=2)
+      self._create_records('whole_window', 1 << 30, shuffle='window')
+    self.assertGreater(len(unshuffled), 1)
+    self.assertTrue(all(len(shard) <= 1 << 10 for shard in unshuffled.values()))
+    self.assertEqual(read_labels('none'), list(range(300)))
+    labels = read_labels('window')
+    self.assertCountEqual(labels, range(300))
+    self.assertNotEqual(labels, list(range(300)))
+    self.assertEqual(read_labels('window_parallel'), labels)
+    # A window holding the whole split shuffles it fully.
+    self.assertEqual(read_labels('whole_window'), read_labels('full'))
+    # Nothing but the shards and metadata is written.
+    self.assertCountEqual(os.listdir(self.tempdir),
+                          ['full', 'none', 'window', 'window_parallel', 'whole_window'])
+    self.assertEmpty(
+        [name for name in os.listdir(os.path.join(self.tempdir, 'none')) if name.endswith('.tmp')])
+    dataset_info = info_utils.load_dataset_info(os.path.join(self.tempdir, 'none'))
+    self.assertEqual(dataset_info['train']['shuffle'], 'none')
+    with self.assertRaises(ValueError):
+      self._create_records('unsupported', 0, shuffle='partial')
+
+  def test_compression_type(self):
+
+    def read_records(name, compression_type):
+      path = os.path.join(self.tempdir, name)
+      shard_info = json.load(open(os.path.join(path, 'shard_info.json')))['train']
+      files = [os.path.join(path, filename) for filename in shard_info]
+      return list(
+          tf.data.TFRecordDataset(files, compression_type=compression_type).as_numpy_iterator())
+
+    uncompressed = self._create_records('uncompressed', 1 << 30)
+    gzip = self._create_records('gzip', 1 << 30, compression_type='GZIP')
+    # Shards are sized after their compressed size.
+    self.assertLess(len(gzip), len(uncompressed))
+    self.assertLess(sum(map(len, gzip.values())), sum(map(len, uncompressed.values())) // 2)
+    records = read_records('uncompressed', None)
+    self.assertLen(records, 300)
+    self.assertEqual(read_records('gzip', 'GZIP'), records)
+    self.assertEqual(
+        gzip,
+        self._create_records('gzip_parallel',
+                             0,
+                             buckets_number=3,
+                             flush_workers=2,
+                             compression_type='GZIP'))
+    self._create_records('zlib', 1 << 30, compression_type='ZLIB', shuffle='window')
+    self.assertEqual(read_records('zlib', 'ZLIB'), records)
+    dataset_info = info_utils.load_dataset_info(os.path.join(self.tempdir, 'gzip'))
+    self.assertEqual(dataset_info['train']['compression_type'], 'GZIP')
+    # The reader picks the compression type up from the dataset info.
+    labels = {}
+    for name in ('uncompressed', 'gzip'):
+      reader = Reader(os.path.join(self.tempdir, name), TFRReadConfigs())
+      labels[name] = [int(datum['label']) for datum in reader.read('train[:50%]', False)]
+    self.assertLen(labels['gzip'], 150)
+    self.assertCountEqual(labels['gzip'], labels['uncompressed'])
+    with self.assertRaisesRegex(ValueError, 'compression type'):
+      self._create_records('gzip', 1 << 30, append=True)
+    with self.assertRaises(ValueError):
+      self._create_records('unsupported', 1 << 30, compression_type='gzip')
+
+  def test_sharding_targets(self):
+    # About 20KB of examples.
+    self.assertLen(self._create_records('default', 1 << 30), 16)
+    self.assertLen(self._create_records('shard_size', 1 << 30, shard_size=5 << 10), 4)
+    self.assertLen(self._create_records('min_shards', 1 << 30, shard_size=5 << 10, min_shards=6), 6)
+    outputs = self._create_records('shards_multiple',
+                                   1 << 30,
+                                   shard_size=5 << 10,
+                                   min_shards=5,
+                                   shards_multiple=8)
+    self.assertLen(outputs, 8)
+    dataset_info = info_utils.load_dataset_info(os.path.join(self.tempdir, 'shards_multiple'))
+    self.assertEqual(dataset_info['train']['sharding'],
+                     dict(num_shards=8, shard_size=5 << 10, min_shards=5, shards_multiple=8))
+    self.assertLen(self._create_records('streamed', 0, shuffle='none', shard_size=5 << 10), 4)
+    with self.assertRaises(ValueError):
+      self._create_records('streamed_min_shards', 0, shuffle='none', min_shards=4)
+
+  def test_write_index(self):
+    outputs = {
+        'in_memory':
+        self._create_records('in_memory', 1 << 30, write_index=True),
+        'parallel':
+        self._create_records('parallel', 0, buckets_number=3, flush_workers=2, write_index=True),
+        'streamed':
+        self._create_records('streamed', 0, shuffle='none', shard_size=5 << 10, write_index=True),
+    }
+    for name, shards in outputs.items():
+      dataset_info = info_utils.load_dataset_info(os.path.join(self.tempdir, name))
+      self.assertTrue(dataset_info['train']['record_index'])
+      for filename, content in shards.items():
+        path = os.path.join(self.tempdir, name, filename)
+        index = shard_utils.read_record_index(path)
+        records = list(tf.data.TFRecordDataset(path).as_numpy_iterator())
+        self.assertLen(index, len(records))
+        # A record is its 8 bytes length and its 4 bytes crc, the example and its 4 bytes crc.
+        self.assertEqual([content[offset + 12:offset + 12 + length] for offset, length in index],
+                         records)
+        self.assertEqual(index[-1].sum() + shard_utils.TFRECORD_REC_OVERHEAD, len(content))
+    self.assertEqual(outputs['in_memory'], self._create_records('no_index', 1 << 30))
+    self.assertEmpty([
+        name for name in os.listdir(os.path.join(self.tempdir, 'no_index')) if name.endswith('.idx')
+    ])
+    with self.assertRaises(ValueError):
+      self._create_records('compressed', 1 << 30, compression_type='GZIP', write_index=True)
+
+  def test_rewrite_split(self):
+    self._create_records('rewritten', 1 << 30)
+    outputs = self._create_records('rewritten', 1 << 30, shard_size=5 << 10)
+    shard_info = json.load(open(os.path.join(self.tempdir, 'rewritten', 'shard_info.json')))
+    self.assertLen(shard_info['train'], 4)
+    self.assertContainsSubset(shard_info['train'], outputs)
+
+  def test_write_stats(self):
+    runs = {
+        'in_memory': (1 << 30, {}),
+        'spilled': (1 << 10, {}),
+        'parallel': (1 << 30, dict(num_workers=2)),
+        'window': (1 << 10, dict(shuffle='window')),
+    }
+    for name, (memory_budget, kwargs) in runs.items():
+      self._create_records(name, memory_budget, **kwargs)
+      with open(os.path.join(self.tempdir, name, info_utils.WRITE_STATS_FILENAME)) as stats_f:
+        stats = json.load(stats_f)['train']
+      self.assertEqual(stats['examples'], 300)
+      self.assertEqual(list(stats['stages']), list(stats_utils.STAGES))
+      for stage, stage_stats in stats['stages'].items():
+        self.assertEqual(stage_stats['count'], 300, msg=f'{name} {stage}')
+      self.assertEqual(stats['stages']['serialize']['bytes'], stats['bytes'])
+      self.assertGreater(stats['peak_buffer_size'], 0)
+      if name == 'spilled':
+        self.assertGreater(stats['spill_bytes'], 0)
+      else:
+        self.assertEqual(stats['spill_bytes'], 0)
+    writer = TFRecordWriter(_text_generator, self.serializer, self.tempdir, 'train', 300)
+    stats = writer.create_records()
+    self.assertIsInstance(stats, stats_utils.WriteStats)
+    self.assertEqual(stats.to_dict()['examples'], 300)
+
+  def test_flush_runs(self):
+    in_memory = self._create_records('in_memory', 1 << 30)
+    self.assertEqual(in_memory, self._create_records('runs', 1 << 12, spill_strategy='runs'))
+    # Shards never exhaust the merged runs, run files are still removed.
+    self.assertEmpty([name for name in os.listdir(self.tempdir) if name.endswith('.tmp')])
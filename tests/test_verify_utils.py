@@ -0,0 +1,108 @@
+# Copyright 2021 The OpenAGI Datum Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import tempfile
+from shutil import rmtree
+
+from absl.testing import absltest
+
+from datum.serializer.serializer import DatumSerializer
+from datum.utils import info_utils, shard_utils, verify_utils
+from datum.writer.tfrecord_writer import TFRecordWriter
+
+
+def _text_generator(split, num_examples=300, **kwargs):
+  for idx in range(num_examples):
+    yield idx, {'text': f'{split} example {idx}', 'label': idx}
+
+
+class TestVerifyDataset(absltest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    serializer = DatumSerializer('text')
+    TFRecordWriter(_text_generator,
+                   serializer,
+                   self.tempdir,
+                   'train',
+                   300,
+                   shard_size=5 << 10,
+                   write_index=True,
+                   write_checksums=True).create_records()
+    TFRecordWriter(_text_generator,
+                   serializer,
+                   self.tempdir,
+                   'val',
+                   300,
+                   shuffle='none',
+                   shard_size=5 << 10,
+                   compression_type='GZIP').create_records()
+    self.shard_info = info_utils.load_shard_info(self.tempdir)
+
+  def tearDown(self):
+    rmtree(self.tempdir)
+
+  def _shard_path(self, split, shard_index):
+    return os.path.join(self.tempdir, list(self.shard_info[split])[shard_index])
+
+  def test_digests(self):
+    dataset_info = info_utils.load_dataset_info(self.tempdir)
+    for split in ['train', 'val']:
+      digests = dataset_info[split]['shards']
+      self.assertEqual(list(digests), list(self.shard_info[split]))
+      for filename, num_examples in self.shard_info[split].items():
+        path = os.path.join(self.tempdir, filename)
+        checksum = split == 'train'
+        self.assertEqual(digests[filename],
+                         shard_utils.get_shard_digest(path, num_examples, checksum))
+        self.assertEqual('sha256' in digests[filename], checksum)
+        self.assertEqual(digests[filename]['size'], os.path.getsize(path))
+
+  def test_valid(self):
+    self.assertEmpty(verify_utils.verify_dataset(self.tempdir))
+    self.assertEmpty(verify_utils.verify_dataset(self.tempdir, verify_utils.VERIFY_FULL))
+
+  def test_truncated(self):
+    path = self._shard_path('train', 1)
+    with open(path, 'r+b') as shard_f:
+      shard_f.truncate(os.path.getsize(path) - 10)
+    os.remove(self._shard_path('val', 0))
+    problems = verify_utils.verify_dataset(self.tempdir)
+    self.assertEqual(
+        sorted(problems),
+        sorted(
+            os.path.basename(self._shard_path(split, index))
+            for split, index in [('train', 1), ('val', 0)]))
+    self.assertIn('(truncated)', problems[os.path.basename(path)][0])
+    self.assertEqual(problems[os.path.basename(self._shard_path('val', 0))], ['missing shard'])
+
+  def test_corrupted(self):
+    path = self._shard_path('train', 2)
+    with open(path, 'r+b') as shard_f:
+      shard_f.seek(100)
+      byte = shard_f.read(1)
+      shard_f.seek(100)
+      shard_f.write(bytes([byte[0] ^ 0xff]))
+    self.assertEmpty(verify_utils.verify_dataset(self.tempdir))
+    problems = verify_utils.verify_dataset(self.tempdir,
+                                           verify_utils.VERIFY_FULL,
+                                           splits=['train'],
+                                           num_workers=2)
+    self.assertEqual(list(problems), [os.path.basename(path)])
+    self.assertEqual(problems[os.path.basename(path)][0], 'sha256 digest mismatch')
+    self.assertStartsWith(problems[os.path.basename(path)][1], 'corrupted records')
+
+
+if __name__ == '__main__':
+  absltest.main()